@@ -0,0 +1,103 @@
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+
+answer_cache_path = "./answer_cache.sqlite"
+# 问题 embedding 的余弦相似度超过这个值才算同一个问题
+answer_cache_threshold = 0.95
+answer_cache_ttl = 7 * 24 * 3600
+answer_cache_max_entries = 2000
+
+
+def normalize_question(question):
+    question = re.sub(r"\s+", " ", question.strip().lower())
+    return question.rstrip("?？!！。.， ")
+
+
+class AnswerCache(object):
+    """Cache of answers to standalone questions, matched by question embedding similarity.
+
+    Entries are scoped (e.g. by index snapshot version and LLM) so an answer
+    is only reused for the same knowledge base and model. Entries expire
+    after ``ttl`` seconds and the least recently used ones are evicted
+    beyond ``max_entries``.
+    """
+
+    def __init__(self, embed_model, path=answer_cache_path, threshold=answer_cache_threshold,
+                 ttl=answer_cache_ttl, max_entries=answer_cache_max_entries):
+        self.embed_model = embed_model
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            "scope TEXT NOT NULL, key TEXT NOT NULL, question TEXT NOT NULL, embedding BLOB NOT NULL, "
+            "answer TEXT NOT NULL, sources TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL, "
+            "PRIMARY KEY (scope, key))")
+        self._conn.commit()
+
+    def _embed(self, normalized):
+        embedding = np.asarray(self.embed_model.get_query_embedding(normalized), dtype=np.float32)
+        return embedding / (np.linalg.norm(embedding) or 1.0)
+
+    def lookup(self, question, scope):
+        """Return {"question", "answer", "sources", "similarity"} for a cached answer, or None."""
+        normalized = normalize_question(question)
+        key = hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+        with self._lock:
+            self._conn.execute("DELETE FROM answers WHERE created < ?", (time.time() - self.ttl,))
+            # 未命中时也要提交, 不然共享连接上一直挂着写事务
+            self._conn.commit()
+            row = self._conn.execute(
+                "SELECT key, question, answer, sources FROM answers WHERE scope=? AND key=?", (scope, key)).fetchone()
+        similarity = 1.0
+        if row is None:
+            # 文字不完全一样时再比较 embedding, 同义问法也能命中
+            embedding = self._embed(normalized)
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT key, question, answer, sources, embedding FROM answers WHERE scope=?", (scope,)).fetchall()
+            if rows:
+                similarities = np.stack([np.frombuffer(r[4], dtype=np.float32) for r in rows]) @ embedding
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    row, similarity = rows[best][:4], float(similarities[best])
+
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with self._lock:
+            self._conn.execute("UPDATE answers SET last_used=? WHERE scope=? AND key=?", (time.time(), scope, row[0]))
+            self._conn.commit()
+        return {"question": row[1], "answer": row[2], "sources": json.loads(row[3]), "similarity": similarity}
+
+    def store(self, question, scope, answer, sources):
+        normalized = normalize_question(question)
+        key = hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+        embedding = self._embed(normalized)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO answers (scope, key, question, embedding, answer, sources, created, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (scope, key, question, embedding.tobytes(), answer, json.dumps(sources, ensure_ascii=False), now, now))
+            count = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM answers WHERE rowid IN (SELECT rowid FROM answers ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,))
+            self._conn.commit()
+
+    def report(self):
+        total = self.hits + self.misses
+        return f"answer cache: {self.hits} hits, {self.misses} misses ({self.hits / total if total else 0.0:.1%} hit rate)"
@@ -62,6 +62,7 @@ user_access_token = getUserAccessToken(oauth_code)
 import requests
 import logging
 from urllib import parse
+from feishuToken import FeishuException, get_token_provider
 
 # const
 # open api capability
@@ -70,8 +71,9 @@ APP_ACCESS_TOKEN_URI = "/open-apis/auth/v3/app_access_token/internal"
 USER_INFO_URI = "/open-apis/authen/v1/user_info"
 
 class Auth(object):
-    def __init__(self, feishu_host, app_id, app_secret):
+    def __init__(self, feishu_host, app_id, app_secret, user_key="default"):
         self.feishu_host = feishu_host
+        self.user_key = user_key
         self.app_id = app_id
         self.app_secret = app_secret
         self._app_access_token = ""
@@ -79,6 +81,9 @@ class Auth(object):
 
     @property
     def user_access_token(self):
+        # 过期前由 TokenProvider 用 refresh_token 自动刷新
+        if self._user_access_token:
+            self._user_access_token = self._token_provider().user_access_token(self.user_key)
         return self._user_access_token
 
     @property
@@ -103,7 +108,10 @@ class Auth(object):
         req_body = {"grant_type": "authorization_code", "code": code}
         response = requests.post(url=url, headers=headers, json=req_body)
         Auth._check_error_response(response)
-        self._user_access_token = response.json().get("data").get("access_token")
+        data = response.json().get("data")
+        self._user_access_token = data.get("access_token")
+        # 交给 TokenProvider 保存 refresh_token, 过期前自动刷新
+        self._token_provider().set_user_token(data.get("access_token"), data.get("expires_in"), data.get("refresh_token"), self.user_key)
 
     def get_user_info(self):
         # 获取 user info, 依托于飞书开放能力实现.  
@@ -123,12 +131,11 @@ class Auth(object):
     def authorize_app_access_token(self):
         # 获取 app_access_token, 依托于飞书开放能力实现. 
         # 文档链接: https://open.feishu.cn/document/ukTMukTMukTM/ukDNz4SO0MjL5QzM/auth-v3/auth/app_access_token_internal
-        url = self._gen_url(APP_ACCESS_TOKEN_URI)
-        # "app_id" 和 "app_secret" 位于HTTP请求的请求体
-        req_body = {"app_id": self.app_id, "app_secret": self.app_secret}
-        response = requests.post(url, req_body)
-        Auth._check_error_response(response)
-        self._app_access_token = response.json().get("app_access_token")
+        # token 由进程内共享的 TokenProvider 缓存, 快过期时才会重新请求
+        self._app_access_token = self._token_provider().app_access_token()
+
+    def _token_provider(self):
+        return get_token_provider(self.app_id, self.app_secret, feishu_host=self.feishu_host)
 
     def _gen_url(self, uri):
         # 拼接飞书开放平台域名feishu_host和uri
@@ -145,14 +152,3 @@ class Auth(object):
         if code != 0:
             logging.error(response_dict)
             raise FeishuException(code=code, msg=response_dict.get("msg"))
-
-class FeishuException(Exception):
-    # 处理并展示飞书侧返回的错误码和错误信息
-    def __init__(self, code=0, msg=None):
-        self.code = code
-        self.msg = msg
-
-    def __str__(self) -> str:
-        return "{}:{}".format(self.code, self.msg)
-
-    __repr__ = __str__
\ No newline at end of file
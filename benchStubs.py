@@ -0,0 +1,465 @@
+"""Local stand-ins for Feishu and the OpenAI-compatible API, for offline benchmarks.
+
+Each stub is a threaded HTTP server on 127.0.0.1 that answers a request from
+one of three places, in order:
+
+* ``record=True``: the live ``upstream``; the reply is appended to the cassette
+* the cassette (JSONL of earlier recordings), if it has the request
+* a deterministic synthetic reply (the fixture wiki dump, hashed embeddings,
+  an extractive "answer" built from the prompt's context)
+
+Replayed and synthetic replies wait ``latency[route]`` seconds first, and
+streamed replies wait ``token_latency`` between events, so the benchmark sees
+network-like timings without a network. Point the app at a stub with
+``QC_FEISHU_HOST`` / ``OPENAI_API_BASE``.
+"""
+import re
+import json
+import math
+import time
+import base64
+import struct
+import hashlib
+import threading
+from collections import Counter
+from urllib.parse import urlsplit, parse_qs, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+stub_embedding_dim = 256
+# 合成回答的长度 (字符), 流式输出时大约每 4 个字符一个 chunk
+stub_answer_chars = 400
+stub_upstream_timeout = 600
+
+_CJK = re.compile(r"[一-鿿]+")
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+class Reply(object):
+    def __init__(self, status=200, body=b"", content_type="application/json", events=None):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        # 流式回复按 SSE 事件逐个写出
+        self.events = events
+
+    @classmethod
+    def json(cls, payload, status=200):
+        return cls(status, json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+
+    @classmethod
+    def from_entry(cls, entry):
+        body = entry["body"].encode("utf-8")
+        events = None
+        if entry["content_type"].startswith("text/event-stream"):
+            events = [event + b"\n\n" for event in body.split(b"\n\n") if event.strip()]
+        return cls(entry["status"], body, entry["content_type"], events)
+
+    def entry(self):
+        body = self.body if self.events is None else b"".join(self.events)
+        return {"status": self.status, "content_type": self.content_type, "body": body.decode("utf-8", errors="replace")}
+
+
+class Cassette(object):
+    """Recorded replies keyed by request, kept in memory and appended to a JSONL file."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+        if path:
+            try:
+                with open(path) as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            continue
+                        self.entries[entry["key"]] = entry
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256("\n".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, entry):
+        entry = dict(entry, key=key)
+        with self._lock:
+            self.entries[key] = entry
+            if self.path:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def _normalized_body(body):
+    # JSON 请求体按 key 排序后再算 key, 字段顺序不同不影响命中
+    try:
+        return json.dumps(json.loads(body), sort_keys=True, ensure_ascii=False)
+    except ValueError:
+        return body.decode("utf-8", errors="replace")
+
+
+class StubServer(object):
+    """Threaded HTTP server answering from upstream (recording), a cassette or ``synthesize``.
+
+    Subclasses map a request to a route name with ``route`` and build
+    synthetic replies in ``synthesize``; ``latency`` is keyed by route, with
+    "*" as the default.
+    """
+
+    def __init__(self, cassette=None, upstream=None, record=False, latency=None, token_latency=0.0):
+        self.cassette = cassette or Cassette()
+        self.upstream = upstream.rstrip("/") if upstream else None
+        self.record = record and self.upstream is not None
+        self.latency = latency if isinstance(latency, dict) else {"*": latency or 0.0}
+        self.token_latency = token_latency
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+        self._server = None
+        self.url = None
+
+    def route(self, method, path):
+        return "*"
+
+    def recordable(self, route):
+        return True
+
+    def synthesize(self, route, method, path, query, payload):
+        return Reply.json({"error": f"no stub for {method} {path}"}, status=404)
+
+    def count(self, route, source):
+        with self._stats_lock:
+            self.stats[f"{route}:{source}"] += 1
+
+    def forward(self, method, path, headers, body):
+        response = requests.request(method, self.upstream + path, data=body or None, timeout=stub_upstream_timeout,
+                                    headers={name: value for name, value in headers.items()
+                                             if name.lower() in ("authorization", "content-type", "accept")})
+        reply = Reply(response.status_code, response.content, response.headers.get("Content-Type", "application/json"))
+        if reply.content_type.startswith("text/event-stream"):
+            reply = Reply.from_entry(reply.entry())
+        return reply
+
+    def handle(self, method, path, headers, body):
+        split = urlsplit(path)
+        route = self.route(method, split.path)
+        key = Cassette.key(method, path, _normalized_body(body))
+        if self.record:
+            reply = self.forward(method, path, headers, body)
+            # 鉴权接口的回复里有真实 token, 不落盘
+            if reply.status == 200 and self.recordable(route):
+                self.cassette.put(key, reply.entry())
+            self.count(route, "upstream")
+            return reply
+        entry = self.cassette.get(key)
+        if entry is not None:
+            reply = Reply.from_entry(entry)
+            self.count(route, "cassette")
+        else:
+            try:
+                payload = json.loads(body) if body else None
+            except ValueError:
+                payload = None
+            reply = self.synthesize(route, method, unquote(split.path), parse_qs(split.query), payload)
+            self.count(route, "synthetic")
+        time.sleep(self.latency.get(route, self.latency.get("*", 0.0)))
+        return reply
+
+    def start(self, host="127.0.0.1", port=0):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, 和真实服务一样复用连接池里的连接
+            protocol_version = "HTTP/1.1"
+
+            def _serve(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                try:
+                    reply = stub.handle(self.command, self.path, self.headers, body)
+                except Exception as e:
+                    reply = Reply.json({"error": f"{type(e).__name__}: {e}"}, status=502)
+                self.send_response(reply.status)
+                self.send_header("Content-Type", reply.content_type)
+                if reply.events is None:
+                    self.send_header("Content-Length", str(len(reply.body)))
+                    self.end_headers()
+                    self.wfile.write(reply.body)
+                    return
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for event in reply.events:
+                    if stub.token_latency:
+                        time.sleep(stub.token_latency)
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(event), event))
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+
+            do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = _serve
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.url = f"http://{host}:{self._server.server_address[1]}"
+        threading.Thread(target=self._server.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def report(self):
+        return ", ".join(f"{name}={count}" for name, count in sorted(self.stats.items()))
+
+
+def _ok(data):
+    return Reply.json({"code": 0, "msg": "success", "data": data})
+
+
+def _column_number(letters):
+    # A -> 1, Z -> 26, AA -> 27
+    n = 0
+    for letter in letters:
+        n = n * 26 + ord(letter) - ord("A") + 1
+    return n
+
+
+class FeishuStub(StubServer):
+    """Feishu open API over a wiki dump: {"space_id", "nodes": [...]}.
+
+    A docx node carries its raw ``content``; a sheet node carries ``sheets``,
+    each {"sheet_id", "title", "rows"}. Nodes point at their parent with
+    ``parent_node_token``.
+    """
+
+    routes = (
+        ("POST", re.compile(r"/open-apis/auth/v3/\w+/internal$"), "auth"),
+        ("GET", re.compile(r"/open-apis/wiki/v2/spaces/[^/]+/nodes$"), "wiki_nodes"),
+        ("POST", re.compile(r"/open-apis/drive/v1/metas/batch_query$"), "drive_meta"),
+        ("GET", re.compile(r"/open-apis/docx/v1/documents/[^/]+/raw_content$"), "docx"),
+        ("GET", re.compile(r"/open-apis/sheets/v3/spreadsheets/[^/]+/sheets/query$"), "sheets"),
+        ("GET", re.compile(r"/open-apis/sheets/v2/spreadsheets/[^/]+/values/.+$"), "sheet_values"),
+    )
+
+    def __init__(self, dump, **kwargs):
+        super().__init__(**kwargs)
+        self.space_id = dump["space_id"]
+        self.nodes = dump["nodes"]
+        self.by_obj_token = {node["obj_token"]: node for node in self.nodes}
+        self.children = {}
+        for node in self.nodes:
+            self.children.setdefault(node.get("parent_node_token"), []).append(node)
+
+    def route(self, method, path):
+        for route_method, pattern, name in self.routes:
+            if method == route_method and pattern.search(path):
+                return name
+        return "*"
+
+    def recordable(self, route):
+        return route != "auth"
+
+    def _node(self, node):
+        return {
+            "space_id": self.space_id,
+            "node_token": node["node_token"],
+            "obj_token": node["obj_token"],
+            "obj_type": node["obj_type"],
+            "parent_node_token": node.get("parent_node_token") or "",
+            "node_type": "origin",
+            "title": node["title"],
+            "has_child": node["node_token"] in self.children,
+            "obj_edit_time": node["obj_edit_time"],
+        }
+
+    def synthesize(self, route, method, path, query, payload):
+        parts = path.split("/")
+        if route == "auth":
+            return Reply.json({"code": 0, "msg": "ok", "tenant_access_token": "t-bench", "app_access_token": "a-bench",
+                               "expire": 7200})
+        if route == "wiki_nodes":
+            parent = query.get("parent_node_token", [None])[0]
+            page_size = int(query.get("page_size", ["50"])[0])
+            start = int(query.get("page_token", ["0"])[0])
+            children = self.children.get(parent, [])
+            page = children[start:start + page_size]
+            has_more = start + page_size < len(children)
+            return _ok({"items": [self._node(node) for node in page], "has_more": has_more,
+                        "page_token": str(start + page_size) if has_more else ""})
+        if route == "drive_meta":
+            docs = (payload or {}).get("request_docs") or []
+            return _ok({"metas": [{"doc_token": doc["doc_token"], "doc_type": doc["doc_type"],
+                                   "title": self.by_obj_token.get(doc["doc_token"], {}).get("title", ""),
+                                   "url": f"https://bench.feishu.cn/{doc['doc_type']}/{doc['doc_token']}"}
+                                  for doc in docs], "failed_list": []})
+        if route == "docx":
+            node = self.by_obj_token.get(parts[-2])
+            if node is None:
+                return Reply.json({"code": 1770002, "msg": "not found"}, status=404)
+            return _ok({"content": node["content"]})
+        if route == "sheets":
+            node = self.by_obj_token.get(parts[-3])
+            if node is None:
+                return Reply.json({"code": 1310214, "msg": "not found"}, status=404)
+            return _ok({"sheets": [{"sheet_id": sheet["sheet_id"], "title": sheet["title"], "index": position,
+                                    "grid_properties": {"frozen_row_count": 0, "frozen_column_count": 0,
+                                                        "row_count": len(sheet["rows"]),
+                                                        "column_count": max((len(row) for row in sheet["rows"]), default=0)}}
+                                   for position, sheet in enumerate(node["sheets"])]})
+        if route == "sheet_values":
+            token, value_range = parts[-3], parts[-1]
+            node = self.by_obj_token.get(token)
+            sheet_id, _, cells = value_range.partition("!")
+            sheet = next((sheet for sheet in (node or {}).get("sheets", []) if sheet["sheet_id"] == sheet_id), None)
+            if sheet is None:
+                return Reply.json({"code": 90215, "msg": "not found"}, status=404)
+            rows = sheet["rows"]
+            match = re.match(r"([A-Z]+)(\d+):([A-Z]+)(\d+)$", cells)
+            if match:
+                first_column, first_row, last_column, last_row = match.groups()
+                rows = [row[_column_number(first_column) - 1:_column_number(last_column)]
+                        for row in rows[int(first_row) - 1:int(last_row)]]
+            return _ok({"revision": 1, "spreadsheetToken": token,
+                        "valueRange": {"majorDimension": "ROWS", "range": value_range, "revision": 1, "values": rows}})
+        return Reply.json({"code": 404, "msg": f"no stub for {method} {path}"}, status=404)
+
+
+def stub_embedding(text, dim=stub_embedding_dim):
+    """Deterministic unit vector from hashed words and CJK bigrams; texts sharing terms land close together."""
+    vector = [0.0] * dim
+    text = (text or "").lower()
+    features = _WORD.findall(text)
+    for run in _CJK.findall(text):
+        features.extend(run[i:i + 2] for i in range(max(1, len(run) - 1)))
+    for feature in features or [""]:
+        digest = hashlib.md5(feature.encode("utf-8")).digest()
+        vector[int.from_bytes(digest[:4], "little") % dim] += 1.0 if digest[4] & 1 else -1.0
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+
+def _pack(vector):
+    return base64.b64encode(struct.pack(f"<{len(vector)}f", *vector)).decode("ascii")
+
+
+def _unpack(data):
+    raw = base64.b64decode(data)
+    return list(struct.unpack(f"<{len(raw) // 4}f", raw))
+
+
+def _extract(text, start, end):
+    begin = text.find(start)
+    if begin < 0:
+        return None
+    begin += len(start)
+    finish = text.find(end, begin)
+    return text[begin:finish if finish >= 0 else None].strip()
+
+
+def stub_answer(messages, answer_chars=stub_answer_chars):
+    """Deterministic completion for the prompts the app sends (router selection, condense, QA)."""
+    prompt = (messages[-1].get("content") or "") if messages else ""
+    if isinstance(prompt, list):
+        prompt = " ".join(part.get("text", "") for part in prompt if isinstance(part, dict))
+    lowered = prompt.lower()
+    if "return the choice" in lowered or "return the top choices" in lowered:
+        # 路由固定选第一个工具 (文档检索), SQL 表格引擎需要真模型写 SQL
+        return '[{"choice": 1, "reason": "benchmark stub routes to document search"}]'
+    follow_up = _extract(prompt, "<Follow Up Message>", "<Standalone question>")
+    if follow_up is not None:
+        return follow_up
+    context = _extract(prompt, "---------------------", "---------------------")
+    question = _extract(prompt, "Query:", "Answer:") or prompt[-200:]
+    answer = " ".join((context or prompt).split())[:answer_chars]
+    return f"{question.strip()} -> {answer}"
+
+
+class OpenAIStub(StubServer):
+    """OpenAI-compatible /embeddings and /chat/completions (streaming and not).
+
+    Embeddings are recorded and replayed per input text rather than per
+    request, because the scheduler packs texts into batches differently from
+    run to run.
+    """
+
+    def __init__(self, dim=stub_embedding_dim, answer_chars=stub_answer_chars, **kwargs):
+        super().__init__(**kwargs)
+        self.dim = dim
+        self.answer_chars = answer_chars
+
+    def route(self, method, path):
+        if path.endswith("/embeddings"):
+            return "embeddings"
+        if path.endswith("/chat/completions"):
+            return "chat"
+        return "*"
+
+    def handle(self, method, path, headers, body):
+        if self.route(method, urlsplit(path).path) != "embeddings":
+            return super().handle(method, path, headers, body)
+        payload = json.loads(body)
+        inputs = payload["input"] if isinstance(payload["input"], list) else [payload["input"]]
+        model = payload.get("model", "")
+        keys = [Cassette.key("embedding", model, text) for text in inputs]
+        if self.record:
+            reply = self.forward(method, path, headers, body)
+            if reply.status == 200:
+                for item in json.loads(reply.body)["data"]:
+                    vector = item["embedding"]
+                    self.cassette.put(keys[item["index"]], {"vector": vector if isinstance(vector, str) else _pack(vector)})
+            self.count("embeddings", "upstream")
+            return reply
+        vectors = []
+        for text, key in zip(inputs, keys):
+            entry = self.cassette.get(key)
+            if entry is not None:
+                vectors.append(_unpack(entry["vector"]))
+                self.count("embeddings", "cassette")
+            else:
+                vectors.append(stub_embedding(text, self.dim))
+                self.count("embeddings", "synthetic")
+        time.sleep(self.latency.get("embeddings", self.latency.get("*", 0.0)))
+        as_base64 = payload.get("encoding_format") == "base64"
+        tokens = sum(len(str(text)) for text in inputs) // 4
+        return Reply.json({
+            "object": "list",
+            "model": model,
+            "data": [{"object": "embedding", "index": i, "embedding": _pack(vector) if as_base64 else vector}
+                     for i, vector in enumerate(vectors)],
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+    def synthesize(self, route, method, path, query, payload):
+        if route != "chat":
+            return super().synthesize(route, method, path, query, payload)
+        messages = payload.get("messages") or []
+        answer = stub_answer(messages, self.answer_chars)
+        model = payload.get("model", "stub")
+        created = int(time.time())
+        prompt_tokens = sum(len(str(message.get("content") or "")) for message in messages) // 4
+        if not payload.get("stream"):
+            return Reply.json({
+                "id": "chatcmpl-bench", "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(answer) // 4,
+                          "total_tokens": prompt_tokens + len(answer) // 4},
+            })
+
+        def event(delta, finish_reason=None):
+            chunk = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": created, "model": model,
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            return b"data: " + json.dumps(chunk, ensure_ascii=False).encode("utf-8") + b"\n\n"
+
+        events = [event({"role": "assistant", "content": ""})]
+        events.extend(event({"content": piece}) for piece in re.findall(r"\s*\S{1,4}", answer))
+        events.append(event({}, "stop"))
+        events.append(b"data: [DONE]\n\n")
+        return Reply(200, b"", "text/event-stream", events)
@@ -0,0 +1,322 @@
+"""End-to-end ingest and query benchmark over a fixture wiki, without network access.
+
+Feishu, the embedding API and the chat LLM are replaced by the local stubs in
+benchStubs.py; everything in between is the real pipeline: readWiki crawls,
+fetches, parses, embeds and writes chroma/SQLite/BM25 in a scratch directory,
+then conversations from the fixture are answered through RetrievalService's
+streaming chat engine by several concurrent sessions.
+
+    python benchmark.py                               # compare with bench/baseline.json
+    python benchmark.py --update-baseline             # accept the current numbers
+    python benchmark.py --scale 20 --llm-latency 0.5  # bigger wiki, slower LLM
+    python benchmark.py --record --space-id ... --app-id ... --app-secret ...
+
+``--record`` sends Feishu and OpenAI requests to the live services and saves
+the replies under bench/cassettes; later runs replay them, and fall back to
+synthetic replies for anything not recorded. The exit status is 1 when a
+metric regressed beyond ``--tolerance``.
+"""
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from benchStubs import Cassette, FeishuStub, OpenAIStub
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+bench_dir = os.path.join(repo_dir, "bench")
+fixture_path = os.path.join(bench_dir, "wiki.json")
+baseline_path = os.path.join(bench_dir, "baseline.json")
+cassette_dir = os.path.join(bench_dir, "cassettes")
+
+# 默认的模拟网络延迟 (秒), 大致按线上观察到的量级
+feishu_latency = 0.02
+embed_latency = 0.05
+llm_latency = 0.2
+token_latency = 0.002
+bench_sessions = 4
+bench_rounds = 3
+# 指标变差超过这个比例算回退
+bench_tolerance = 0.25
+bench_llm = "gpt4o"
+bench_system_prompt = "You are an expert ai infra analyst. Use your knowledge base to answer questions about ai model/hardware performance."
+
+# 指标 -> (方向, 绝对容差): 1 越大越好, -1 越小越好; 变化小于绝对容差时不算回退, 避免毫秒级抖动误报
+metric_checks = {
+    "ingest_seconds": (-1, 0.5),
+    "ingest_docs_per_second": (1, 0.0),
+    "ingest_chunks_per_second": (1, 0.0),
+    "resync_seconds": (-1, 0.1),
+    "index_size_mb": (-1, 0.5),
+    "query_p50": (-1, 0.05),
+    "query_p95": (-1, 0.05),
+    "ttft_p50": (-1, 0.05),
+    "ttft_p95": (-1, 0.05),
+    "rss_peak_mb": (-1, 50.0),
+}
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(q * len(values))) - 1)]
+
+
+def load_fixture(path=fixture_path, scale=1):
+    """The wiki dump with every node copied ``scale`` times (copies get their own tokens, titles and text)."""
+    with open(path) as f:
+        dump = json.load(f)
+    nodes = list(dump["nodes"])
+    for copy in range(1, scale):
+        suffix = f"x{copy}"
+        for node in dump["nodes"]:
+            node = dict(node, node_token=node["node_token"] + suffix, obj_token=node["obj_token"] + suffix,
+                        title=f'{node["title"]} ({copy})')
+            if node.get("parent_node_token"):
+                node["parent_node_token"] += suffix
+            if "content" in node:
+                # 内容也要不同, 否则 embedding 缓存会让副本几乎不花时间
+                node["content"] = f'{node["title"]}\n\n{node["content"]}'
+            nodes.append(node)
+    return dict(dump, nodes=nodes)
+
+
+def directory_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total
+
+
+def rss_peak_mb():
+    # Linux 上 ru_maxrss 的单位是 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def prepare_workdir(workdir, app_id, app_secret):
+    # readFeishuWiki 在 import 时读取 st.secrets, 数据文件都写在当前目录
+    os.makedirs(os.path.join(workdir, ".streamlit"), exist_ok=True)
+    with open(os.path.join(workdir, ".streamlit", "secrets.toml"), "w") as f:
+        f.write(f'feishu_app_id = "{app_id}"\nfeishu_app_secret = "{app_secret}"\n')
+    os.chdir(workdir)
+
+
+def run_ingest(space_id, app_id, app_secret, embed_base):
+    """Cold sync of the whole space, then a no-change resync; returns (metrics, index, fileToTitleAndUrl)."""
+    import lark_oapi as lark
+    import readFeishuWiki
+    from readFeishuWiki import readWiki, getEmbedModel
+
+    lark.logger.setLevel(logging.WARNING)
+    embed_model = getEmbedModel(embed_base)
+    started = time.perf_counter()
+    index, fileToTitleAndUrl = asyncio.run(readWiki(space_id, app_id, app_secret, embed_model))
+    ingest_seconds = time.perf_counter() - started
+    docs = len(readFeishuWiki.SyncManifest().entries)
+    chunks = index.vector_store.client.count()
+
+    started = time.perf_counter()
+    asyncio.run(readWiki(space_id, app_id, app_secret, embed_model, index=index))
+    resync_seconds = time.perf_counter() - started
+
+    sizes = {name: directory_size(name) for name in (readFeishuWiki.chroma_db_path, readFeishuWiki.wikiTables.path,
+                                                     readFeishuWiki.wikiKeywords.path) if os.path.exists(name)}
+    metrics = {
+        "docs": docs,
+        "chunks": chunks,
+        "ingest_seconds": ingest_seconds,
+        "ingest_docs_per_second": docs / ingest_seconds,
+        "ingest_chunks_per_second": chunks / ingest_seconds,
+        "resync_seconds": resync_seconds,
+        "index_size_mb": sum(sizes.values()) / 1024 / 1024,
+        "index_files_mb": {os.path.basename(name): round(size / 1024 / 1024, 3) for name, size in sizes.items()},
+    }
+    return metrics, index, fileToTitleAndUrl
+
+
+def run_queries(index, fileToTitleAndUrl, conversations, sessions=bench_sessions, rounds=bench_rounds):
+    """Answer every conversation ``rounds`` times from ``sessions`` concurrent sessions sharing one RetrievalService."""
+    from llama_index.core.memory import ChatMemoryBuffer
+    from readFeishuWiki import wikiTables, wikiKeywords
+    from retrievalService import RetrievalService
+    from llmRegistry import LLMRegistry, default_factories
+    from turnMetrics import TurnMetrics
+
+    registry = LLMRegistry(default_factories(bench_system_prompt))
+    llm = registry.get(bench_llm)
+    service = RetrievalService(index, fileToTitleAndUrl, wikiTables, wikiKeywords)
+    turns, errors = [], []
+    lock = threading.Lock()
+
+    def converse(questions):
+        chat_engine = service.chat_engine(ChatMemoryBuffer.from_defaults(), bench_llm, llm)
+        for question in questions:
+            turn = TurnMetrics()
+            with turn.active():
+                try:
+                    response = chat_engine.stream_chat(question)
+                    answer = ""
+                    generate_started = time.perf_counter()
+                    for token in response.response_gen:
+                        turn.token()
+                        answer += token
+                    turn.add_stage("generate", time.perf_counter() - generate_started)
+                    service.citations(response.source_nodes)
+                except Exception as e:
+                    registry.record(bench_llm, time.perf_counter() - turn.started, e)
+                    with lock:
+                        errors.append(f"{question}: {type(e).__name__}: {e}")
+                    continue
+            turn.finish(answer)
+            registry.record(bench_llm, turn.total)
+            with lock:
+                turns.append(turn)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sessions) as executor:
+        list(executor.map(converse, [questions for _ in range(rounds) for questions in conversations]))
+    elapsed = time.perf_counter() - started
+
+    totals = [turn.total for turn in turns]
+    ttfts = [turn.ttft for turn in turns if turn.ttft is not None]
+    stages = {}
+    for turn in turns:
+        for name, seconds in turn.stages.items():
+            stages.setdefault(name, []).append(seconds)
+    return {
+        "turns": len(turns),
+        "errors": len(errors),
+        "error_samples": errors[:3],
+        "turns_per_second": len(turns) / elapsed,
+        "query_p50": percentile(totals, 0.5),
+        "query_p95": percentile(totals, 0.95),
+        "ttft_p50": percentile(ttfts, 0.5),
+        "ttft_p95": percentile(ttfts, 0.95),
+        "stage_p50": {name: round(percentile(values, 0.5), 4) for name, values in sorted(stages.items())},
+    }
+
+
+def compare(metrics, baseline, tolerance=bench_tolerance):
+    """Lines describing each checked metric against the baseline, and the names of the regressed ones."""
+    lines, regressions = [], []
+    for name, (direction, slack) in metric_checks.items():
+        current, previous = metrics.get(name), baseline.get(name)
+        if current is None or previous is None:
+            continue
+        change = (current - previous) / previous if previous else 0.0
+        worse = (previous - current) * direction
+        regressed = worse > abs(previous) * tolerance and worse > slack
+        if regressed:
+            regressions.append(name)
+        lines.append(f"{name:<26}{current:>12.3f}{previous:>12.3f}{change:>+10.1%}{'  REGRESSED' if regressed else ''}")
+    return lines, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline end-to-end ingest/query benchmark.")
+    parser.add_argument("--fixture", default=fixture_path, help="Wiki dump JSON with nodes and conversations.")
+    parser.add_argument("--scale", type=int, default=1, help="Copies of the fixture wiki to ingest.")
+    parser.add_argument("--sessions", type=int, default=bench_sessions, help="Concurrent chat sessions.")
+    parser.add_argument("--rounds", type=int, default=bench_rounds, help="Times each conversation is asked.")
+    parser.add_argument("--feishu-latency", type=float, default=feishu_latency)
+    parser.add_argument("--embed-latency", type=float, default=embed_latency)
+    parser.add_argument("--llm-latency", type=float, default=llm_latency, help="Seconds before the first LLM byte.")
+    parser.add_argument("--token-latency", type=float, default=token_latency, help="Seconds between streamed chunks.")
+    parser.add_argument("--baseline", default=baseline_path)
+    parser.add_argument("--tolerance", type=float, default=bench_tolerance)
+    parser.add_argument("--update-baseline", action="store_true", help="Write this run's metrics as the new baseline.")
+    parser.add_argument("--output", default=None, help="Also write the full results as JSON here.")
+    parser.add_argument("--cassettes", default=cassette_dir, help="Directory of recorded replies.")
+    parser.add_argument("--record", action="store_true", help="Call the live services and record their replies.")
+    parser.add_argument("--feishu-upstream", default="https://open.feishu.cn")
+    parser.add_argument("--openai-upstream", default="http://vasi.chitu.ai", help="Origin of the live OpenAI-compatible API.")
+    parser.add_argument("--space-id", default=None, help="Wiki space to sync; defaults to the fixture's.")
+    parser.add_argument("--app-id", default="cli_bench")
+    parser.add_argument("--app-secret", default="bench")
+    parser.add_argument("--workdir", default=None, help="Scratch directory; a temporary one is used and removed by default.")
+    args = parser.parse_args(argv)
+
+    dump = load_fixture(args.fixture, args.scale)
+    os.makedirs(args.cassettes, exist_ok=True)
+    feishu = FeishuStub(dump, cassette=Cassette(os.path.join(args.cassettes, "feishu.jsonl")),
+                        upstream=args.feishu_upstream, record=args.record, latency=args.feishu_latency).start()
+    openai_stub = OpenAIStub(cassette=Cassette(os.path.join(args.cassettes, "openai.jsonl")),
+                             upstream=args.openai_upstream, record=args.record,
+                             latency={"embeddings": args.embed_latency, "chat": args.llm_latency},
+                             token_latency=args.token_latency).start()
+    # 必须在 import 项目模块之前设置, 飞书地址和 OpenAI 地址在 import 时读取
+    os.environ["QC_FEISHU_HOST"] = feishu.url
+    os.environ["OPENAI_API_BASE"] = openai_stub.url + "/v1"
+    if not args.record:
+        os.environ["OPENAI_API_KEY"] = "bench"
+    sys.path.insert(0, repo_dir)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="qc-bench-")
+    cwd = os.getcwd()
+    prepare_workdir(workdir, args.app_id, args.app_secret)
+    try:
+        ingest, index, fileToTitleAndUrl = run_ingest(args.space_id or dump["space_id"], args.app_id, args.app_secret,
+                                                      openai_stub.url + "/v1")
+        ingest["rss_after_ingest_mb"] = rss_peak_mb()
+        query = run_queries(index, fileToTitleAndUrl, dump["conversations"], args.sessions, args.rounds)
+    finally:
+        os.chdir(cwd)
+        feishu.stop()
+        openai_stub.stop()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    config = {name: getattr(args, name) for name in ("scale", "sessions", "rounds", "feishu_latency", "embed_latency",
+                                                     "llm_latency", "token_latency")}
+    metrics = {name: value for name, value in dict(ingest, **query).items() if isinstance(value, (int, float))}
+    metrics["rss_peak_mb"] = rss_peak_mb()
+    results = {"config": config, "metrics": metrics, "index_files_mb": ingest["index_files_mb"],
+               "stage_p50": query["stage_p50"], "error_samples": query["error_samples"],
+               "stubs": {"feishu": feishu.report(), "openai": openai_stub.report()}}
+
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+    if query["errors"]:
+        # 出错的轮次不计入延迟, 这种结果既不能当基线也不能拿来比较
+        print(f'{query["errors"]} turns failed, e.g. {query["error_samples"][0]}')
+        return 1
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"config": config, "metrics": {name: round(value, 4) for name, value in metrics.items()}},
+                      f, indent=2, ensure_ascii=False)
+            f.write("\n")
+        print(f"baseline written to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline}, run with --update-baseline to create one")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("config") != config:
+        print(f'baseline was recorded with {baseline.get("config")}, this run used {config}; numbers are not comparable')
+    lines, regressions = compare(metrics, baseline["metrics"], args.tolerance)
+    print(f"{'metric':<26}{'current':>12}{'baseline':>12}{'change':>10}")
+    print("\n".join(lines))
+    if regressions:
+        print(f"regressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,49 @@
+import json
+import hashlib
+
+# 存在每个 chunk 元数据里的文档内容哈希, 不参与 embedding 和 LLM 上下文
+DOC_HASH_KEY = "doc_hash"
+# chroma 单次 get/delete 的批大小
+chroma_batch_size = 5000
+
+
+def document_hash(doc):
+    """Hash of a document's text and metadata, i.e. everything that ends up in its vectors."""
+    metadata = {k: v for k, v in doc.metadata.items() if k != DOC_HASH_KEY}
+    payload = doc.text + json.dumps(metadata, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def stamp_document(doc):
+    doc.metadata[DOC_HASH_KEY] = document_hash(doc)
+    if DOC_HASH_KEY not in doc.excluded_embed_metadata_keys:
+        doc.excluded_embed_metadata_keys.append(DOC_HASH_KEY)
+    if DOC_HASH_KEY not in doc.excluded_llm_metadata_keys:
+        doc.excluded_llm_metadata_keys.append(DOC_HASH_KEY)
+    return doc
+
+
+def indexed_document_hashes(chroma_collection):
+    """Return (hashes, legacy_ids) for everything already in the collection.
+
+    ``hashes`` maps ref doc id -> doc hash. ``legacy_ids`` are the chunks
+    written before hashes and file paths were tracked; no re-sync of their
+    file would ever replace them, so the caller has to delete them.
+    """
+    hashes = {}
+    legacy_ids = []
+    offset = 0
+    while True:
+        result = chroma_collection.get(include=["metadatas"], limit=chroma_batch_size, offset=offset)
+        metadatas = result["metadatas"] or []
+        for node_id, metadata in zip(result["ids"], metadatas):
+            metadata = metadata or {}
+            if DOC_HASH_KEY not in metadata or "file_path" not in metadata:
+                legacy_ids.append(node_id)
+                continue
+            ref_doc_id = metadata.get("document_id")
+            if ref_doc_id is not None:
+                hashes[ref_doc_id] = metadata[DOC_HASH_KEY]
+        if len(metadatas) < chroma_batch_size:
+            return hashes, legacy_ids
+        offset += chroma_batch_size
@@ -0,0 +1,153 @@
+import time
+import sqlite3
+import hashlib
+import threading
+from array import array
+from typing import Any, List
+
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+embedding_cache_path = "./embedding_cache.sqlite"
+# 默认最多缓存的向量条数, text-embedding-3-large 每条约 12KB
+embedding_cache_max_entries = 200000
+# 超过上限时删到上限的这个比例, 之后再写入一成才需要重新计数和淘汰
+embedding_cache_evict_ratio = 0.9
+
+
+class EmbeddingCache(object):
+    """SQLite-backed embedding store keyed by (model, kind, sha256 of text), with LRU eviction."""
+
+    def __init__(self, path=embedding_cache_path, max_entries=embedding_cache_max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+        # 条数的上界估计: 覆盖写和其它进程的写入不精确, 只在超过上限时用 COUNT(*) 校正
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    @staticmethod
+    def key(model_name, kind, text):
+        return hashlib.sha256(f"{model_name}\0{kind}\0{text}".encode('utf-8')).hexdigest()
+
+    def get_many(self, keys):
+        """Return {key: embedding} for the keys that are cached, and mark them as recently used."""
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+                for key, blob in rows:
+                    found[key] = array('f', blob).tolist()
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE embeddings SET last_used=? WHERE key=?", [(now, key) for key in found])
+                self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(set(keys)) - len(found)
+        return found
+
+    def put_many(self, items):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, array('f', embedding).tobytes(), now) for key, embedding in items])
+            self._count += len(items)
+            if self._count > self.max_entries:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if count > self.max_entries:
+            keep = int(self.max_entries * embedding_cache_evict_ratio)
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                (count - keep,))
+            count = keep
+        self._count = count
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+    def report(self):
+        stats = self.stats()
+        return f"embedding cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.1%} hit rate)"
+
+
+class CachedEmbedding(BaseEmbedding):
+    """Wrap an embedding model so every text is only ever sent to the endpoint once.
+
+    Identical chunks across rebuilds, wiki pages and uploaded files share one
+    cache entry per model; only cache misses reach the wrapped model.
+    """
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _cache: EmbeddingCache = PrivateAttr()
+
+    def __init__(self, embed_model: BaseEmbedding, cache: EmbeddingCache = None, **kwargs: Any) -> None:
+        kwargs.setdefault("model_name", embed_model.model_name)
+        kwargs.setdefault("embed_batch_size", embed_model.embed_batch_size)
+        super().__init__(**kwargs)
+        self._embed_model = embed_model
+        self._cache = cache or EmbeddingCache()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def cache(self) -> EmbeddingCache:
+        return self._cache
+
+    def _split(self, kind, texts):
+        keys = [EmbeddingCache.key(self.model_name, kind, text) for text in texts]
+        found = self._cache.get_many(keys)
+        # 同一批里重复的文本只请求一次, _merge 再按 key 分发回每个位置
+        first = {}
+        for i, key in enumerate(keys):
+            if key not in found:
+                first.setdefault(key, i)
+        return keys, found, list(first.values())
+
+    def _merge(self, keys, found, missing, embeddings):
+        self._cache.put_many([(keys[i], embedding) for i, embedding in zip(missing, embeddings)])
+        found.update({keys[i]: embedding for i, embedding in zip(missing, embeddings)})
+        return [found[key] for key in keys]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        keys, found, missing = self._split("text", texts)
+        embeddings = self._embed_model.get_text_embedding_batch([texts[i] for i in missing]) if missing else []
+        return self._merge(keys, found, missing, embeddings)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        keys, found, missing = self._split("text", texts)
+        embeddings = await self._embed_model.aget_text_embedding_batch([texts[i] for i in missing]) if missing else []
+        return self._merge(keys, found, missing, embeddings)
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        keys, found, missing = self._split("query", [query])
+        embeddings = [self._embed_model.get_query_embedding(query)] if missing else []
+        return self._merge(keys, found, missing, embeddings)[0]
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        keys, found, missing = self._split("query", [query])
+        embeddings = [await self._embed_model.aget_query_embedding(query)] if missing else []
+        return self._merge(keys, found, missing, embeddings)[0]
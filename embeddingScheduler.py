@@ -0,0 +1,230 @@
+import time
+import random
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List
+
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.utils import get_tokenizer
+
+# OpenAI embedding 接口单次请求的上限是 2048 条输入 / 300k token, 这里留一些余量
+max_batch_inputs = 512
+max_batch_tokens = 100000
+max_concurrency = 4
+
+
+def is_retryable(e):
+    # 429 和 5xx 可以重试, 其它 4xx 是请求本身有问题
+    status = getattr(e, "status_code", None)
+    if status is None:
+        status = getattr(getattr(e, "response", None), "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    # 连接错误 / 超时没有状态码
+    return type(e).__name__ in ("APIConnectionError", "APITimeoutError", "ConnectionError", "Timeout", "TimeoutError")
+
+
+class AdaptiveLimit(object):
+    """Concurrency limit that halves on rate limiting and creeps back up on success."""
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.limit = maximum
+        self.in_flight = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False, succeeded=True):
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+                self._successes = 0
+            elif succeeded:
+                self._successes += 1
+                if self.limit < self.maximum and self._successes >= self.limit:
+                    self.limit += 1
+                    self._successes = 0
+            self._cond.notify_all()
+
+
+class EmbeddingStats(object):
+    def __init__(self):
+        self.chunks = 0
+        self.tokens = 0
+        self.requests = 0
+        self.retries = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, chunks, tokens, elapsed):
+        with self._lock:
+            self.chunks += chunks
+            self.tokens += tokens
+            self.requests += 1
+            self.busy_seconds += elapsed
+
+    def retry(self):
+        # 线程池里的多个批次会同时重试
+        with self._lock:
+            self.retries += 1
+
+    def report(self, elapsed):
+        rate = self.chunks / elapsed if elapsed else 0.0
+        return (f"embedded {self.chunks} chunks ({self.tokens} tokens) in {self.requests} requests, "
+                f"{self.retries} retries, {rate:.1f} chunks/s")
+
+
+class BatchedEmbedding(BaseEmbedding):
+    """Schedule embedding requests for a wrapped model.
+
+    Texts are packed into requests by token count rather than a fixed batch
+    size, up to ``max_concurrency`` requests run at once, and 429/5xx
+    responses are retried with jittered exponential backoff while the
+    concurrency limit is halved until the endpoint recovers.
+    """
+
+    max_batch_inputs: int = max_batch_inputs
+    max_batch_tokens: int = max_batch_tokens
+    max_concurrency: int = max_concurrency
+    max_retries: int = 6
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _limit: AdaptiveLimit = PrivateAttr()
+    _stats: EmbeddingStats = PrivateAttr()
+    _tokenizer: Any = PrivateAttr()
+
+    def __init__(self, embed_model: BaseEmbedding, **kwargs: Any) -> None:
+        kwargs.setdefault("model_name", embed_model.model_name)
+        # 外层一次把尽可能多的文本交给调度器, 由调度器按 token 数切批
+        kwargs.setdefault("embed_batch_size", 2048)
+        super().__init__(**kwargs)
+        self._embed_model = embed_model
+        self._limit = AdaptiveLimit(self.max_concurrency)
+        self._stats = EmbeddingStats()
+        self._tokenizer = get_tokenizer()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "BatchedEmbedding"
+
+    @property
+    def stats(self) -> EmbeddingStats:
+        return self._stats
+
+    def pack(self, texts):
+        """Split texts into [(indices, token_count)] batches under the input and token limits."""
+        batches = []
+        indices, tokens = [], 0
+        for i, text in enumerate(texts):
+            n = len(self._tokenizer(text))
+            if indices and (len(indices) >= self.max_batch_inputs or tokens + n > self.max_batch_tokens):
+                batches.append((indices, tokens))
+                indices, tokens = [], 0
+            indices.append(i)
+            tokens += n
+        if indices:
+            batches.append((indices, tokens))
+        return batches
+
+    def _backoff(self, attempt):
+        self._stats.retry()
+        return min(60.0, 2 ** attempt) * (0.5 + random.random() / 2)
+
+    def _embed_batch(self, texts, tokens):
+        for attempt in range(self.max_retries + 1):
+            self._limit.acquire()
+            started = time.perf_counter()
+            try:
+                # 直接调用单次请求的接口, 避免被内层模型按 embed_batch_size 再切一次
+                embeddings = self._embed_model._get_text_embeddings(texts)
+            except Exception as e:
+                # 只有 429/5xx 才收紧并发, 400/401 或本地错误不是限流
+                retryable = is_retryable(e)
+                self._limit.release(throttled=retryable, succeeded=False)
+                if attempt == self.max_retries or not retryable:
+                    raise
+                time.sleep(self._backoff(attempt))
+                continue
+            except BaseException:
+                # 被中断时也要归还名额
+                self._limit.release(succeeded=False)
+                raise
+            self._limit.release()
+            self._stats.record(len(texts), tokens, time.perf_counter() - started)
+            return embeddings
+
+    async def _aacquire(self):
+        # 线程里的 acquire 取消不掉, 任务被取消时等它拿到名额后立即归还
+        acquiring = asyncio.ensure_future(asyncio.to_thread(self._limit.acquire))
+        try:
+            await asyncio.shield(acquiring)
+        except asyncio.CancelledError:
+            acquiring.add_done_callback(
+                lambda f: f.cancelled() or f.exception() or self._limit.release(succeeded=False))
+            raise
+
+    async def _aembed_batch(self, texts, tokens):
+        for attempt in range(self.max_retries + 1):
+            await self._aacquire()
+            started = time.perf_counter()
+            try:
+                embeddings = await self._embed_model._aget_text_embeddings(texts)
+            except Exception as e:
+                retryable = is_retryable(e)
+                self._limit.release(throttled=retryable, succeeded=False)
+                if attempt == self.max_retries or not retryable:
+                    raise
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+            except BaseException:
+                # CancelledError 不是 Exception, 任务被取消时也要归还名额
+                self._limit.release(succeeded=False)
+                raise
+            self._limit.release()
+            self._stats.record(len(texts), tokens, time.perf_counter() - started)
+            return embeddings
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        started = time.perf_counter()
+        batches = self.pack(texts)
+        results = [None] * len(texts)
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            futures = [(indices, executor.submit(self._embed_batch, [texts[i] for i in indices], tokens))
+                       for indices, tokens in batches]
+            for indices, future in futures:
+                for i, embedding in zip(indices, future.result()):
+                    results[i] = embedding
+        if len(batches) > 1:
+            print(self._stats.report(time.perf_counter() - started))
+        return results
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        batches = self.pack(texts)
+        embeddings = await asyncio.gather(*[
+            self._aembed_batch([texts[i] for i in indices], tokens) for indices, tokens in batches])
+        results = [None] * len(texts)
+        for (indices, _), batch in zip(batches, embeddings):
+            for i, embedding in zip(indices, batch):
+                results[i] = embedding
+        return results
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self._embed_model.get_query_embedding(query)
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        return await self._embed_model.aget_query_embedding(query)
@@ -0,0 +1,203 @@
+"""Evaluation runner for question/answer accuracy runs.
+
+Cases are answered concurrently (bounded per backend), every finished case
+is appended to a JSONL checkpoint right away, and a rerun with the same
+checkpoint skips what is already done:
+
+    runner = EvalRunner(ask, "eval/gpt4o.jsonl", concurrency=4)
+    summary = runner.run(cases)
+
+``ask(case)`` returns the answer text, or {"answer", "prompt_tokens",
+"completion_tokens"}. ``mock_backend`` answers offline for CI.
+"""
+import os
+import re
+import json
+import hashlib
+import time
+import math
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+eval_concurrency = 4
+# 数值比较的相对误差, 回答里四舍五入到两位小数也算对
+eval_rel_tol = 0.01
+eval_abs_tol = 1e-6
+
+# 紧跟在字母/数字后面的数字是标识符的一部分 (llama-7b, a100, Llama3), 不是数值, 连字符也不是负号
+_NUMBER = re.compile(r"(?<![A-Za-z0-9_.\-])-?\d+(?:,\d{3})*(?:\.\d+)?(?:[eE][-+]?\d+)?")
+
+
+def extract_numbers(text):
+    numbers = []
+    for match in _NUMBER.finditer(text or ""):
+        try:
+            numbers.append(float(match.group().replace(",", "")))
+        except ValueError:
+            continue
+    return numbers
+
+
+def numeric_match(expected, numbers, rel_tol=eval_rel_tol, abs_tol=eval_abs_tol):
+    return any(math.isclose(value, expected, rel_tol=rel_tol, abs_tol=abs_tol) for value in numbers)
+
+
+def score_answer(expected, answer, rel_tol=eval_rel_tol, question=None):
+    """(hits, misses) of the ``expected`` numbers found in ``answer`` within tolerance.
+
+    Expected values are matched in order and each answer number counts for at
+    most one of them. Numbers the answer echoes from ``question`` (input
+    lengths, "Batch=64") are dropped first unless they are expected values.
+    """
+    expected = [float(value) for value in expected]
+    numbers = extract_numbers(answer)
+    if question:
+        echoed = [value for value in extract_numbers(question) if not numeric_match(value, expected, rel_tol)]
+        numbers = [number for number in numbers if not numeric_match(number, echoed, 0.0)]
+    # 最长公共子序列: 按顺序一一对应时最多能对上几个
+    matched = [0] * (len(numbers) + 1)
+    for value in expected:
+        previous = matched[:]
+        for j, number in enumerate(numbers):
+            if numeric_match(value, [number], rel_tol):
+                matched[j + 1] = max(matched[j + 1], previous[j] + 1)
+            matched[j + 1] = max(matched[j + 1], matched[j], previous[j + 1])
+    hits = matched[-1]
+    return hits, len(expected) - hits
+
+
+def case_id(question, expected):
+    """Stable id for a case, so an edited sheet never reuses a checkpointed answer for a different question."""
+    return hashlib.sha1(json.dumps([question, [float(value) for value in expected]]).encode("utf-8")).hexdigest()[:16]
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(q * len(values))) - 1)]
+
+
+class EvalRunner(object):
+    """Answer cases with ``ask`` in parallel, checkpointing each result to JSONL.
+
+    A case is a dict with a unique ``id`` (see ``case_id``), a ``question`` and
+    the ``expected`` numbers. Results that ended in an error, or whose
+    question or expected numbers no longer match the case, are not treated
+    as done, so a resumed run answers them again.
+    """
+
+    def __init__(self, ask, checkpoint_path, concurrency=eval_concurrency, rel_tol=eval_rel_tol):
+        self.ask = ask
+        self.checkpoint_path = checkpoint_path
+        self.concurrency = concurrency
+        self.rel_tol = rel_tol
+        self._lock = threading.Lock()
+
+    def load_checkpoint(self):
+        results = {}
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as f:
+                for line in f:
+                    try:
+                        result = json.loads(line)
+                    except ValueError:
+                        # 上次中断时写了一半的行
+                        continue
+                    if "error" not in result:
+                        results[result["id"]] = result
+        return results
+
+    def _write(self, result):
+        with self._lock, open(self.checkpoint_path, "a") as f:
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _run_case(self, case):
+        started = time.perf_counter()
+        result = {"id": case["id"], "question": case["question"], "expected": case["expected"]}
+        try:
+            reply = self.ask(case)
+        except Exception as e:
+            result.update(error=f"{type(e).__name__}: {e}", latency=time.perf_counter() - started)
+            return result
+        if not isinstance(reply, dict):
+            reply = {"answer": reply}
+        hits, misses = score_answer(case["expected"], reply.get("answer"), self.rel_tol, case["question"])
+        result.update(
+            answer=reply.get("answer"),
+            hits=hits,
+            misses=misses,
+            latency=time.perf_counter() - started,
+            prompt_tokens=reply.get("prompt_tokens"),
+            completion_tokens=reply.get("completion_tokens"),
+        )
+        return result
+
+    def run(self, cases, progress=None):
+        """Answer every case not in the checkpoint yet; returns ``summarize`` of all results."""
+        if os.path.dirname(self.checkpoint_path):
+            os.makedirs(os.path.dirname(self.checkpoint_path), exist_ok=True)
+        checkpointed = self.load_checkpoint()
+        # id 相同但题目或期望值变了 (例如 --checkpoint 指向别的文件的结果) 的旧结果不能复用
+        results = {case["id"]: checkpointed[case["id"]] for case in cases
+                   if case["id"] in checkpointed
+                   and checkpointed[case["id"]]["question"] == case["question"]
+                   and checkpointed[case["id"]]["expected"] == case["expected"]}
+        pending = [case for case in cases if case["id"] not in results]
+        if results:
+            print(f"resuming: {len(results)} cases done, {len(pending)} to go")
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [executor.submit(self._run_case, case) for case in pending]
+            for future in as_completed(futures):
+                result = future.result()
+                self._write(result)
+                if "error" in result:
+                    print(f'case {result["id"]} failed: {result["error"]}')
+                else:
+                    results[result["id"]] = result
+                if progress is not None:
+                    progress.update(1)
+        return summarize([results[case["id"]] for case in cases if case["id"] in results], len(cases))
+
+
+def summarize(results, total=None):
+    hits = sum(result["hits"] for result in results)
+    misses = sum(result["misses"] for result in results)
+    latencies = [result["latency"] for result in results]
+    return {
+        "cases": len(results),
+        "unfinished": (total - len(results)) if total is not None else 0,
+        "hits": hits,
+        "misses": misses,
+        "accuracy": hits / (hits + misses) if hits + misses else 0.0,
+        "latency_p50": _percentile(latencies, 0.5),
+        "latency_p95": _percentile(latencies, 0.95),
+        "prompt_tokens": sum(result.get("prompt_tokens") or 0 for result in results),
+        "completion_tokens": sum(result.get("completion_tokens") or 0 for result in results),
+    }
+
+
+def mock_backend(latency=0.0, miss_rate=0.0, seed=0):
+    """Offline stand-in for an LLM backend: answers with the expected numbers rounded to two decimals.
+
+    ``miss_rate`` of the numbers are replaced with wrong ones so scoring can be
+    exercised; token counts are rough character-based estimates.
+    """
+    rng = random.Random(seed)
+    rng_lock = threading.Lock()
+
+    def ask(case):
+        if latency:
+            time.sleep(latency)
+        values = []
+        for value in case["expected"]:
+            with rng_lock:
+                wrong = rng.random() < miss_rate
+            values.append(round(float(value) * (3.0 if wrong else 1.0) + (1.0 if wrong else 0.0), 2))
+        answer = ", ".join(str(value) for value in values)
+        return {"answer": answer, "prompt_tokens": len(case["question"]) // 2, "completion_tokens": len(answer) // 2}
+
+    return ask
@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+import requests
+
+# 压测/离线环境下指向本地的飞书替身, 例如 http://127.0.0.1:8901
+FEISHU_HOST = os.environ.get("QC_FEISHU_HOST", "https://open.feishu.cn").rstrip("/")
+TENANT_ACCESS_TOKEN_URI = "/open-apis/auth/v3/tenant_access_token/internal"
+APP_ACCESS_TOKEN_URI = "/open-apis/auth/v3/app_access_token/internal"
+REFRESH_USER_ACCESS_TOKEN_URI = "/open-apis/authen/v1/refresh_access_token"
+
+# 所有模块共用的 token 缓存文件 (明文, 0600), 进程重启后复用未过期的 token;
+# 默认只缓存在内存里, 需要时指向代码目录之外的路径
+token_cache_path = os.environ.get("QC_FEISHU_TOKEN_CACHE") or None
+
+# token 有效期 2 小时, 剩余不足 30 分钟时飞书才会签发新 token, 所以提前量要小于 30 分钟
+refresh_margin = 10 * 60
+
+
+class FeishuException(Exception):
+    # 处理并展示飞书侧返回的错误码和错误信息
+    def __init__(self, code=0, msg=None):
+        self.code = code
+        self.msg = msg
+
+    def __str__(self) -> str:
+        return "{}:{}".format(self.code, self.msg)
+
+    __repr__ = __str__
+
+
+class TokenProvider(object):
+    """Tenant, app and user access tokens for one app, cached until shortly before expiry.
+
+    Tokens live in memory and, if ``cache_path`` is set, in a 0600 JSON file so
+    restarts reuse them. Refreshes are serialised by a lock, so concurrent
+    threads or coroutines trigger at most one token request.
+    """
+
+    def __init__(self, app_id, app_secret, feishu_host=FEISHU_HOST, cache_path=None, refresh_margin=refresh_margin):
+        self.app_id = app_id
+        self.app_secret = app_secret
+        self.feishu_host = feishu_host
+        self.cache_path = cache_path
+        self.refresh_margin = refresh_margin
+        # kind -> {"token", "expires_at", 以及 user token 的 "refresh_token"}
+        self._tokens = {}
+        self._lock = threading.RLock()
+        self._load()
+
+    def _load(self):
+        if self.cache_path and os.path.exists(self.cache_path):
+            try:
+                with open(self.cache_path, 'r') as f:
+                    cached = json.load(f)
+                if cached.get("app_id") == self.app_id:
+                    self._tokens = cached.get("tokens", {})
+            except (OSError, ValueError) as e:
+                logging.warning(f"Failed to load token cache {self.cache_path}: {e}")
+
+    def _save(self):
+        if not self.cache_path:
+            return
+        tmp_path = self.cache_path + ".tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({"app_id": self.app_id, "tokens": self._tokens}, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def _cached(self, kind):
+        entry = self._tokens.get(kind)
+        if entry and entry["expires_at"] - self.refresh_margin > time.time():
+            return entry["token"]
+        return None
+
+    def _post(self, uri, body, headers=None):
+        response = requests.post(self.feishu_host + uri, json=body, headers=headers, timeout=10)
+        response.raise_for_status()
+        response_dict = response.json()
+        code = response_dict.get("code", -1)
+        if code != 0:
+            logging.error(response_dict)
+            raise FeishuException(code=code, msg=response_dict.get("msg"))
+        return response_dict
+
+    def _store(self, kind, token, expire, **extra):
+        self._tokens[kind] = dict(extra, token=token, expires_at=time.time() + expire)
+        self._save()
+        return token
+
+    def get(self, kind="tenant"):
+        """Return a valid token of ``kind`` ("tenant", "app" or "user:<key>"), refreshing if needed."""
+        token = self._cached(kind)
+        if token:
+            return token
+        with self._lock:
+            # 其它线程可能已经刷新过了
+            token = self._cached(kind)
+            if token:
+                return token
+            if kind == "tenant":
+                result = self._post(TENANT_ACCESS_TOKEN_URI, {"app_id": self.app_id, "app_secret": self.app_secret})
+                return self._store(kind, result["tenant_access_token"], result["expire"])
+            if kind == "app":
+                result = self._post(APP_ACCESS_TOKEN_URI, {"app_id": self.app_id, "app_secret": self.app_secret})
+                return self._store(kind, result["app_access_token"], result["expire"])
+            if kind.startswith("user:"):
+                return self._refresh_user_token(kind)
+            raise ValueError(f"unknown token kind {kind}")
+
+    async def aget(self, kind="tenant"):
+        """Async variant of ``get``; a refresh runs in a thread so the event loop never blocks."""
+        token = self._cached(kind)
+        if token:
+            return token
+        return await asyncio.to_thread(self.get, kind)
+
+    def tenant_access_token(self):
+        return self.get("tenant")
+
+    def app_access_token(self):
+        return self.get("app")
+
+    def set_user_token(self, access_token, expires_in, refresh_token=None, user_key="default"):
+        with self._lock:
+            return self._store(f"user:{user_key}", access_token, expires_in, refresh_token=refresh_token)
+
+    def user_access_token(self, user_key="default"):
+        return self.get(f"user:{user_key}")
+
+    def _refresh_user_token(self, kind):
+        entry = self._tokens.get(kind)
+        if not entry or not entry.get("refresh_token"):
+            raise FeishuException(msg=f"no refreshable user token for {kind}")
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": "Bearer " + self.app_access_token(),
+        }
+        data = self._post(REFRESH_USER_ACCESS_TOKEN_URI,
+                          {"grant_type": "refresh_token", "refresh_token": entry["refresh_token"]},
+                          headers=headers)["data"]
+        return self._store(kind, data["access_token"], data["expires_in"], refresh_token=data["refresh_token"])
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+def get_token_provider(app_id, app_secret, **kwargs):
+    """Process-wide TokenProvider for ``app_id``, so every module shares one token cache."""
+    kwargs.setdefault("cache_path", token_cache_path)
+    with _providers_lock:
+        if app_id not in _providers:
+            _providers[app_id] = TokenProvider(app_id, app_secret, **kwargs)
+            return _providers[app_id]
+        provider = _providers[app_id]
+        # 先创建的调用方决定了配置, 后来的参数不一致时不能悄悄忽略
+        conflicts = {name: value for name, value in kwargs.items() if getattr(provider, name, value) != value}
+        if conflicts:
+            logging.warning(f"Token provider for {app_id} already exists, ignoring conflicting settings {conflicts}")
+        return provider
+
+
+async def resolve_token(token):
+    # 调用方可以传固定的 token 字符串, 也可以传 TokenProvider 让长任务中途自动续期
+    if isinstance(token, TokenProvider):
+        return await token.aget("tenant")
+    return token
@@ -0,0 +1,73 @@
+"""Background wiki indexer.
+
+Syncs the Feishu wiki into the local index on a schedule and publishes every
+changed result as a versioned snapshot under ``snapshots/``. The Streamlit app
+only opens the latest snapshot, so ingest runs once per deployment instead of
+in every app process:
+
+    python indexer.py --once
+    python indexer.py --interval 900 --snapshot-dir /shared/snapshots
+"""
+import os
+import time
+import asyncio
+import argparse
+import streamlit as st
+
+from readFeishuWiki import readWiki, getEmbedModel, chroma_db_path, wikiTables, wikiKeywords, wikiParser
+from wikiSync import SyncManifest
+from snapshots import publish_snapshot, latest_version, snapshot_root, snapshot_keep
+
+openai_api_base = "http://vasi.chitu.ai/v1"
+
+
+def sync_once(space_id, app_id, app_secret, embed_model, root=snapshot_root, keep=snapshot_keep, force=False):
+    """Run one wiki sync and publish a snapshot if anything changed; returns the new version or None."""
+    before = SyncManifest().entries
+    started = time.perf_counter()
+    _, fileToTitleAndUrl = asyncio.run(readWiki(space_id, app_id, app_secret, embed_model))
+    after = SyncManifest().entries
+    if before == after and latest_version(root) and not force:
+        print(f"Wiki unchanged, keeping snapshot {latest_version(root)}")
+        return None
+
+    version = publish_snapshot(chroma_db_path, [wikiTables.path, wikiKeywords.path], fileToTitleAndUrl, root, keep, info={
+        "documents": len(after),
+        "sync_seconds": round(time.perf_counter() - started, 2),
+    })
+    print(f"Published snapshot {version} ({len(after)} documents)")
+    return version
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sync the Feishu wiki and publish index snapshots.")
+    parser.add_argument("--once", action="store_true", help="run a single sync and exit")
+    parser.add_argument("--interval", type=float, default=900, help="seconds between syncs")
+    parser.add_argument("--snapshot-dir", default=snapshot_root)
+    parser.add_argument("--keep", type=int, default=snapshot_keep, help="number of snapshots to keep")
+    parser.add_argument("--force", action="store_true", help="publish even if nothing changed")
+    parser.add_argument("--space-id", default=None)
+    parser.add_argument("--api-base", default=openai_api_base)
+    args = parser.parse_args()
+
+    os.environ.setdefault("OPENAI_API_KEY", st.secrets.openai_key)
+    space_id = args.space_id or st.secrets.feishu_space_id
+    embed_model = getEmbedModel(args.api_base)
+
+    try:
+        while True:
+            try:
+                sync_once(space_id, st.secrets.feishu_app_id, st.secrets.feishu_app_secret, embed_model,
+                          args.snapshot_dir, args.keep, args.force)
+            except Exception as e:
+                # 一次同步失败不影响下一轮, app 继续用上一个快照
+                print(f"Wiki sync failed: {e}")
+            if args.once:
+                break
+            time.sleep(args.interval)
+    finally:
+        wikiParser.shutdown()
+
+
+if __name__ == "__main__":
+    main()
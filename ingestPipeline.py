@@ -0,0 +1,191 @@
+import os
+import time
+import asyncio
+import aiohttp
+
+from llama_index.core import Settings
+from llama_index.core.ingestion import run_transformations
+
+from deltaIndex import DOC_HASH_KEY, chroma_batch_size, stamp_document, indexed_document_hashes
+
+_STAGE_DONE = object()
+
+
+class IngestStats(object):
+    def __init__(self):
+        self.fetched = 0
+        self.parsed = 0
+        self.skipped = 0
+        self.indexed = 0
+        self.chunks = 0
+        self.started = None
+        self.first_indexed = None
+        self.finished = None
+
+    def report(self):
+        now = time.perf_counter()
+        first = f"{self.first_indexed - self.started:.2f}s" if self.first_indexed else "n/a"
+        return (f"ingested {self.indexed} documents ({self.chunks} chunks, {self.skipped} unchanged) "
+                f"from {self.fetched} fetched in {(self.finished or now) - self.started:.2f}s, "
+                f"first document queryable after {first}")
+
+
+class IngestPipeline(object):
+    """Fetch -> parse/chunk -> embed/insert, with every stage running concurrently.
+
+    Stages are connected by bounded queues so a slow embedding endpoint applies
+    backpressure to parsing and fetching instead of piling documents up in
+    memory. Chunks are inserted into ``index`` in batches as soon as they are
+    embedded, so the index is queryable while the ingest is still running.
+    ``load_file`` turns a local path into Documents with stable ids. Chunks
+    are also added to ``keyword_index`` when one is given.
+    """
+
+    def __init__(self, fetcher, index, chroma_collection, load_file, transformations=None,
+                 parse_workers=4, insert_batch_size=256, queue_size=32, keyword_index=None):
+        self.fetcher = fetcher
+        self.index = index
+        self.chroma_collection = chroma_collection
+        self.load_file = load_file
+        self.transformations = transformations or Settings.transformations
+        self.parse_workers = parse_workers
+        self.insert_batch_size = insert_batch_size
+        self.queue_size = queue_size
+        self.keyword_index = keyword_index
+        self.stats = IngestStats()
+
+    async def _fetch_stage(self, nodes, parse_queue):
+        pending = asyncio.Queue()
+        for node in nodes:
+            pending.put_nowait(node)
+
+        async def worker(session):
+            while True:
+                try:
+                    node = pending.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                node, path, fetched = await self.fetcher.fetch_node(session, node)
+                if fetched:
+                    self.stats.fetched += 1
+                    # 队列满时在这里等待, 下游处理不过来就不再继续下载
+                    await parse_queue.put((node, path))
+
+        self.fetcher.stats.started = time.perf_counter()
+        async with aiohttp.ClientSession() as session:
+            await asyncio.gather(*[worker(session) for _ in range(min(self.fetcher.workers, len(nodes)) or 1)])
+        self.fetcher.stats.finished = time.perf_counter()
+        print(self.fetcher.stats.report())
+        for _ in range(self.parse_workers):
+            await parse_queue.put(_STAGE_DONE)
+
+    def _parse(self, node, path, indexed):
+        docs = self.load_file(path)
+        for doc in docs:
+            stamp_document(doc)
+        if docs and all(indexed.get(doc.doc_id) == doc.metadata[DOC_HASH_KEY] for doc in docs):
+            return None, []
+        # 同一个文件切出来的旧 chunk (包括新版本里已经不存在的 _part_N) 先只记下 id,
+        # 新 chunk 写入成功后再删, 更新期间文档一直可以被检索到
+        stale = self.chroma_collection.get(where={"file_path": os.path.abspath(path)}, include=[])["ids"]
+        return run_transformations(docs, self.transformations), stale
+
+    def _delete_stale(self, stale, inserted):
+        inserted = {node.node_id for node in inserted}
+        stale = [node_id for node_id in stale if node_id not in inserted]
+        for i in range(0, len(stale), chroma_batch_size):
+            self.chroma_collection.delete(ids=stale[i:i + chroma_batch_size])
+        if self.keyword_index is not None and stale:
+            self.keyword_index.delete(stale)
+
+    async def _parse_stage(self, parse_queue, insert_queue, indexed):
+        while True:
+            item = await parse_queue.get()
+            if item is _STAGE_DONE:
+                return
+            node, path = item
+            try:
+                chunks, stale = await asyncio.to_thread(self._parse, node, path, indexed)
+            except Exception as e:
+                print(f'failed to parse {path}: {e}')
+                continue
+            self.stats.parsed += 1
+            if chunks is None:
+                self.stats.skipped += 1
+                await insert_queue.put((node, path, [], []))
+            else:
+                await insert_queue.put((node, path, chunks, stale))
+
+    async def _insert_stage(self, insert_queue, on_indexed):
+        batch = []
+        docs = []
+        stale = []
+
+        async def flush():
+            if batch or stale:
+                # insert_nodes 会按 embed_batch_size 批量 embedding 后写入 chroma
+                try:
+                    if batch:
+                        await asyncio.to_thread(self.index.insert_nodes, list(batch))
+                        if self.keyword_index is not None:
+                            await asyncio.to_thread(self.keyword_index.add_nodes, list(batch))
+                    await asyncio.to_thread(self._delete_stale, list(stale), list(batch))
+                except Exception as e:
+                    # 这批文档不回调 on_indexed, 旧 chunk 还在, 下次同步会重新处理
+                    print(f'failed to index {[path for _, path in docs]}: {e}')
+                    batch.clear()
+                    docs.clear()
+                    stale.clear()
+                    return
+                self.stats.chunks += len(batch)
+                if batch and self.stats.first_indexed is None:
+                    self.stats.first_indexed = time.perf_counter()
+            for node, path in docs:
+                self.stats.indexed += 1
+                if on_indexed is not None:
+                    on_indexed(node, path)
+            batch.clear()
+            docs.clear()
+            stale.clear()
+
+        while True:
+            # 上游暂时没有新数据就先写入, 让已经处理好的文档尽早可查
+            if docs and insert_queue.empty():
+                await flush()
+            item = await insert_queue.get()
+            if item is _STAGE_DONE:
+                await flush()
+                return
+            node, path, chunks, stale_ids = item
+            batch.extend(chunks)
+            stale.extend(stale_ids)
+            docs.append((node, path))
+            if len(batch) >= self.insert_batch_size:
+                await flush()
+
+    async def run(self, nodes, on_indexed=None):
+        """Ingest ``nodes``; ``on_indexed(node, path)`` is called once a document is in the index."""
+        self.stats.started = time.perf_counter()
+        indexed, legacy = await asyncio.to_thread(indexed_document_hashes, self.chroma_collection)
+        parse_queue = asyncio.Queue(maxsize=self.queue_size)
+        insert_queue = asyncio.Queue(maxsize=self.queue_size)
+
+        inserter = asyncio.create_task(self._insert_stage(insert_queue, on_indexed))
+        parsers = [asyncio.create_task(self._parse_stage(parse_queue, insert_queue, indexed))
+                   for _ in range(self.parse_workers)]
+        try:
+            await self._fetch_stage(nodes, parse_queue)
+            await asyncio.gather(*parsers)
+            await insert_queue.put(_STAGE_DONE)
+            await inserter
+        finally:
+            for task in parsers + [inserter]:
+                task.cancel()
+        if legacy:
+            # 以前的版本写入的 chunk 没有 file_path 和 doc_hash, 不会被任何文件的更新替换掉,
+            # 新 chunk 都写完后一次删掉, 否则每个文档都会被检索到两份
+            await asyncio.to_thread(self._delete_stale, legacy, [])
+            print(f"removed {len(legacy)} chunks indexed before file paths and hashes were tracked")
+        self.stats.finished = time.perf_counter()
+        print(self.stats.report())
+        return self.stats
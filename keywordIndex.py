@@ -0,0 +1,207 @@
+import os
+import re
+import math
+import sqlite3
+import threading
+from collections import Counter
+from typing import List
+
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+
+keyword_index_path = "./keywords.sqlite"
+# BM25 参数
+bm25_k1 = 1.2
+bm25_b = 0.75
+# 倒数排名融合的平滑常数, 论文里的默认值
+rrf_k = 60
+
+_CJK = r"\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
+_TOKEN = re.compile(rf"[a-z0-9]+(?:[._\-/][a-z0-9]+)*|[{_CJK}]+")
+_CJK_RUN = re.compile(rf"^[{_CJK}]+$")
+_ALNUM_PART = re.compile(r"[a-z]+|[0-9]+")
+
+
+def tokenize(text):
+    """Split text into search terms.
+
+    Latin/digit runs are kept whole ("cht830", "llama-3.1-8b") and also split
+    into their parts ("cht", "830"); Chinese runs become overlapping
+    character bigrams, which needs no dictionary and matches any substring
+    of two or more characters.
+    """
+    terms = []
+    for match in _TOKEN.finditer(text.lower()):
+        token = match.group()
+        if _CJK_RUN.match(token):
+            if len(token) == 1:
+                terms.append(token)
+            else:
+                terms.extend(token[i:i + 2] for i in range(len(token) - 1))
+            continue
+        terms.append(token)
+        parts = _ALNUM_PART.findall(token)
+        if len(parts) > 1:
+            terms.extend(parts)
+    return terms
+
+
+class KeywordIndex(object):
+    """Persistent BM25 inverted index over the same chunks that are in Chroma.
+
+    Only terms and chunk ids are stored; chunk text, metadata and embeddings
+    stay in Chroma. Chunks are grouped by ``file_path`` so a re-synced file
+    can be replaced as a whole, like in the vector store.
+    """
+
+    def __init__(self, path=keyword_index_path, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self._lock = threading.Lock()
+        if readonly:
+            # 快照里的倒排索引只读打开, 不建表也不切 WAL
+            return
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS chunks (node_id TEXT PRIMARY KEY, file_path TEXT, length INTEGER NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS chunks_file_path ON chunks (file_path)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS postings ("
+                "term TEXT NOT NULL, node_id TEXT NOT NULL, tf INTEGER NOT NULL, PRIMARY KEY (term, node_id)) WITHOUT ROWID")
+            conn.execute("CREATE INDEX IF NOT EXISTS postings_node_id ON postings (node_id)")
+
+    def _connect(self):
+        if self.readonly:
+            return sqlite3.connect(f"file:{os.path.abspath(self.path)}?mode=ro", uri=True, timeout=30)
+        return sqlite3.connect(self.path, timeout=30)
+
+    def add(self, entries):
+        """Index [(node_id, file_path, text)], replacing chunks that are already indexed."""
+        with self._lock, self._connect() as conn:
+            self._delete_ids(conn, [node_id for node_id, _, _ in entries])
+            for node_id, file_path, text in entries:
+                counts = Counter(tokenize(text))
+                conn.execute("INSERT INTO chunks (node_id, file_path, length) VALUES (?, ?, ?)",
+                             (node_id, file_path, sum(counts.values())))
+                conn.executemany("INSERT INTO postings (term, node_id, tf) VALUES (?, ?, ?)",
+                                 [(term, node_id, tf) for term, tf in counts.items()])
+
+    def add_nodes(self, nodes):
+        self.add([(node.node_id, node.metadata.get("file_path"), node.get_content()) for node in nodes])
+
+    def _delete_ids(self, conn, node_ids):
+        for i in range(0, len(node_ids), 500):
+            chunk = node_ids[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            conn.execute(f"DELETE FROM postings WHERE node_id IN ({marks})", chunk)
+            conn.execute(f"DELETE FROM chunks WHERE node_id IN ({marks})", chunk)
+
+    def delete(self, node_ids):
+        with self._lock, self._connect() as conn:
+            self._delete_ids(conn, list(node_ids))
+
+    def delete_file(self, file_path):
+        with self._lock, self._connect() as conn:
+            ids = [row[0] for row in conn.execute("SELECT node_id FROM chunks WHERE file_path=?", (file_path,))]
+            self._delete_ids(conn, ids)
+
+    def node_ids(self):
+        with self._connect() as conn:
+            return {row[0] for row in conn.execute("SELECT node_id FROM chunks")}
+
+    def sync_with_collection(self, chroma_collection, batch_size=1000):
+        """Index chunks that are in Chroma but not here (e.g. built before this index existed) and drop stale ones."""
+        indexed = self.node_ids()
+        in_chroma = set()
+        offset = 0
+        while True:
+            page = chroma_collection.get(include=[], limit=batch_size, offset=offset)
+            if not page["ids"]:
+                break
+            in_chroma.update(page["ids"])
+            offset += len(page["ids"])
+
+        stale = indexed - in_chroma
+        if stale:
+            self.delete(stale)
+        missing = list(in_chroma - indexed)
+        for i in range(0, len(missing), batch_size):
+            page = chroma_collection.get(ids=missing[i:i + batch_size], include=["documents", "metadatas"])
+            self.add([(node_id, (metadata or {}).get("file_path"), text or "")
+                      for node_id, text, metadata in zip(page["ids"], page["documents"], page["metadatas"])])
+        return len(missing), len(stale)
+
+    def search(self, query, top_k=10):
+        """Return [(node_id, bm25 score)] for the best ``top_k`` chunks."""
+        terms = Counter(tokenize(query))
+        if not terms:
+            return []
+        with self._connect() as conn:
+            total, avg_length = conn.execute("SELECT COUNT(*), AVG(length) FROM chunks").fetchone()
+            if not total:
+                return []
+            scores = Counter()
+            for term, query_tf in terms.items():
+                postings = conn.execute(
+                    "SELECT p.node_id, p.tf, c.length FROM postings p JOIN chunks c ON c.node_id = p.node_id WHERE p.term=?",
+                    (term,)).fetchall()
+                if not postings:
+                    continue
+                idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+                for node_id, tf, length in postings:
+                    norm = tf + bm25_k1 * (1 - bm25_b + bm25_b * length / (avg_length or 1))
+                    scores[node_id] += query_tf * idf * tf * (bm25_k1 + 1) / norm
+        return scores.most_common(top_k)
+
+
+class HybridRetriever(BaseRetriever):
+    """Fuse Chroma vector search with BM25 keyword search by reciprocal rank fusion.
+
+    Exact terms such as model names and SKUs ("CHT830", "JSX") that embed
+    poorly are found by the keyword side. Every returned node is scored with
+    the same ``exp(-distance)`` similarity Chroma reports, so similarity
+    cutoffs keep their meaning for keyword-only hits.
+    """
+
+    def __init__(self, index, keyword_index, similarity_top_k=3, candidate_top_k=10, **kwargs):
+        self._vector_retriever = index.as_retriever(similarity_top_k=candidate_top_k)
+        self._collection = index.vector_store._collection
+        self._embed_model = index._embed_model
+        self._keyword_index = keyword_index
+        self._similarity_top_k = similarity_top_k
+        self._candidate_top_k = candidate_top_k
+        super().__init__(**kwargs)
+
+    def _keyword_nodes(self, node_ids, query_embedding):
+        page = self._collection.get(ids=node_ids, include=["documents", "metadatas", "embeddings"])
+        nodes = {}
+        for node_id, text, metadata, embedding in zip(page["ids"], page["documents"], page["metadatas"], page["embeddings"]):
+            try:
+                node = metadata_dict_to_node(metadata)
+            except Exception as e:
+                print(f'failed to load keyword hit {node_id}: {e}')
+                continue
+            node.set_content(text)
+            distance = sum((a - b) ** 2 for a, b in zip(query_embedding, embedding))
+            nodes[node_id] = NodeWithScore(node=node, score=math.exp(-distance))
+        return nodes
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        vector_hits = self._vector_retriever.retrieve(query_bundle)
+        keyword_hits = self._keyword_index.search(query_bundle.query_str, self._candidate_top_k)
+
+        fused = Counter()
+        for rank, hit in enumerate(vector_hits):
+            fused[hit.node.node_id] += 1.0 / (rrf_k + rank + 1)
+        for rank, (node_id, _) in enumerate(keyword_hits):
+            fused[node_id] += 1.0 / (rrf_k + rank + 1)
+        top = [node_id for node_id, _ in fused.most_common(self._similarity_top_k)]
+
+        nodes = {hit.node.node_id: hit for hit in vector_hits}
+        missing = [node_id for node_id in top if node_id not in nodes]
+        if missing:
+            if query_bundle.embedding is None:
+                query_bundle.embedding = self._embed_model.get_query_embedding(query_bundle.query_str)
+            nodes.update(self._keyword_nodes(missing, query_bundle.embedding))
+        return [nodes[node_id] for node_id in top if node_id in nodes]
@@ -1,54 +1,86 @@
-import os
+import time
 import aiohttp
 import asyncio
+from feishuToken import FEISHU_HOST, resolve_token
 
 # Constants
-FEISHU_OPENAPI_ENDPOINT = "https://open.feishu.cn/open-apis/wiki/v2/spaces"
+FEISHU_OPENAPI_ENDPOINT = f"{FEISHU_HOST}/open-apis/wiki/v2/spaces"
+# 飞书频控错误码, 命中后需要退避重试
+FEISHU_RATE_LIMIT_CODE = 99991400
 
-async def get_wiki_node_list(space_id, headers, page_token=None, parent_node_token=None):
+class IncompleteCrawl(Exception):
+    """Some node pages could not be fetched; ``nodes`` is only part of the space.
+
+    Nodes missing from a partial crawl must not be treated as deleted.
+    """
+
+    def __init__(self, nodes, failures):
+        super().__init__(f"{failures} wiki node page(s) could not be fetched")
+        self.nodes = nodes
+        self.failures = failures
+
+def _node_list_url(space_id, page_token=None, parent_node_token=None):
     url = f"{FEISHU_OPENAPI_ENDPOINT}/{space_id}/nodes?page_size=50"
     if page_token:
         url += f"&page_token={page_token}"
     if parent_node_token:
         url += f"&parent_node_token={parent_node_token}"
+    return url
+
+async def get_wiki_node_list(space_id, headers, page_token=None, parent_node_token=None, session=None):
+    url = _node_list_url(space_id, page_token, parent_node_token)
+
+    if session is None:
+        async with aiohttp.ClientSession() as session:
+            return await get_wiki_node_list(space_id, headers, page_token, parent_node_token, session)
+
+    async with session.get(url, headers=headers) as response:
+        if response.status != 200:
+            print(f"Failed to fetch from Feishu: {response.status}")
+            return None
+        result_data = await response.json()
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            if response.status != 200:
-                print(f"Failed to fetch from Feishu: {response.status}")
-                return None
-            result_data = await response.json()
-    
     return result_data['data']
 
-async def get_all_wiki_nodes(space_id, tenantAccessToken):
+def _wiki_headers(tenantAccessToken):
+    return {
+        'Authorization': f"Bearer {tenantAccessToken}",
+        'Content-Type': 'application/json; charset=utf-8',
+        'User-Agent': 'feishu-pages',
+    }
+
+async def get_all_wiki_nodes(space_id, tenantAccessToken, concurrency=None, requests_per_second=20.0):
+    # concurrency 不为空时使用并发爬取模式, 否则按原来的顺序遍历
+    if concurrency:
+        crawler = WikiCrawler(space_id, tenantAccessToken, concurrency=concurrency, requests_per_second=requests_per_second)
+        nodes = [node async for node in crawler.crawl()]
+        print(crawler.stats.report())
+        if crawler.stats.failures:
+            raise IncompleteCrawl(nodes, crawler.stats.failures)
+        return nodes
+
     try:
         nodes = []
         page_token = None
         has_more = True
-        authorization = f"Bearer {tenantAccessToken}"
-        headers = {
-            'Authorization': authorization,
-            'Content-Type': 'application/json; charset=utf-8',
-            'User-Agent': 'feishu-pages',
-        }
+        headers = _wiki_headers(await resolve_token(tenantAccessToken))
 
-        while has_more and (page_token is None or page_token.strip()):
-            # Fetch top-level nodes with pagination
-            paged_result = await get_wiki_node_list(space_id, headers, page_token)
-            if paged_result:
-                nodes.extend(paged_result['items'])
-
-                for item in paged_result['items']:
-                    if item['has_child']:
-                        child_nodes = await get_wiki_child_nodes(space_id, item['node_token'], headers)
-                        nodes.extend(child_nodes)
-
-                page_token = paged_result['page_token']
-                has_more = paged_result['has_more']
-            else:
-                page_token = ""
-                has_more = False
+        async with aiohttp.ClientSession() as session:
+            while has_more and (page_token is None or page_token.strip()):
+                # Fetch top-level nodes with pagination
+                paged_result = await get_wiki_node_list(space_id, headers, page_token, session=session)
+                if paged_result:
+                    nodes.extend(paged_result['items'])
+
+                    for item in paged_result['items']:
+                        if item['has_child']:
+                            child_nodes = await get_wiki_child_nodes(space_id, item['node_token'], headers, session)
+                            nodes.extend(child_nodes)
+
+                    page_token = paged_result['page_token']
+                    has_more = paged_result['has_more']
+                else:
+                    raise IncompleteCrawl(nodes, 1)
 
         return nodes
 
@@ -62,16 +94,18 @@ async def get_all_wiki_nodes(space_id, tenantAccessToken):
         print(f"Request Exception!!!\nException Message: {ex.message},\nStack Trace: {ex.stack},\nResponse Data: {response_data}\n")
         raise
 
-async def get_wiki_child_nodes(space_id, parent_node_token, headers):
+async def get_wiki_child_nodes(space_id, parent_node_token, headers, session=None):
     child_nodes = []
     page_token = None
     has_more = True
 
     while has_more and (page_token is None or page_token.strip()):
-        paged_result = await get_wiki_node_list(space_id, headers, page_token, parent_node_token)
+        paged_result = await get_wiki_node_list(space_id, headers, page_token, parent_node_token, session)
+        if not paged_result:
+            raise IncompleteCrawl(child_nodes, 1)
         for item in paged_result['items']:
             if item['has_child']:
-                grand_child_nodes = await get_wiki_child_nodes(space_id, item['node_token'], headers)
+                grand_child_nodes = await get_wiki_child_nodes(space_id, item['node_token'], headers, session)
                 child_nodes.extend(grand_child_nodes)
             else:
                 child_nodes.append(item)
@@ -80,3 +114,180 @@ async def get_wiki_child_nodes(space_id, parent_node_token, headers):
         has_more = paged_result['has_more']
 
     return child_nodes
+
+
+class RateLimiter(object):
+    # 令牌桶限流, 保证请求速率不超过飞书的频控额度
+    def __init__(self, requests_per_second, burst=None):
+        self.rate = float(requests_per_second)
+        self.capacity = float(burst or max(1, int(requests_per_second)))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class CrawlStats(object):
+    # 爬取过程的吞吐和分页请求延迟统计, 用于调参
+    def __init__(self):
+        self.nodes = 0
+        self.pages = 0
+        self.retries = 0
+        self.failures = 0
+        self.page_latencies = []
+        self.started = None
+        self.finished = None
+
+    def start(self):
+        self.started = time.perf_counter()
+
+    def finish(self):
+        self.finished = time.perf_counter()
+
+    def record_page(self, latency):
+        self.pages += 1
+        self.page_latencies.append(latency)
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def nodes_per_sec(self):
+        elapsed = self.elapsed
+        return self.nodes / elapsed if elapsed else 0.0
+
+    def latency_percentile(self, pct):
+        if not self.page_latencies:
+            return 0.0
+        latencies = sorted(self.page_latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * pct / 100))]
+
+    def report(self):
+        return (f"crawled {self.nodes} nodes in {self.elapsed:.2f}s ({self.nodes_per_sec:.1f} nodes/s), "
+                f"{self.pages} pages, {self.retries} retries, {self.failures} failures, "
+                f"page latency p50={self.latency_percentile(50) * 1000:.0f}ms "
+                f"p95={self.latency_percentile(95) * 1000:.0f}ms")
+
+
+_CRAWL_DONE = object()
+
+class WikiCrawler(object):
+    """Walk a wiki space concurrently over one pooled aiohttp session.
+
+    Sibling subtrees are fanned out as separate tasks; ``concurrency`` bounds the
+    number of in-flight page requests and ``requests_per_second`` keeps the crawl
+    under the Feishu rate-limit budget. Every node (including ones that have
+    children) is yielded from ``crawl()`` as soon as its page arrives.
+    ``tenantAccessToken`` may be a TokenProvider so long crawls survive expiry.
+    """
+
+    def __init__(self, space_id, tenantAccessToken, concurrency=8, requests_per_second=20.0, max_retries=3, backoff=1.0):
+        self.space_id = space_id
+        self.tenantAccessToken = tenantAccessToken
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.stats = CrawlStats()
+        self._semaphore = None
+
+    async def _headers(self):
+        return _wiki_headers(await resolve_token(self.tenantAccessToken))
+
+    async def _get_page(self, session, parent_node_token=None, page_token=None):
+        url = _node_list_url(self.space_id, page_token, parent_node_token)
+
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.acquire()
+            headers = await self._headers()
+            async with self._semaphore:
+                started = time.perf_counter()
+                reset = None
+                try:
+                    async with session.get(url, headers=headers) as response:
+                        status = response.status
+                        reset = response.headers.get("x-ogw-ratelimit-reset")
+                        try:
+                            result_data = await response.json(content_type=None)
+                        except ValueError:
+                            result_data = {}
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    # 连接断开/超时按 5xx 处理
+                    print(f"Failed to fetch from Feishu: {e}")
+                    status, result_data = 599, {}
+                self.stats.record_page(time.perf_counter() - started)
+
+            result_data = result_data or {}
+            code = result_data.get("code")
+            # 频控和 5xx 都是暂时性的, 退避后重试; 其它错误重试也没用
+            if status == 429 or status >= 500 or code == FEISHU_RATE_LIMIT_CODE:
+                if attempt == self.max_retries:
+                    break
+                self.stats.retries += 1
+                delay = float(reset) if reset else self.backoff * 2 ** attempt
+                await asyncio.sleep(delay)
+                continue
+            if status != 200 or code not in (0, None):
+                print(f"Failed to fetch from Feishu: {status}, code: {code}, msg: {result_data.get('msg')}")
+                break
+            return result_data['data']
+
+        self.stats.failures += 1
+        return None
+
+    async def _walk(self, session, parent_node_token, out):
+        page_token = None
+        has_more = True
+        subtrees = []
+
+        while has_more and (page_token is None or page_token.strip()):
+            paged_result = await self._get_page(session, parent_node_token, page_token)
+            if not paged_result:
+                break
+            for item in paged_result.get('items') or []:
+                self.stats.nodes += 1
+                out.put_nowait(item)
+                if item['has_child']:
+                    subtrees.append(asyncio.create_task(self._walk(session, item['node_token'], out)))
+
+            page_token = paged_result.get('page_token')
+            has_more = paged_result.get('has_more')
+
+        if subtrees:
+            await asyncio.gather(*subtrees)
+
+    async def crawl(self):
+        out = asyncio.Queue()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+
+        async with aiohttp.ClientSession(connector=connector) as session:
+            self.stats.start()
+            walker = asyncio.create_task(self._walk(session, None, out))
+            walker.add_done_callback(lambda _: out.put_nowait(_CRAWL_DONE))
+            try:
+                while True:
+                    item = await out.get()
+                    if item is _CRAWL_DONE:
+                        break
+                    yield item
+            finally:
+                if not walker.done():
+                    walker.cancel()
+                    await asyncio.gather(walker, return_exceptions=True)
+                self.stats.finish()
+            # 子树任务抛出的异常在这里重新抛出
+            walker.result()
@@ -0,0 +1,111 @@
+import threading
+
+import httpx
+
+# 所有 OpenAI 兼容后端共用一个连接池
+http_max_connections = 32
+http_max_keepalive = 16
+http_timeout = httpx.Timeout(600.0, connect=10.0)
+local_llama_base = "http://localhost:2512/v1"
+
+
+def shared_http_client():
+    return httpx.Client(limits=httpx.Limits(max_connections=http_max_connections,
+                                            max_keepalive_connections=http_max_keepalive),
+                        timeout=http_timeout)
+
+
+def default_factories(system_prompt, http_client=None):
+    """Factories for the chat backends offered in the app, keyed by display name.
+
+    Provider modules are imported inside the factories, so only the backends
+    that are actually selected are imported and constructed.
+    """
+    http_client = http_client or shared_http_client()
+
+    def claude():
+        from llama_index.llms.anthropic import Anthropic
+        return Anthropic(model="claude-3-5-sonnet-20240620", system_prompt=system_prompt)
+
+    def openai(**kwargs):
+        from llama_index.llms.openai import OpenAI
+        return OpenAI(system_prompt=system_prompt, http_client=http_client, **kwargs)
+
+    def ollama():
+        from llama_index.llms.ollama import Ollama
+        return Ollama(model="llama2", request_timeout=60.0)
+
+    return {
+        "Claude3.5": claude,
+        "gpt4o": lambda: openai(model="gpt-4o"),
+        "gpt3.5": lambda: openai(model="gpt-3.5-turbo", temperature=0.5),
+        # 本地 vLLM 不校验 key, 但 OpenAI 客户端要求非空
+        "Llama3_8B": lambda: openai(api_base=local_llama_base, api_key="aa"),
+        "ollama": ollama,
+    }
+
+
+class BackendStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_error = None
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "avg_seconds": self.total_seconds / self.calls if self.calls else 0.0,
+            "max_seconds": self.max_seconds,
+            "last_error": self.last_error,
+        }
+
+
+class LLMRegistry(object):
+    """Lazily built LLM clients shared by every session in the process.
+
+    A client is built the first time its name is requested and reused after
+    that, so its HTTP connection pool survives Streamlit reruns. Callers
+    report each call with ``record`` to keep per-backend latency and error
+    counters.
+    """
+
+    def __init__(self, factories):
+        self._factories = dict(factories)
+        self._clients = {}
+        self._stats = {name: BackendStats() for name in self._factories}
+        self._lock = threading.Lock()
+
+    def names(self):
+        return list(self._factories)
+
+    def get(self, name):
+        with self._lock:
+            if name not in self._clients:
+                self._clients[name] = self._factories[name]()
+            return self._clients[name]
+
+    def record(self, name, seconds, error=None):
+        with self._lock:
+            stats = self._stats.setdefault(name, BackendStats())
+            stats.calls += 1
+            stats.total_seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            if error is not None:
+                stats.errors += 1
+                stats.last_error = f"{type(error).__name__}: {error}"
+
+    def stats(self):
+        """{name: {"calls", "errors", "avg_seconds", "max_seconds", "last_error", "loaded"}} per backend."""
+        with self._lock:
+            return {name: dict(stats.as_dict(), loaded=name in self._clients) for name, stats in self._stats.items()}
+
+    def report(self):
+        lines = []
+        for name, stats in self.stats().items():
+            if stats["calls"]:
+                lines.append(f'{name}: {stats["calls"]} calls, {stats["errors"]} errors, '
+                             f'avg {stats["avg_seconds"]:.2f}s, max {stats["max_seconds"]:.2f}s')
+        return "\n".join(lines) or "no llm calls yet"
@@ -1,8 +1,7 @@
 import os
+import time
 import uuid
 import random
-import asyncio
-import requests
 import lark_oapi as lark
 from lark_oapi.api.wiki.v2 import *
 from lark_oapi.api.docx.v1 import *
@@ -10,18 +9,22 @@ from lark_oapi.api.auth.v3 import *
 import streamlit as st
 import openai
 from functools import partial
-from llama_index.llms.ollama import Ollama
-from llama_index.llms.openai import OpenAI
-from llama_index.llms.anthropic import Anthropic
-from llama_index.core import Settings, SimpleDirectoryReader
-from llama_index.core.postprocessor import SimilarityPostprocessor
+from llama_index.core import Settings
 
-from readFeishuWiki import readWiki, ExcelReader
+from readFeishuWiki import startWikiIngest, openWikiSnapshot, getEmbedModel, localIndexVersion, wikiTables, wikiKeywords
+from answerCache import AnswerCache
+from snapshots import latest_version
+from uploadIndex import UploadIndexStore, archive_uploads
+from retrievalService import RetrievalService
+from llmRegistry import LLMRegistry, default_factories
+from streamRenderer import StreamRenderer
+from telemetry import TelemetryQueue
+from turnMetrics import TurnMetrics, MetricsRegistry, serve_metrics
 
 from streamlit_feedback import streamlit_feedback
 from langsmith.run_helpers import get_current_run_tree
 from langchain_core.tracers.context import tracing_v2_enabled
-from langsmith import Client, traceable
+from langsmith import traceable
 
 title = "AI assistant, powered by Qingcheng knowledge"
 st.set_page_config(page_title=title, page_icon="🦙", layout="centered", initial_sidebar_state="auto", menu_items=None)
@@ -35,7 +38,6 @@ os.environ["LANGCHAIN_ENDPOINT"] = "https://api.smith.langchain.com"
 langchain_api_key = os.environ["LANGCHAIN_API_KEY"] = st.secrets.langsmith_key
 
 langsmith_project_id = st.secrets.langsmith_project_id
-langsmith_client = Client(api_key=langchain_api_key)
 
 app_id = st.secrets.feishu_app_id
 app_secret = st.secrets.feishu_app_secret
@@ -66,7 +68,7 @@ def _submit_feedback(user_response, emoji=None, run_id=None):
     # st.toast(f"Feedback submitted: {feedback}", icon=emoji)
     messages = st.session_state.messages
     if len(messages)>1:
-        langsmith_client.create_feedback(
+        get_telemetry().create_feedback(
             run_id,
             key="user-score",
             score=0.0 if feedback=="👎" else 1.0,
@@ -75,8 +77,12 @@ def _submit_feedback(user_response, emoji=None, run_id=None):
     return user_response
 
 @st.cache_resource(show_spinner=False)
-def load_data():
-    with st.spinner(text="Loading and indexing the docs – hang tight! This should take 1-2 minutes."):
+def get_embed_model():
+    return getEmbedModel(openai_api_base)
+
+@st.cache_resource(show_spinner=False)
+def start_local_ingest():
+    with st.spinner(text="Loading the knowledge base – new and changed docs keep indexing in the background."):
         app_id = st.secrets.feishu_app_id
         app_secret = st.secrets.feishu_app_secret
         # recursively read wiki and write each file into the machine
@@ -86,21 +92,57 @@ def load_data():
         #     model="jina-embeddings-v2-base-en",
         #     embed_batch_size=16,
         # )
-        from llama_index.embeddings.openai import OpenAIEmbedding
-        embed_model = OpenAIEmbedding(model="text-embedding-3-large", api_base=openai_api_base)
+        embed_model = get_embed_model()
         # from llama_index.core import VectorStoreIndex
         # index = VectorStoreIndex.from_documents([], embed_model=embed_model)
-        index, fileToTitleAndUrl = asyncio.run(readWiki(space_id, app_id, app_secret, embed_model))
+        # 后台线程增量同步 wiki, 已经入库的文档马上就可以检索
+        index, fileToTitleAndUrl = startWikiIngest(space_id, app_id, app_secret, embed_model)
         
         return index, fileToTitleAndUrl 
-   
 
-llm_map = {"Claude3.5": Anthropic(model="claude-3-5-sonnet-20240620", system_prompt=prompt), 
-           "gpt4o": OpenAI(model="gpt-4o", system_prompt=prompt),
-           "gpt3.5": OpenAI(model="gpt-3.5-turbo", temperature=0.5, system_prompt=prompt),
-           "Llama3_8B": OpenAI(base_url="http://localhost:2512/v1", system_prompt=prompt),
-           "ollama": Ollama(model="llama2", request_timeout=60.0)
-}
+@st.cache_resource(show_spinner=False)
+def get_telemetry():
+    # run 更新和反馈在后台线程批量上报, 不占用户这一轮的时间
+    return TelemetryQueue(langchain_api_key)
+
+@st.cache_resource(show_spinner=False)
+def get_metrics():
+    metrics = MetricsRegistry()
+    serve_metrics(lambda: metrics.render(get_llm_registry().stats()))
+    return metrics
+
+@st.cache_resource(show_spinner=False)
+def get_answer_cache():
+    return AnswerCache(get_embed_model())
+
+def answer_scope():
+    # 同一个知识库版本 + 同一个模型的回答才能复用
+    # 没有快照时用进程内同步的 manifest 版本; 同步还在进行时索引一直在变, 返回 None 表示不用缓存
+    version = st.session_state.get("snapshot_version") or localIndexVersion()
+    return f'{version}:{st.session_state.llm}' if version else None
+
+def chat_memory():
+    # 对话记忆单独保存, 切换快照重建 chat_engine 时对话不会丢
+    if "chat_memory" not in st.session_state.keys():
+        from llama_index.core.memory import ChatMemoryBuffer
+        st.session_state.chat_memory = ChatMemoryBuffer.from_defaults()
+    return st.session_state.chat_memory
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def get_retrieval_service(version):
+    """Process-wide retrieval service for a snapshot version (None: in-process ingest)."""
+    if version is None:
+        # 还没有部署 indexer 时退回到进程内后台同步
+        index, fileToTitleAndUrl = start_local_ingest()
+        return RetrievalService(index, fileToTitleAndUrl, wikiTables, wikiKeywords)
+    # 索引由 indexer.py 构建并发布, 这里只打开快照, 不做任何同步
+    index, fileToTitleAndUrl, tables, keywords = openWikiSnapshot(version, get_embed_model())
+    return RetrievalService(index, fileToTitleAndUrl, tables, keywords, version)
+
+@st.cache_resource(show_spinner=False)
+def get_llm_registry():
+    # 模型客户端第一次被选中时才创建, 之后所有会话和 rerun 共用
+    return LLMRegistry(default_factories(prompt))
 
 def toggle_llm():
     llm = st.sidebar.selectbox(
@@ -108,24 +150,71 @@ def toggle_llm():
         ("gpt4o", "Claude3.5", "Llama3_8B"),
         index=1
     )
-    if llm=="Llama3_8B":
-        os.environ["OPENAI_API_KEY"] = "aa"
-    else:
-        os.environ["OPENAI_API_KEY"] = st.secrets.openai_key
-
     if llm!=st.session_state["llm"]:
         st.session_state["llm"] = llm
-        Settings.llm = llm_map[llm]
+        Settings.llm = get_llm_registry().get(llm)
         st.rerun()
 
 
+def build_chat_engine(use_rag, upload_index=None):
+    """Per-session chat engine: only the conversation memory belongs to the session."""
+    from llama_index.core.chat_engine import CondenseQuestionChatEngine, SimpleChatEngine
+    llm = get_llm_registry().get(st.session_state.llm)
+    st.session_state.retrieval_service = None
+    if upload_index is not None and not use_rag:
+        query_engine = upload_index.as_query_engine(llm=llm, streaming=True)
+        return CondenseQuestionChatEngine.from_defaults(query_engine=query_engine, memory=chat_memory(), llm=llm)
+    if not use_rag:
+        # 不用知识库时直接和模型对话, 不需要建索引
+        return SimpleChatEngine.from_defaults(memory=chat_memory(), llm=llm)
+    # 检索器/表格引擎/索引在进程内共享, 每次 rerun 只取缓存, 不做 embedding 或构建
+    service = get_retrieval_service(latest_version())
+    st.session_state.retrieval_service = service
+    st.session_state.snapshot_version = service.version
+    # 有上传文件时 wiki 和上传文件一起检索
+    return service.chat_engine(chat_memory(), st.session_state.llm, llm, upload_index)
+
+@st.cache_resource(show_spinner=False)
+def get_upload_store():
+    return UploadIndexStore()
+
+def upload_session():
+    # session_id 在清空对话时会换, 上传索引和 bucket 用单独的固定 id
+    if "upload_session" not in st.session_state.keys():
+        st.session_state.upload_session = str(uuid.uuid4())
+    return st.session_state.upload_session
+
+def load_uploads(uploaded_files):
+    """Index the session's uploaded files in memory; returns the upload index or None."""
+    store = get_upload_store()
+    upload_key = tuple((file.name, file.size) for file in uploaded_files) if uploaded_files else None
+    if upload_key == st.session_state.get("upload_key"):
+        upload_index = store.get(upload_session())
+        # 闲置过期被回收了就重新建
+        if upload_index is not None or not uploaded_files:
+            return upload_index
+    st.session_state.upload_key = upload_key
+    store.discard(upload_session())
+    if not uploaded_files:
+        return None
+
+    # 直接解析上传的内存数据, S3 归档在后台进行, 不等上传
+    files = [(file.name, file.getvalue()) for file in uploaded_files]
+    if st.secrets.aws_region=='us-east-1':
+        region = None
+    else:
+        region = st.secrets.aws_region
+    urls = archive_uploads(files, bucket=upload_session(), region=region)
+    # 上传文件的链接只属于当前会话, 不写进共享的 wiki 映射
+    st.session_state.upload_urls = {name: {"url": url} for name, url in urls.items()}
+    with st.spinner(text="Indexing uploaded files..."):
+        upload_index, skipped = store.build(upload_session(), files, embed_model=get_embed_model(),
+                                            file_metadata=lambda name: {"url": urls.get(name)})
+    if skipped:
+        st.sidebar.warning("超过上传大小上限, 未索引: " + ", ".join(skipped))
+    return upload_index
+
 def toggle_rag_use():
-    
-    from llama_index.core import VectorStoreIndex
-    from llama_index.core import Document
-    placeholder_doc = Document(text="blah")
-    index = VectorStoreIndex.from_documents([placeholder_doc])
-        
     use_rag = st.sidebar.selectbox(
         "是否用知识库",
         ("是", "否")
@@ -133,57 +222,31 @@ def toggle_rag_use():
     use_rag = True if use_rag=="是" else False
     
     uploaded_files = st.sidebar.file_uploader(label="上传临时文件", accept_multiple_files=True)
-    if uploaded_files:
-        use_rag = False
-        from upsertS3 import upload_file, create_bucket, create_presigned_url
-
-        directory = st.session_state.session_id
-        os.makedirs(directory)
-        if st.secrets.aws_region=='us-east-1':
-            region = None
-        else:
-            region = st.secrets.aws_region
-        bucket_created = create_bucket(bucket_name=directory, region=region)
-        if bucket_created:
-            for file in uploaded_files:
-                filename = file.name
-                upload_file(filename, bucket=directory)
-                bytes_data = file.read()
-                with open(filename, 'w') as f:
-                    f.write(bytes_data)
-                
-                s3_url = create_presigned_url(bucket_name=directory, object_name=filename)
-                st.session_state.fileToTitleAndUrl[filename] = {"url": s3_url}
-                
-            reader = SimpleDirectoryReader(
-                        input_dir=directory, 
-                        recursive=True, 
-                        file_extractor={".xlsx": ExcelReader()}, 
-                        file_metadata=lambda filename: {"file_name": st.session_state.fileToTitleAndUrl.get(filename, {}).get("url")}
-                    )
-            docs = reader.load_data()
-            index = VectorStoreIndex.from_documents(docs)
-        
+    upload_index = load_uploads(uploaded_files)
+    st.session_state.upload_active = upload_index is not None
+
+    # indexer 发布了新快照时切换过去, 读 LATEST 只是一次小文件读取
+    # 后台同步新增了表格时也要重建, 否则已打开的会话一直没有 SQL 路由
+    version = latest_version() if use_rag else None
+    tables_version = get_retrieval_service(version).tables_version() if use_rag else None
+    engine_key = (use_rag, st.session_state.llm, version, tables_version, id(upload_index) if upload_index else None)
+    if engine_key != st.session_state.get("chat_engine_key"):
+        st.session_state.chat_engine = build_chat_engine(use_rag, upload_index)
+        st.session_state.chat_engine_key = engine_key
     if use_rag!= st.session_state.use_rag:
-        if use_rag:
-            index, st.session_state.fileToTitleAndUrl = load_data()                
-        
-        st.session_state.chat_engine = index.as_chat_engine(chat_mode="condense_question", streaming=True)
         st.session_state.use_rag = use_rag
         st.rerun()
-    else:
-        if "chat_engine" not in st.session_state.keys():
-            index, st.session_state.fileToTitleAndUrl = load_data()
-            st.session_state.chat_engine = index.as_chat_engine(chat_mode="condense_question", streaming=True)
 
 def init_chat():
+    Settings.embed_model = get_embed_model()
+    get_metrics()
              
     if "llm" not in st.session_state.keys(): 
         st.session_state.llm = "claude3.5"
     if "use_rag" not in st.session_state.keys(): 
         st.session_state.use_rag = True
-    if "fileToTitleAndUrl" not in st.session_state.keys(): 
-        st.session_state.fileToTitleAndUrl = {}
+    if "upload_urls" not in st.session_state.keys(): 
+        st.session_state.upload_urls = {}
     
     toggle_llm()
     toggle_rag_use()
@@ -268,42 +331,65 @@ def main():
         if message["role"] != "assistant":
             with st.chat_message("assistant"):
                 response_container = st.empty()  # Container to hold the response as it streams
+                renderer = StreamRenderer(response_container)
                 response_msg = ""
-                try:
-                    if prompt:
-                        streaming_response = st.session_state.chat_engine.stream_chat(prompt)
-                    else:
-                        st.rerun()
-                except:
-                    st.rerun()
-                for token in streaming_response.response_gen:
-                    response_msg += token
-                    response_container.write(response_msg)
-                
-                if st.session_state.use_rag:
-                    processor = SimilarityPostprocessor(similarity_cutoff=0.25)
-                    source_nodes = streaming_response.source_nodes
-                    filtered_nodes = processor.postprocess_nodes(source_nodes)
-                    sources_list = []
-                    for node in filtered_nodes:
+                sources_list = []
+                turn = None
+                # 对话里的第一个问题不依赖上下文, 相同/相近的问题直接用缓存的回答和引用
+                first_turn = not chat_memory().get_all()
+                cached = None
+                # 带上传文件的回答依赖这个会话的文件, 进程内同步还没结束时索引一直在变, 都不走缓存
+                # 版本在这一轮开始时取一次, 查找和写入用同一个
+                scope = answer_scope() if first_turn and st.session_state.use_rag else None
+                cacheable = scope is not None and not st.session_state.get("upload_active")
+                if prompt and cacheable:
+                    cached = get_answer_cache().lookup(prompt, scope)
+                if cached:
+                    from llama_index.core.llms import ChatMessage, MessageRole
+                    response_msg = cached["answer"]
+                    sources_list = cached["sources"]
+                    chat_memory().put(ChatMessage(role=MessageRole.USER, content=prompt))
+                    chat_memory().put(ChatMessage(role=MessageRole.ASSISTANT, content=response_msg))
+                    renderer.write(response_msg)
+                else:
+                    turn = TurnMetrics()
+                    with turn.active():
+                        llm_started = time.perf_counter()
                         try:
-                            file_path = node.metadata["file_path"]
-                            file_name = st.session_state.fileToTitleAndUrl[file_path]["title"]
-                            file_url = st.session_state.fileToTitleAndUrl[file_path]["url"]
-                            source = "[%s](%s)中某部分相似度" % (file_name, file_url) + format(node.score, ".2%") 
-                            sources_list.append(source)
+                            if prompt:
+                                streaming_response = st.session_state.chat_engine.stream_chat(prompt)
+                            else:
+                                st.rerun()
                         except Exception as e:
-                            # no source wiki node
-                            print(e)
-                            pass
+                            get_llm_registry().record(st.session_state.llm, time.perf_counter() - llm_started, e)
+                            st.rerun()
+                        generate_started = time.perf_counter()
+                        try:
+                            for token in streaming_response.response_gen:
+                                turn.token()
+                                response_msg += token
+                                renderer.write(token)
+                        except Exception as e:
+                            get_llm_registry().record(st.session_state.llm, time.perf_counter() - llm_started, e)
+                            raise
+                        turn.add_stage("generate", time.perf_counter() - generate_started)
+                        get_llm_registry().record(st.session_state.llm, time.perf_counter() - llm_started)
+                    
+                        if st.session_state.use_rag:
+                            sources_list = st.session_state.retrieval_service.citations(streaming_response.source_nodes)
+
+                            if prompt and cacheable and response_msg:
+                                get_answer_cache().store(prompt, scope, response_msg, sources_list)
+                    turn.finish(response_msg)
+                    # 分阶段耗时汇总到 /metrics, 单轮明细随 run 一起上报
+                    get_metrics().observe(turn, st.session_state.llm)
                     
-                    if sources_list: 
-                        sources = "  \n".join(sources_list)
-                        source_msg = "  \n  \n***知识库引用***  \n" + sources
-                        
-                        for c in source_msg:
-                            response_msg += c
-                            response_container.write(response_msg)
+                if sources_list: 
+                    sources = "  \n".join(sources_list)
+                    source_msg = "  \n  \n***知识库引用***  \n" + sources
+                    # 引用和回答剩下的部分一次性写出
+                    renderer.write(source_msg)
+                response_msg = renderer.close()
                 
                 message = {"role": "assistant", "content": response_msg}
                 st.session_state.messages.append(message) # Add response to message history
@@ -311,14 +397,14 @@ def main():
                 # log nonnull converstaion to langsmith
                 if prompt and response_msg:
                     print(f'{prompt} -> {response_msg}')
-                    requests.patch(
-                        f"https://api.smith.langchain.com/runs/{run_id}",
-                        json={
-                            "name": st.session_state.session_id,
-                            "inputs": {"text": prompt},
-                            "outputs": {"my_output": response_msg},
-                        },
-                        headers={"x-api-key": langchain_api_key},
+                    outputs = {"my_output": response_msg}
+                    if turn:
+                        outputs["turn_metrics"] = turn.as_dict()
+                    get_telemetry().patch_run(
+                        run_id,
+                        name=st.session_state.session_id,
+                        inputs={"text": prompt},
+                        outputs=outputs,
                     )
                     
                 # st.rerun()
@@ -0,0 +1,131 @@
+import os
+import time
+import threading
+import multiprocessing
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from llama_index.core import SimpleDirectoryReader
+
+# 默认留一个核给 streamlit 主进程
+parse_workers = max(1, (os.cpu_count() or 2) - 1)
+
+
+def _fixed_metadata(metadata, filename):
+    return dict(metadata or {})
+
+
+def _parse_file(path, metadata, file_extractor, filename_as_id):
+    # 在子进程里执行, 和原来的单文件 SimpleDirectoryReader 完全一样, 只是元数据由父进程算好传进来
+    started = time.perf_counter()
+    reader = SimpleDirectoryReader(
+        input_files=[path],
+        filename_as_id=filename_as_id,
+        file_extractor=file_extractor,
+        file_metadata=partial(_fixed_metadata, metadata),
+        raise_on_error=True,
+    )
+    return reader.load_data(), time.perf_counter() - started
+
+
+class ParseStats(object):
+    def __init__(self):
+        self.timings = {}
+        self.failures = {}
+        self.crashes = 0
+        self._lock = threading.Lock()
+
+    def record(self, path, elapsed):
+        with self._lock:
+            self.timings[path] = elapsed
+
+    def fail(self, path, error):
+        with self._lock:
+            self.failures[path] = error
+
+    def report(self, slowest=5):
+        slow = sorted(self.timings.items(), key=lambda t: t[1], reverse=True)[:slowest]
+        slow_str = ", ".join(f"{os.path.basename(path)}={elapsed:.2f}s" for path, elapsed in slow)
+        return (f"parsed {len(self.timings)} files ({len(self.failures)} failed, {self.crashes} worker crashes) "
+                f"in {sum(self.timings.values()):.2f}s of worker time, slowest: {slow_str}")
+
+
+class ParallelReader(object):
+    """Parse files with SimpleDirectoryReader in a pool of worker processes.
+
+    docx/PDF/xlsx parsing is CPU bound, so it runs in separate processes
+    instead of on the Streamlit process's one core. ``file_metadata`` is
+    evaluated in the calling process, so it may depend on in-memory state.
+    A file that kills its worker (e.g. a malformed PDF crashing a C
+    extension) is retried once on its own and then reported as failed,
+    without failing the other files.
+    """
+
+    def __init__(self, file_extractor=None, file_metadata=None, filename_as_id=False, max_workers=None):
+        self.file_extractor = file_extractor or {}
+        self.file_metadata = file_metadata
+        self.filename_as_id = filename_as_id
+        self.max_workers = max_workers or parse_workers
+        self.stats = ParseStats()
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                # streamlit 进程里有很多线程, fork 出来的子进程可能拿到别人持有的锁, 所以用 spawn
+                self._executor = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+    def _reset_pool(self, broken):
+        with self._lock:
+            if self._executor is broken:
+                self.stats.crashes += 1
+                self._executor = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, executor, path):
+        path = os.path.abspath(path)
+        metadata = self.file_metadata(path) if self.file_metadata else None
+        return executor.submit(_parse_file, path, metadata, self.file_extractor, self.filename_as_id)
+
+    def _isolated(self, path):
+        # 池子崩了以后不知道是哪个文件导致的, 单独开一个进程再解析一次
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            return self._submit(executor, path).result()
+
+    def _finish(self, path, future):
+        try:
+            docs, elapsed = future.result()
+        except BrokenProcessPool:
+            try:
+                docs, elapsed = self._isolated(path)
+            except Exception as e:
+                self.stats.fail(path, e)
+                raise
+        except Exception as e:
+            self.stats.fail(path, e)
+            raise
+        self.stats.record(path, elapsed)
+        return docs
+
+    def load_file(self, path):
+        """Parse one file in the pool and return its Documents; raises if the file cannot be parsed."""
+        executor = self._pool()
+        future = self._submit(executor, path)
+        if isinstance(future.exception(), BrokenProcessPool):
+            self._reset_pool(executor)
+        return self._finish(path, future)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
@@ -1,6 +1,9 @@
 import os 
+import asyncio
+import threading
 import requests
 import json
+import hashlib
 import lark_oapi as lark
 from lark_oapi.api.wiki.v2 import *
 from lark_oapi.api.docx.v1 import *
@@ -9,265 +12,249 @@ from lark_oapi.api.auth.v3 import *
 from lark_oapi.api.sheets.v3 import *
 import streamlit as st
 from listAllWiki import *
+from wikiSync import SyncManifest, UrlCache, local_path, remove_local_doc, manifest_path
+from wikiFetcher import WikiFetcher
+from ingestPipeline import IngestPipeline
+from embeddingCache import CachedEmbedding
+from embeddingScheduler import BatchedEmbedding
+from feishuToken import FEISHU_HOST, FeishuException, get_token_provider
+from tableStore import TableStore, ExcelReader, SheetReader
+from parallelReader import ParallelReader
+from snapshots import snapshot_path, load_fileToTitleAndUrl
+from keywordIndex import KeywordIndex
 
 from llama_index.vector_stores.chroma import ChromaVectorStore
-from llama_index.core import VectorStoreIndex, SimpleDirectoryReader, StorageContext
-from llama_index.core.readers.base import BaseReader
-import pandas as pd
-from llama_index.core import Document
+from llama_index.core import VectorStoreIndex
 
 import chromadb
 
 collection = "qcWiki"
 chroma_db_path = "chroma_db"
+# 并发爬取知识库目录树时的并发数和每秒请求数上限
+crawl_concurrency = 8
+crawl_requests_per_second = 20.0
+# drive meta batch_query 单次最多查询的文档数
+META_BATCH_SIZE = 200
 fileToTitleAndUrl = {}
+# startWikiIngest 的后台同步还在改写索引
+_ingest_running = threading.Event()
+
+# wiki 表格按 sheet 存成 SQLite 表, 数值问题走 SQL 查询
+wikiTables = TableStore()
+# 和 chroma 里的 chunk 一一对应的 BM25 倒排索引, 用来召回型号/SKU 之类的精确词
+wikiKeywords = KeywordIndex()
+
+def getUrls(client, docs, option=None):
+    """Resolve many (doc_token, doc_type) pairs to URLs, META_BATCH_SIZE docs per request."""
+    urls = {}
+    for i in range(0, len(docs), META_BATCH_SIZE):
+        batch = docs[i:i + META_BATCH_SIZE]
+        request: BatchQueryMetaRequest = BatchQueryMetaRequest.builder() \
+            .request_body(MetaRequest.builder()
+                .request_docs([RequestDoc.builder()
+                    .doc_token(doc_id)
+                    .doc_type(doc_type)
+                    .build()
+                    for doc_id, doc_type in batch])
+                .with_url(True)
+                .build()) \
+            .build()
 
-class ExcelReader(BaseReader):
-    def load_data(self, file_path: str, extra_info: dict = None):
-        data = pd.read_excel(file_path).to_string()
-        return [Document(text=data, metadata=extra_info)]
-    
-def getUrl(client, doc_id, doc_type):
-    request: BatchQueryMetaRequest = BatchQueryMetaRequest.builder() \
-        .request_body(MetaRequest.builder()
-            .request_docs([RequestDoc.builder()
-                .doc_token(doc_id)
-                .doc_type(doc_type)
-                .build()
-                ])
-            .with_url(True)
-            .build()) \
-        .build()
-
-    # 发起请求
-    response: BatchQueryMetaResponse = client.drive.v1.meta.batch_query(request)
+        # 发起请求
+        response: BatchQueryMetaResponse = client.drive.v1.meta.batch_query(request, option)
 
-    # 处理失败返回
-    if not response.success():
-        lark.logger.error(
-            f"client.drive.v1.meta.batch_query failed, code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}")
-        return None
+        # 处理失败返回
+        if not response.success():
+            lark.logger.error(
+                f"client.drive.v1.meta.batch_query failed, code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}")
+            continue
 
-    # 处理业务结果
-    lark.logger.info(lark.JSON.marshal(response.data, indent=4))
-    if len(response.data.metas)!=1:
-        print(f'{doc_type}" -> {response.data.metas}')
-    return response.data.metas[0].url
+        # 处理业务结果
+        for meta in response.data.metas or []:
+            urls[meta.doc_token] = meta.url
+        if response.data.failed_list:
+            print(f'failed to resolve urls -> {[(f.token, f.code) for f in response.data.failed_list]}')
+    return urls
 
 app_id = st.secrets.feishu_app_id
 app_secret = st.secrets.feishu_app_secret
 
 larkClient = lark.Client.builder() \
+        .domain(FEISHU_HOST) \
         .enable_set_token(True) \
         .log_level(lark.LogLevel.DEBUG) \
         .app_id(app_id) \
         .app_secret(app_secret) \
         .build()
 
-def getAppAccessToken(app_id, app_secret):
-    # 构造请求对象
-    request: InternalAppAccessTokenRequest = InternalAppAccessTokenRequest.builder() \
-        .request_body(InternalAppAccessTokenRequestBody.builder()
-            .app_id(app_id)
-            .app_secret(app_secret)
-            .build()) \
-        .build()
-
-    # 发起请求
-    response: InternalAppAccessTokenResponse = larkClient.auth.v3.app_access_token.internal(request)
+def getTokenProvider(app_id, app_secret):
+    # 所有模块共用一份 token 缓存, 快过期时自动刷新
+    return get_token_provider(app_id, app_secret)
 
-    # 处理失败返回
-    if not response.success():
-        lark.logger.error(
-            f"client.auth.v3.app_access_token.internal failed, code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}")
+def getAppAccessToken(app_id, app_secret):
+    try:
+        return getTokenProvider(app_id, app_secret).app_access_token()
+    except (FeishuException, requests.RequestException) as e:
+        lark.logger.error(f"getting app_access_token failed: {e}")
         return
 
-    # 处理业务结果
-    lark.logger.info(lark.JSON.marshal(response.data, indent=4))
-
-    return response.data["app_access_token"]
-
 
 def getTenantAccessToken(app_id, app_secret):
-    request: InternalTenantAccessTokenRequest = InternalTenantAccessTokenRequest.builder() \
-        .request_body(InternalTenantAccessTokenRequestBody.builder()
-            .app_id(app_id)
-            .app_secret(app_secret)
-            .build()) \
-        .build()
-
-    # 发起请求
-    response: InternalTenantAccessTokenResponse = larkClient.auth.v3.tenant_access_token.internal(request)
-
-    # 处理失败返回
-    if not response.success():
-        lark.logger.error(
-            f"client.auth.v3.tenant_access_token.internal failed, code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}")
+    try:
+        return getTokenProvider(app_id, app_secret).tenant_access_token()
+    except (FeishuException, requests.RequestException) as e:
+        lark.logger.error(f"getting tenant_access_token failed: {e}")
         return
 
-    # 处理业务结果
-    lark.logger.info(lark.JSON.marshal(response, indent=4))
-    return json.loads(response.raw.content)["tenant_access_token"]
 
+def wikiFileMetadata(filename):
+    # file_path 用来在增量更新时定位旧 chunk, file_name 存放引用时展示的 url
+    return {
+        "file_path": os.path.abspath(filename),
+        "file_name": fileToTitleAndUrl.get(os.path.abspath(filename), {}).get("url"),
+    }
 
-async def readWiki(space_id, app_id, app_secret, embed_model):
-    tenant_access_token = getTenantAccessToken(app_id, app_secret)
-    nodes = await get_all_wiki_nodes(space_id, tenant_access_token)
+# 文档解析放到进程池里, 不占用 streamlit 进程的 CPU
+wikiParser = ParallelReader(
+                file_extractor={".xlsx": ExcelReader(wikiTables), ".sqlite": SheetReader(wikiTables)},
+                file_metadata=wikiFileMetadata,
+                filename_as_id=True,
+            )
+
+def loadWikiFile(path):
+    return wikiParser.load_file(path)
+
+def getEmbedModel(api_base):
+    # 同一段文本只会 embedding 一次, wiki 重建和上传文件共享同一份本地缓存
+    # 未命中缓存的文本按 token 数打包并发请求, 429/5xx 由调度器退避重试, 所以关掉客户端自带的重试
+    from llama_index.embeddings.openai import OpenAIEmbedding
+    return CachedEmbedding(BatchedEmbedding(OpenAIEmbedding(model="text-embedding-3-large", api_base=api_base, max_retries=0)))
+
+class WikiChromaVectorStore(ChromaVectorStore):
+    def query(self, query, **kwargs):
+        # 没有过滤条件时适配层会传 where={}, 新版 chromadb 直接拒绝空的 where, 这里显式传 None
+        if query.filters is None:
+            kwargs.setdefault("where", None)
+        return super().query(query, **kwargs)
+
+def openWikiIndex(embed_model, path=chroma_db_path, readonly=False):
+    db = chromadb.PersistentClient(path=path)
+    # 快照里的 collection 一定已经存在, 只读的一方不去创建
+    chroma_collection = db.get_collection(collection) if readonly else db.get_or_create_collection(collection)
+    vector_store = WikiChromaVectorStore(chroma_collection=chroma_collection)
+    index = VectorStoreIndex.from_vector_store(
+        vector_store,
+        embed_model=embed_model,
+    )
+    return index, chroma_collection
+
+
+async def readWiki(space_id, app_id, app_secret, embed_model, index=None):
+    # 传 provider 而不是 token 字符串, 长时间同步中途 token 过期也会自动续期
+    tenant_access_token = getTokenProvider(app_id, app_secret)
+    complete = True
+    try:
+        nodes = await get_all_wiki_nodes(space_id, tenant_access_token, concurrency=crawl_concurrency, requests_per_second=crawl_requests_per_second)
+    except IncompleteCrawl as e:
+        # 没爬全时分不清哪些节点是真的被删了, 这次只同步爬到的新增/变更节点, 不做删除
+        print(f"Wiki crawl incomplete: {e}, skipping deletions in this sync")
+        nodes, complete = e.nodes, False
     directory = "./data"
     if not os.path.exists(directory):
         os.makedirs(directory)
 
-    for node in nodes:
-        doc_id = node["obj_token"]
-        title = node["title"]
-        doc_type = node["obj_type"]
+    # 只下载新增或 obj_edit_time 变化过的节点, 已删除节点的本地文件和向量一并清理
+    manifest = SyncManifest()
+    changed, unchanged, vanished = manifest.plan(nodes, directory, complete=complete)
+    print(f"Wiki sync: {len(changed)} new or changed, {len(unchanged)} unchanged, {len(vanished)} vanished")
+
+    opened_index, chroma_collection = openWikiIndex(embed_model)
+    if index is None:
+        index = opened_index
+
+    # 倒排索引是后加的, 第一次运行时把 chroma 里已有的 chunk 补进去
+    added, stale = await asyncio.to_thread(wikiKeywords.sync_with_collection, chroma_collection)
+    if added or stale:
+        print(f"Keyword index: {added} chunks added, {stale} stale removed")
+
+    for token, entry in vanished:
+        remove_local_doc(entry["path"], chroma_collection, wikiTables, wikiKeywords)
+        manifest.remove(token)
+
+    # 节点改名后旧文件会留在本地, 先清掉; 以前同步成 xlsx 的表格也在这里换成 SQLite 文件
+    for node in changed:
+        previous = manifest.entries.get(node["obj_token"])
+        if previous and previous["path"] != local_path(directory, node):
+            remove_local_doc(previous["path"], chroma_collection, wikiTables, wikiKeywords)
+
+    # wiki 文档的 url 不会变, 只批量查询缓存里还没有的; 下载前先查好, 文档入库时就能带上 url
+    url_cache = UrlCache()
+    url_cache.prune(manifest.entries)
+    missing = url_cache.missing(dict(manifest.entries, **{node["obj_token"]: node for node in changed}))
+    if missing:
+        option = lark.RequestOption.builder().tenant_access_token(await tenant_access_token.aget()).build()
+        url_cache.update(await asyncio.to_thread(getUrls, larkClient, missing, option))
+        url_cache.save()
+    fileToTitleAndUrl.update(manifest.fileToTitleAndUrl(url_cache.urls))
+    for node in changed:
+        fileToTitleAndUrl[local_path(directory, node)] = {"title": node["title"], "url": url_cache.urls.get(node["obj_token"])}
+
+    # 下载, 切分, embedding 和写入 chroma 流水线并行, 每个文档写入后就可以被检索到
+    fetcher = WikiFetcher(larkClient, tenant_access_token, directory)
+    pipeline = IngestPipeline(fetcher, index, chroma_collection, loadWikiFile, parse_workers=wikiParser.max_workers,
+                              keyword_index=wikiKeywords)
+    await pipeline.run(changed, on_indexed=manifest.record)
+    manifest.save()
+    print(wikiParser.stats.report())
+    if isinstance(embed_model, CachedEmbedding):
+        print(embed_model.cache.report())
 
-        # 发起请求
-        option = lark.RequestOption.builder().tenant_access_token(tenant_access_token).build()
+    return index, fileToTitleAndUrl
 
-        if doc_type=="sheet":
-            sheet_token = doc_id
-            request: QuerySpreadsheetSheetRequest = QuerySpreadsheetSheetRequest.builder() \
-        .spreadsheet_token(sheet_token) \
-        .build()
 
-            # 发起请求
-            response: QuerySpreadsheetSheetResponse = larkClient.sheets.v3.spreadsheet_sheet.query(request)
-
-            # 处理失败返回
-            if not response.success():
-                lark.logger.error(
-                    f"client.sheets.v3.spreadsheet_sheet.query failed, code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}")
-            else:
-                # 处理业务结果
-                lark.logger.info(lark.JSON.marshal(response.data, indent=4))
-                sheets = response.data.sheets
-
-                with pd.ExcelWriter("./data/"+title, engine='xlsxwriter') as writer:
-                    for sheet in sheets:
-                        url = f'https://open.feishu.cn/open-apis/sheets/v2/spreadsheets/{sheet_token}/values/{sheet.sheet_id}'
-                        headers = {
-                            'Authorization': f'Bearer {tenant_access_token}'
-                        }
-
-                        response = requests.get(url, headers=headers)
-                        if response.status_code==200:
-                            respJson = response.json()
-                            sheet_data = respJson["data"]["valueRange"]["values"]
-                            df = pd.DataFrame(sheet_data)
-                            df.to_excel(writer, sheet_name=sheet.title, index=False)
-                        else:
-                            lark.logger.error(
-                            f"Getting sheet from {url} failed, code: {response.status_code}, msg: {response.text}")
-            
-        elif doc_type=="docx":
-            request: RawContentDocumentRequest = RawContentDocumentRequest.builder() \
-            .document_id(doc_id) \
-            .lang(0) \
-            .build()
+def startWikiIngest(space_id, app_id, app_secret, embed_model):
+    """Open the wiki index right away and sync the wiki into it from a background thread.
 
-            # 发起请求
-            response: RawContentDocumentResponse = larkClient.docx.v1.document.raw_content(request, option)
-            if not response.success():
-                lark.logger.error(
-                    f"client.docx.v1.document.get failed, code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}, doc_id: {doc_id}")
-            else:
-                path = "./data/"+title
-                if not os.path.exists(path):
-                    try:
-                        with open(path, 'w') as f:
-                            f.write(response.data.content)
-                    except:
-                        pass
-
-            request: ListDocumentBlockRequest = ListDocumentBlockRequest.builder() \
-            .document_id(doc_id) \
-            .page_size(500) \
-            .document_revision_id(-1) \
-            .build()
+    Queries are answered from whatever has been indexed so far, so a cold start
+    does not wait for the crawl and embedding to finish.
+    """
+    index, _ = openWikiIndex(embed_model)
+    fileToTitleAndUrl.update(SyncManifest().fileToTitleAndUrl(UrlCache().urls))
+    _ingest_running.set()
 
-            # 发起请求
-            listBlockResponse: ListDocumentBlockResponse = larkClient.docx.v1.document_block.list(request)
-
-            # 处理失败返回
-            if not listBlockResponse.success():
-                lark.logger.error(
-                    f"client.docx.v1.document_block.list failed, code: {listBlockResponse.code}, msg: {listBlockResponse.msg}, log_id: {listBlockResponse.get_log_id()}")
-            else:
-                # 处理业务结果
-                lark.logger.info(lark.JSON.marshal(listBlockResponse.data, indent=4))
-                
-            try:
-                fileToTitleAndUrl[os.path.abspath(path)] = {"title": title, "url": getUrl(larkClient, doc_id, doc_type)}
-            except:
-                print(f'failed {path}')
-    
-    # automatically sets the metadata of each document according to filename_fn
-    reader = SimpleDirectoryReader(
-                input_dir=directory, 
-                recursive=True, 
-                file_extractor={".xlsx": ExcelReader()}, 
-                file_metadata=lambda filename: {"file_name": fileToTitleAndUrl.get(filename, {}).get("url")}
-            )
-    docs = reader.load_data()
-    
-    import hashlib
-    hash_file_path = "./documents_hash.txt"
-
-    def calculate_hash(documents):
-        """Calculate the SHA-256 hash of the documents."""
-        doc_str = json.dumps([doc.text for doc in documents], sort_keys=True)
-        return hashlib.sha256(doc_str.encode('utf-8')).hexdigest()
-
-    def load_hash():
-        """Load the previously saved hash from file."""
-        if os.path.exists(hash_file_path):
-            with open(hash_file_path, 'r') as f:
-                return f.read()
-        return None
+    def run():
+        try:
+            asyncio.run(readWiki(space_id, app_id, app_secret, embed_model, index=index))
+        except Exception as e:
+            # 同步中途失败时索引和 manifest 对不上, 这个进程里就不再给出本地索引版本
+            print(f"Wiki ingest failed: {e}")
+            return
+        _ingest_running.clear()
 
-    def save_hash(new_hash):
-        """Save the new hash to file."""
-        with open(hash_file_path, 'w') as f:
-            f.write(new_hash)
-
-    current_hash = calculate_hash(docs)
-
-    # Load the previous hash
-    previous_hash = load_hash()
-
-    # Check if the documents have been updated
-    if current_hash == previous_hash:
-        print("Documents have not been updated. Loading from disk.")
-        db = chromadb.PersistentClient(path=chroma_db_path)
-        chroma_collection = db.get_or_create_collection(collection)
-        vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
-        storage_context = StorageContext.from_defaults(vector_store=vector_store)
-
-        # Load the existing index from the vector store
-        index = VectorStoreIndex.from_vector_store(
-            vector_store,
-            embed_model=embed_model,
-        )
-    else:
-        print("Documents have been updated. Creating new vector store and index.")
-        # Save the new hash
-        save_hash(current_hash)
-
-        # Create a new vector store and index
-        db = chromadb.PersistentClient(path=chroma_db_path)
-        chroma_collection = db.get_or_create_collection(collection)
-        vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
-        storage_context = StorageContext.from_defaults(vector_store=vector_store)
-
-        # Create a new index from documents
-        index = VectorStoreIndex.from_documents(
-            docs, storage_context=storage_context, embed_model=embed_model
-        )
-        
+    threading.Thread(target=run, name="wiki-ingest", daemon=True).start()
     return index, fileToTitleAndUrl
 
 
+def localIndexVersion():
+    """Version of the index synced in-process: a hash of the sync manifest.
+
+    None while ``startWikiIngest`` is still writing to the index (or failed
+    part way) and before the first sync, since answers are not stable then.
+    """
+    if _ingest_running.is_set() or not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'rb') as f:
+        return "local-" + hashlib.sha1(f.read()).hexdigest()[:16]
+
+
+def openWikiSnapshot(version, embed_model):
+    """Open a snapshot published by indexer.py; returns (index, fileToTitleAndUrl, table store, keyword index)."""
+    path = snapshot_path(version)
+    index, _ = openWikiIndex(embed_model, os.path.join(path, "chroma_db"), readonly=True)
+    return (index, load_fileToTitleAndUrl(version), TableStore(os.path.join(path, "tables.sqlite"), readonly=True),
+            KeywordIndex(os.path.join(path, "keywords.sqlite"), readonly=True))
+
+
 def searchWiki(space_id, node_id, query, user_access_token):
 
     # Define the URL and the headers
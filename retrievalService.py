@@ -0,0 +1,235 @@
+import json
+import math
+import hashlib
+import threading
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
+
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.chat_engine import CondenseQuestionChatEngine
+from llama_index.core.postprocessor import SimilarityPostprocessor
+from llama_index.core.query_engine import RetrieverQueryEngine, RouterQueryEngine
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.core.selectors import LLMSingleSelector
+from llama_index.core.tools import QueryEngineTool
+
+from keywordIndex import HybridRetriever
+from tableStore import table_query_engine
+import turnMetrics
+
+# 引用来源的相似度下限
+citation_similarity_cutoff = 0.25
+# wiki 和上传文件合并后一共取多少个片段
+federated_top_k = 3
+
+_search_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="federated-search")
+
+
+def cosine_to_chroma_similarity(score):
+    """Map a cosine similarity onto Chroma's exp(-squared L2) scale (exact for unit-length embeddings)."""
+    return math.exp(-(2.0 - 2.0 * score))
+
+
+class TimedRetriever(BaseRetriever):
+    """Report retrieval time, node count and context tokens to the active turn."""
+
+    def __init__(self, retriever, **kwargs):
+        self._retriever = retriever
+        super().__init__(**kwargs)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        with turnMetrics.stage("retrieve"):
+            nodes = self._retriever.retrieve(query_bundle)
+        turnMetrics.add("retrieved_nodes", len(nodes))
+        turnMetrics.add("prompt_tokens", sum(turnMetrics.count_tokens(node.node.get_content()) for node in nodes))
+        return nodes
+
+
+class FederatedRetriever(BaseRetriever):
+    """Search several indexes at once and keep the best ``similarity_top_k`` hits overall.
+
+    ``sources`` is [(retriever, score_fn)]; ``score_fn`` maps a source's scores
+    onto a common scale (None keeps them as is). The query is embedded once
+    and the searches run in parallel, so a query costs as much as the slowest
+    search rather than the sum.
+    """
+
+    def __init__(self, sources, embed_model=None, similarity_top_k=federated_top_k, **kwargs):
+        self._sources = sources
+        self._embed_model = embed_model
+        self._similarity_top_k = similarity_top_k
+        super().__init__(**kwargs)
+
+    def _search(self, retriever, score_fn, query_bundle):
+        hits = retriever.retrieve(query_bundle)
+        if score_fn is not None:
+            for hit in hits:
+                if hit.score is not None:
+                    hit.score = score_fn(hit.score)
+        return hits
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        if query_bundle.embedding is None and self._embed_model is not None:
+            query_bundle.embedding = self._embed_model.get_query_embedding(query_bundle.query_str)
+        futures = [_search_pool.submit(self._search, retriever, score_fn, query_bundle)
+                   for retriever, score_fn in self._sources]
+        merged = {}
+        for future in futures:
+            try:
+                hits = future.result()
+            except Exception as e:
+                # 一边检索失败时用另一边的结果
+                print(f"federated search failed: {e}")
+                continue
+            for hit in hits:
+                node_id = hit.node.node_id
+                if node_id not in merged or (hit.score or 0.0) > (merged[node_id].score or 0.0):
+                    merged[node_id] = hit
+        return sorted(merged.values(), key=lambda hit: hit.score or 0.0, reverse=True)[:self._similarity_top_k]
+
+
+class TableGatedQueryEngine(BaseQueryEngine):
+    """Only send questions that mention a stored table through the LLM router.
+
+    Routing costs a full LLM round trip, so questions that name no sheet,
+    model or GPU from ``terms`` (see ``TableStore.terms``) go straight to the
+    retrieval engine.
+    """
+
+    def __init__(self, query_engine, router, terms):
+        self._query_engine = query_engine
+        self._router = router
+        self._terms = terms
+        super().__init__(callback_manager=query_engine.callback_manager)
+
+    def _get_prompt_modules(self):
+        return {}
+
+    def _engine(self, query_bundle):
+        query = query_bundle.query_str.lower()
+        return self._router if any(term in query for term in self._terms) else self._query_engine
+
+    def _query(self, query_bundle: QueryBundle):
+        return self._engine(query_bundle).query(query_bundle)
+
+    async def _aquery(self, query_bundle: QueryBundle):
+        return await self._engine(query_bundle).aquery(query_bundle)
+
+
+class TimedCondenseQuestionChatEngine(CondenseQuestionChatEngine):
+    def _condense_question(self, chat_history, last_message):
+        with turnMetrics.stage("condense"):
+            question = super()._condense_question(chat_history, last_message)
+        turnMetrics.add("prompt_tokens", turnMetrics.count_tokens(question))
+        return question
+
+
+class RetrievalService(object):
+    """Query side of one wiki index, shared by every session in the process.
+
+    The index, retriever, SQL table engine and citation postprocessor are
+    built once; query engines are built once per LLM. A session only owns its
+    chat memory: ``chat_engine(memory, ...)`` wraps the shared query engine in
+    a CondenseQuestionChatEngine, which is a plain object with no I/O.
+    Sessions with uploaded files get their own query engine over a
+    FederatedRetriever, which searches the wiki and the uploads together.
+    """
+
+    def __init__(self, index, fileToTitleAndUrl, table_store=None, keyword_index=None, version=None):
+        self.index = index
+        self.fileToTitleAndUrl = fileToTitleAndUrl
+        self.table_store = table_store
+        self.version = version
+        if keyword_index is not None:
+            # 向量检索和 BM25 关键词检索融合, 型号/SKU 这类精确词也能召回
+            self.base_retriever = HybridRetriever(index, keyword_index)
+        else:
+            self.base_retriever = index.as_retriever()
+        self.retriever = TimedRetriever(self.base_retriever)
+        self.postprocessor = SimilarityPostprocessor(similarity_cutoff=citation_similarity_cutoff)
+        self._query_engines = {}
+        self._table_engines = {}
+        self._lock = threading.Lock()
+
+    def tables_version(self):
+        """Fingerprint of the stored table set; changes when a sync adds, drops or reshapes a sheet."""
+        if self.table_store is None:
+            return None
+        return hashlib.sha1(json.dumps(self.table_store.tables(), sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _table_engine(self, llm_name, llm, version):
+        """(SQL engine, table terms) for the current table set, or (None, None) without tables."""
+        if self.table_store is None:
+            return None, None
+        # 后台同步会陆续写入表格, 表集合变了就重建; 空表集合不缓存成永久的 None
+        with self._lock:
+            cached = self._table_engines.get(llm_name)
+            if cached is None or cached[0] != version:
+                engine = table_query_engine(self.table_store, llm=llm, streaming=True)
+                self._table_engines[llm_name] = (version, engine, self.table_store.terms() if engine else None)
+            return self._table_engines[llm_name][1:]
+
+    def _build_query_engine(self, retriever, table_engine, llm):
+        table_engine, terms = table_engine
+        query_engine = RetrieverQueryEngine.from_args(retriever, llm=llm, streaming=True)
+        if table_engine is None:
+            return query_engine
+        # 表格里的数值问题交给 SQL 过滤/聚合, 其它问题照旧走检索
+        router = RouterQueryEngine(
+            selector=LLMSingleSelector.from_defaults(llm=llm),
+            query_engine_tools=[
+                QueryEngineTool.from_defaults(query_engine, description="Search the wiki documents and the user's uploaded files. Use for explanations, how-tos, project and process questions."),
+                QueryEngineTool.from_defaults(table_engine, description="Run SQL over the wiki spreadsheets (model/hardware benchmark tables). Use for numeric lookups, filters, comparisons, averages, max/min."),
+            ],
+            llm=llm,
+        )
+        return TableGatedQueryEngine(query_engine, router, terms)
+
+    def query_engine(self, llm_name, llm=None, upload_index=None):
+        """Streaming query engine for ``llm_name``; shared unless the session has an upload index.
+
+        The shared engine is rebuilt when the table set changes, so sheets
+        synced after startup become queryable through the SQL route.
+        """
+        version = self.tables_version()
+        table_engine = self._table_engine(llm_name, llm, version)
+        if upload_index is not None:
+            # 上传文件和 wiki 一起检索; 只给这个会话用, 构建不涉及 I/O
+            retriever = TimedRetriever(FederatedRetriever(
+                [(self.base_retriever, None),
+                 (upload_index.as_retriever(similarity_top_k=federated_top_k), cosine_to_chroma_similarity)],
+                embed_model=self.index._embed_model,
+            ))
+            return self._build_query_engine(retriever, table_engine, llm)
+        with self._lock:
+            cached = self._query_engines.get(llm_name)
+            if cached is None or cached[0] != version:
+                self._query_engines[llm_name] = (version, self._build_query_engine(self.retriever, table_engine, llm))
+            return self._query_engines[llm_name][1]
+
+    def chat_engine(self, memory, llm_name, llm=None, upload_index=None):
+        return TimedCondenseQuestionChatEngine.from_defaults(
+            query_engine=self.query_engine(llm_name, llm, upload_index), memory=memory, llm=llm)
+
+    def citations(self, source_nodes):
+        """Markdown citation lines for the source nodes above the similarity cutoff."""
+        sources_list = []
+        with turnMetrics.stage("postprocess"):
+            nodes = self.postprocessor.postprocess_nodes(source_nodes)
+        turnMetrics.add("cited_nodes", len(nodes))
+        for node in nodes:
+            try:
+                if "url" in node.metadata:
+                    # 会话上传的文件
+                    file_name = node.metadata["file_name"]
+                    file_url = node.metadata["url"]
+                else:
+                    file_path = node.metadata["file_path"]
+                    file_name = self.fileToTitleAndUrl[file_path]["title"]
+                    file_url = self.fileToTitleAndUrl[file_path]["url"]
+                sources_list.append("[%s](%s)中某部分相似度" % (file_name, file_url) + format(node.score, ".2%"))
+            except Exception as e:
+                # no source wiki node
+                print(e)
+        return sources_list
@@ -0,0 +1,115 @@
+import os
+import json
+import time
+import shutil
+import sqlite3
+from datetime import datetime
+
+snapshot_root = os.environ.get("QC_SNAPSHOT_DIR", "./snapshots")
+# 保留的历史快照个数, 给还没切换过来的 app 进程留出时间
+snapshot_keep = 3
+# 被新版本取代不到这么久的快照不删, app 进程里可能还有查询正在读它
+snapshot_grace_seconds = int(os.environ.get("QC_SNAPSHOT_GRACE_SECONDS", "3600"))
+LATEST = "LATEST"
+SNAPSHOT_INFO = "snapshot.json"
+
+
+def _copy_sqlite(src, dst):
+    # 用 backup 接口拷贝, 拿到的是一致的数据库, 不用管 WAL 文件
+    source = sqlite3.connect(src)
+    target = sqlite3.connect(dst)
+    try:
+        source.backup(target)
+        # 快照只读打开, 用回滚日志模式, 读的时候不需要 -wal/-shm 文件
+        target.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        target.close()
+        source.close()
+
+
+def _new_version(root):
+    # 版本号按字典序就是发布顺序, 清理旧快照时依赖这一点
+    latest = latest_version(root) or ""
+    while True:
+        version = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        if version > latest and not os.path.exists(os.path.join(root, version)):
+            return version
+        time.sleep(0.001)
+
+
+def publish_snapshot(chroma_path, sqlite_paths, fileToTitleAndUrl, root=snapshot_root, keep=snapshot_keep, info=None):
+    """Copy the current index into a new version under ``root`` and point LATEST at it.
+
+    ``sqlite_paths`` are the side stores (SQL tables, keyword index) copied next
+    to the Chroma directory under their own file names.
+
+    Must be called while nothing is writing to ``chroma_path``. Readers only
+    ever see complete snapshots: the version directory is renamed into place
+    and LATEST is swapped with ``os.replace``. Returns the new version.
+    """
+    os.makedirs(root, exist_ok=True)
+    version = _new_version(root)
+    tmp_dir = os.path.join(root, f".tmp-{version}")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    shutil.copytree(chroma_path, os.path.join(tmp_dir, "chroma_db"))
+    for path in sqlite_paths:
+        if os.path.exists(path):
+            _copy_sqlite(path, os.path.join(tmp_dir, os.path.basename(path)))
+    with open(os.path.join(tmp_dir, "fileToTitleAndUrl.json"), 'w') as f:
+        json.dump(fileToTitleAndUrl, f, ensure_ascii=False)
+    with open(os.path.join(tmp_dir, SNAPSHOT_INFO), 'w') as f:
+        json.dump(dict(info or {}, version=version, created=time.time()), f, ensure_ascii=False, indent=2)
+    os.rename(tmp_dir, os.path.join(root, version))
+
+    latest_tmp = os.path.join(root, f".{LATEST}.tmp")
+    with open(latest_tmp, 'w') as f:
+        f.write(version)
+    os.replace(latest_tmp, os.path.join(root, LATEST))
+
+    prune_snapshots(root, keep)
+    return version
+
+
+def _created(root, version):
+    try:
+        with open(os.path.join(root, version, SNAPSHOT_INFO)) as f:
+            return json.load(f)["created"]
+    except (OSError, ValueError, KeyError):
+        return os.path.getmtime(os.path.join(root, version))
+
+
+def prune_snapshots(root=snapshot_root, keep=snapshot_keep, grace_seconds=snapshot_grace_seconds):
+    """Delete all but the newest ``keep`` versions.
+
+    A version is only deleted once the version after it has been published
+    for ``grace_seconds``, so app processes that still have it open can
+    finish their queries and switch over first.
+    """
+    latest = latest_version(root)
+    versions = sorted(name for name in os.listdir(root)
+                      if not name.startswith(".") and os.path.isdir(os.path.join(root, name)))
+    now = time.time()
+    for i, version in enumerate(versions[:-keep] if keep else []):
+        if version == latest or now - _created(root, versions[i + 1]) < grace_seconds:
+            continue
+        shutil.rmtree(os.path.join(root, version), ignore_errors=True)
+
+
+def latest_version(root=snapshot_root):
+    """Version LATEST points at, or None before the first snapshot is published."""
+    try:
+        with open(os.path.join(root, LATEST)) as f:
+            version = f.read().strip()
+    except OSError:
+        return None
+    return version if version and os.path.isdir(os.path.join(root, version)) else None
+
+
+def snapshot_path(version, root=snapshot_root):
+    return os.path.join(root, version)
+
+
+def load_fileToTitleAndUrl(version, root=snapshot_root):
+    with open(os.path.join(root, version, "fileToTitleAndUrl.json")) as f:
+        return json.load(f)
@@ -0,0 +1,54 @@
+import time
+
+# 两次刷新之间至少间隔的秒数, 以及积压多少字符时提前刷新
+render_interval = 0.08
+render_max_pending = 200
+
+
+class StreamRenderer(object):
+    """Render a streamed answer into a Streamlit placeholder in batches.
+
+    Every Streamlit write re-sends the whole element, so writing once per
+    token is O(n²) traffic for an answer of n tokens. Tokens are buffered and
+    the placeholder is updated at most once per ``interval`` seconds, or
+    sooner when ``max_pending`` characters are waiting. ``close`` renders
+    whatever is left.
+    """
+
+    def __init__(self, container, interval=render_interval, max_pending=render_max_pending, clock=time.monotonic):
+        self.container = container
+        self.interval = interval
+        self.max_pending = max_pending
+        self.clock = clock
+        self.text = ""
+        self.updates = 0
+        self._pending = 0
+        self._last_flush = None
+
+    def write(self, chunk):
+        if not chunk:
+            return
+        self.text += chunk
+        self._pending += len(chunk)
+        now = self.clock()
+        # 第一个 token 马上显示, 首字延迟不受批量影响
+        if self._last_flush is None or self._pending >= self.max_pending or now - self._last_flush >= self.interval:
+            self.flush(now)
+
+    def flush(self, now=None):
+        if self._pending or self._last_flush is None:
+            self.container.write(self.text)
+            self.updates += 1
+        self._pending = 0
+        self._last_flush = self.clock() if now is None else now
+
+    def close(self):
+        if self._pending:
+            self.flush()
+        return self.text
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
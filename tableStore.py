@@ -0,0 +1,346 @@
+import os
+import re
+import json
+import sqlite3
+import hashlib
+import threading
+import pandas as pd
+from llama_index.core import Document
+from llama_index.core.readers.base import BaseReader
+
+from keywordIndex import tokenize
+
+table_db_path = "./tables.sqlite"
+# 每个 row group 文档包含的行数, 每个文档都重复一遍表头
+rows_per_document = 20
+# 一列里能转成数字的值超过这个比例就按数值列存
+numeric_ratio = 0.8
+# 读取同步下来的表格文件时 mmap 的上限
+sheet_file_mmap_size = 256 * 1024 * 1024
+# 判断问题是否涉及表格时, 每列最多取多少个不同的文本值
+table_term_values = 500
+
+_NUMERIC = re.compile(r"^[\d.,%\s]+$")
+# 同时含字母和数字的词, 例如 llama3-70b, a100
+_IDENTIFIER = re.compile(r"^(?=.*[a-z])(?=.*\d)")
+
+
+def _identifier(name):
+    # SQL 里用的表名/列名, 保留中文, 其它符号换成下划线
+    return re.sub(r"\W+", "_", str(name)).strip("_")
+
+
+def _is_blank(value):
+    return value is None or (isinstance(value, float) and pd.isna(value)) or (isinstance(value, str) and not value.strip())
+
+
+def sheet_title(file_path):
+    # "模型性能对比.xlsx.sqlite" -> "模型性能对比"
+    title = os.path.basename(str(file_path))
+    for suffix in (".sqlite", ".xlsx"):
+        if title.endswith(suffix):
+            title = title[:-len(suffix)]
+    return title
+
+
+def _cell(value):
+    # 飞书单元格可能是富文本片段 / 链接 / @人 等结构, 落盘前转成文本
+    if isinstance(value, list):
+        return "".join(str(_cell(v) or "") for v in value)
+    if isinstance(value, dict):
+        return value.get("text") or value.get("link") or value.get("name") or json.dumps(value, ensure_ascii=False)
+    return value
+
+
+class SheetFileWriter(object):
+    """Write a spreadsheet's cells to a SQLite file range by range, one table per sheet.
+
+    Ranges may arrive in any order; rows are keyed by their 1-based row number.
+    The file only replaces ``path`` on ``commit()``, so an interrupted download
+    never leaves a partial spreadsheet behind.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        self._columns = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.tmp_path, check_same_thread=False)
+        self._conn.execute("PRAGMA synchronous=OFF")
+        self._conn.execute("CREATE TABLE sheets (position INTEGER PRIMARY KEY, title TEXT NOT NULL)")
+
+    def add_sheet(self, position, title):
+        with self._lock:
+            self._conn.execute("INSERT INTO sheets (position, title) VALUES (?, ?)", (position, title))
+            self._conn.execute(f"CREATE TABLE s{position} (_row INTEGER PRIMARY KEY)")
+            self._columns[position] = 0
+
+    def write_rows(self, position, start_row, rows):
+        if not rows:
+            return
+        width = max(len(row or []) for row in rows)
+        with self._lock:
+            # 整表读取时事先不知道列数, 遇到更宽的行再加列
+            for i in range(self._columns[position], width):
+                self._conn.execute(f"ALTER TABLE s{position} ADD COLUMN c{i + 1}")
+            self._columns[position] = max(width, self._columns[position])
+            columns = ", ".join(["_row"] + [f"c{i + 1}" for i in range(width)])
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO s{position} ({columns}) VALUES ({', '.join('?' * (width + 1))})",
+                [[start_row + i] + [_cell(v) for v in (row or [])] + [None] * (width - len(row or []))
+                 for i, row in enumerate(rows)])
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        with self._lock:
+            self._conn.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def read_sheet_file(path):
+    """Return [(sheet title, raw cell frame)] from a file written by SheetFileWriter."""
+    conn = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+    try:
+        conn.execute(f"PRAGMA mmap_size={sheet_file_mmap_size}")
+        sheets = []
+        for position, title in conn.execute("SELECT position, title FROM sheets ORDER BY position").fetchall():
+            df = pd.read_sql_query(f"SELECT * FROM s{position} ORDER BY _row", conn)
+            sheets.append((title, df.drop(columns="_row")))
+        return sheets
+    finally:
+        conn.close()
+
+
+def normalize_frame(df):
+    """Turn raw sheet cells (no header) into a frame with a real header row and numeric columns."""
+    df = df.copy()
+    df.columns = range(df.shape[1])
+    # 旧版本同步下来的 xlsx 第一行是 DataFrame 的列号 0..n-1, 不是真正的表头
+    if len(df) and [str(v) for v in df.iloc[0]] == [str(i) for i in range(df.shape[1])]:
+        df = df.iloc[1:]
+    blank = df.apply(lambda col: col.map(_is_blank))
+    df = df.loc[~blank.all(axis=1), ~blank.all(axis=0)]
+    if df.empty:
+        return pd.DataFrame()
+
+    header, df = df.iloc[0], df.iloc[1:].reset_index(drop=True)
+    columns = []
+    for i, label in enumerate(header):
+        label = f"col_{i + 1}" if _is_blank(label) else str(label).strip()
+        while label in columns:
+            label += "_"
+        columns.append(label)
+    df.columns = columns
+
+    for column in columns:
+        values = df[column]
+        filled = values.map(lambda v: not _is_blank(v))
+        if not filled.any():
+            continue
+        numbers = pd.to_numeric(values.map(lambda v: v.replace(",", "").strip() if isinstance(v, str) else v), errors="coerce")
+        if numbers[filled].notna().sum() >= numeric_ratio * filled.sum():
+            df[column] = numbers
+        else:
+            df[column] = values.map(lambda v: None if _is_blank(v) else str(v))
+    return df
+
+
+def row_group_documents(title, sheet, df, table=None, extra_info=None):
+    """One Document per ``rows_per_document`` rows, each carrying the header so it stands on its own."""
+    docs = []
+    for start in range(0, len(df), rows_per_document):
+        rows = df.iloc[start:start + rows_per_document]
+        end = start + len(rows)
+        heading = f"{title} / {sheet} 第 {start + 1}-{end} 行 (共 {len(df)} 行)"
+        if table:
+            heading += f", SQL 表 {table}"
+        metadata = dict(extra_info or {}, sheet=sheet, rows=f"{start + 1}-{end}")
+        if table:
+            metadata["table"] = table
+        docs.append(Document(text=heading + "\n" + rows.to_csv(index=False), metadata=metadata))
+    return docs
+
+
+class TableStore(object):
+    """Spreadsheet sheets kept as SQLite tables, one table per sheet.
+
+    Numeric columns are stored as numbers so questions about benchmark sheets
+    can be answered with SQL filters and aggregates instead of by the LLM
+    reading flattened text. The ``sheet_tables`` registry maps tables back to
+    the file, sheet and original column labels they came from.
+    """
+
+    def __init__(self, path=table_db_path, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self._lock = threading.Lock()
+        if readonly:
+            # 发布出去的快照不可变, 只读打开, 不建表也不切 WAL, 不会在快照目录里留下 -wal/-shm
+            return
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sheet_tables ("
+                "name TEXT PRIMARY KEY, file_path TEXT NOT NULL, title TEXT, sheet TEXT, columns TEXT)")
+
+    def __getstate__(self):
+        # 解析进程池里的 ExcelReader 会带着 TableStore 一起 pickle, 锁不能跨进程
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self.readonly:
+            return sqlite3.connect(f"file:{os.path.abspath(self.path)}?mode=ro", uri=True, timeout=30)
+        return sqlite3.connect(self.path, timeout=30)
+
+    @staticmethod
+    def table_name(file_path, sheet):
+        title = sheet_title(file_path)
+        digest = hashlib.sha1(f"{os.path.abspath(file_path)}\0{sheet}".encode('utf-8')).hexdigest()[:6]
+        return f"{_identifier(title)[:40]}_{_identifier(sheet)[:20]}_{digest}"
+
+    def write_sheets(self, file_path, sheets, title=None):
+        """Replace every table of ``file_path`` with ``sheets`` ([(sheet title, normalized frame)]).
+
+        Returns [(table name, sheet title, frame)] for the sheets that have rows.
+        """
+        file_path = os.path.abspath(file_path)
+        title = title or sheet_title(file_path)
+        written = []
+        with self._lock, self._connect() as conn:
+            self._drop(conn, file_path)
+            for sheet, df in sheets:
+                if df.empty:
+                    continue
+                name = self.table_name(file_path, sheet)
+                columns = []
+                for label in df.columns:
+                    column = _identifier(label) or f"col_{len(columns) + 1}"
+                    while column in [c["name"] for c in columns]:
+                        column += "_"
+                    columns.append({"name": column, "label": label})
+                df.set_axis([c["name"] for c in columns], axis=1).to_sql(name, conn, if_exists="replace", index=False)
+                conn.execute(
+                    "INSERT OR REPLACE INTO sheet_tables (name, file_path, title, sheet, columns) VALUES (?, ?, ?, ?, ?)",
+                    (name, file_path, title, sheet, json.dumps(columns, ensure_ascii=False)))
+                written.append((name, sheet, df))
+        return written
+
+    def _drop(self, conn, file_path):
+        for (name,) in conn.execute("SELECT name FROM sheet_tables WHERE file_path=?", (file_path,)).fetchall():
+            conn.execute(f'DROP TABLE IF EXISTS "{name}"')
+        conn.execute("DELETE FROM sheet_tables WHERE file_path=?", (file_path,))
+
+    def remove_file(self, file_path):
+        with self._lock, self._connect() as conn:
+            self._drop(conn, os.path.abspath(file_path))
+
+    def tables(self):
+        """Return [{name, file_path, title, sheet, columns}] for every stored sheet."""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT name, file_path, title, sheet, columns FROM sheet_tables ORDER BY name").fetchall()
+        return [{"name": name, "file_path": file_path, "title": title, "sheet": sheet, "columns": json.loads(columns)}
+                for name, file_path, title, sheet, columns in rows]
+
+    def describe(self, table):
+        columns = ", ".join(f'{c["name"]} ({c["label"]})' if c["name"] != c["label"] else c["name"] for c in table["columns"])
+        return f'Sheet "{table["sheet"]}" of the spreadsheet "{table["title"]}". Columns: {columns}'
+
+    def query(self, sql, params=()):
+        with self._connect() as conn:
+            return pd.read_sql_query(sql, conn, params=params)
+
+    def terms(self, max_values=table_term_values):
+        """Lower-cased names a question mentions when it is about a stored table.
+
+        These are sheet titles and the text cell values (model and GPU names),
+        plus the identifier-like tokens inside them, so "Llama3-70B" matches
+        a row labelled "Llama3-70B Instruct". Column labels are left out
+        because words like "latency" or "batch" also appear in questions the
+        documents answer.
+        """
+        names = []
+        with self._connect() as conn:
+            for table in self.tables():
+                names.extend([table["title"] or "", table["sheet"] or ""])
+                for column in table["columns"]:
+                    names.extend(value for (value,) in conn.execute(
+                        f'SELECT DISTINCT "{column["name"]}" FROM "{table["name"]}" '
+                        f'WHERE typeof("{column["name"]}") = \'text\' LIMIT ?', (max_values,)))
+        terms = set()
+        for name in names:
+            name = name.strip().lower()
+            # 太短的和纯数字的词在普通问题里也常见, 不作为表格问题的信号
+            if len(name) >= 3 and not _NUMERIC.match(name):
+                terms.add(name)
+            terms.update(token for token in tokenize(name) if len(token) >= 3 and _IDENTIFIER.match(token))
+        return terms
+
+
+class ExcelReader(BaseReader):
+    """Read every sheet of a workbook into row-range Documents.
+
+    With a ``table_store`` the sheets are also written to it as SQL tables.
+    """
+
+    def __init__(self, table_store=None):
+        self.table_store = table_store
+
+    def read_sheets(self, file_path, fs=None):
+        if fs is not None:
+            # 上传的文件在内存文件系统里, 不落盘
+            with fs.open(str(file_path), 'rb') as f:
+                return pd.read_excel(f, sheet_name=None, header=None).items()
+        return pd.read_excel(file_path, sheet_name=None, header=None).items()
+
+    def load_data(self, file_path: str, extra_info: dict = None, fs=None):
+        title = sheet_title(file_path)
+        sheets = [(sheet, normalize_frame(df)) for sheet, df in self.read_sheets(file_path, fs)]
+        if self.table_store is not None:
+            tables = self.table_store.write_sheets(str(file_path), sheets, title=title)
+        else:
+            tables = [(None, sheet, df) for sheet, df in sheets if not df.empty]
+        docs = []
+        for table, sheet, df in tables:
+            docs.extend(row_group_documents(title, sheet, df, table=table, extra_info=extra_info))
+        return docs
+
+
+class SheetReader(ExcelReader):
+    """Read spreadsheets synced by WikiFetcher straight from their SQLite files, no Excel involved."""
+
+    def read_sheets(self, file_path, fs=None):
+        return read_sheet_file(file_path)
+
+
+def table_query_engine(store, llm=None, streaming=False):
+    """Text-to-SQL query engine over every table in ``store``, or None while the store is empty."""
+    from sqlalchemy import create_engine
+    from llama_index.core import SQLDatabase
+    from llama_index.core.query_engine import NLSQLTableQueryEngine
+
+    tables = store.tables()
+    if not tables:
+        return None
+    sql_database = SQLDatabase(create_engine(f"sqlite:///{os.path.abspath(store.path)}"),
+                               include_tables=[table["name"] for table in tables])
+    return NLSQLTableQueryEngine(
+        sql_database=sql_database,
+        tables=[table["name"] for table in tables],
+        context_query_kwargs={table["name"]: store.describe(table) for table in tables},
+        llm=llm,
+        streaming=streaming,
+    )
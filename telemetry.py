@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import uuid
+import queue
+import atexit
+import threading
+
+import requests
+
+# 设成本地的假收集器地址就可以在测试里拦截所有上报
+telemetry_endpoint = os.environ.get("QC_TELEMETRY_ENDPOINT", "https://api.smith.langchain.com")
+telemetry_flush_interval = 5.0
+telemetry_batch_size = 50
+telemetry_timeout = 10
+telemetry_spill_path = "./telemetry_spill.jsonl"
+telemetry_spill_max_bytes = 50 * 1024 * 1024
+# 上报失败后的重试间隔上限
+telemetry_max_backoff = 300.0
+
+
+class TelemetryQueue(object):
+    """Send LangSmith run updates and feedback from a background thread.
+
+    Calls only enqueue and return. The worker flushes every ``flush_interval``
+    seconds or as soon as ``batch_size`` items are waiting, reusing one HTTP
+    session; run updates go out together in one ``/runs/batch`` request per
+    batch, feedback (which has no batch endpoint) one request each. Items that cannot be delivered because the endpoint is down or
+    slow are appended to ``spill_path`` and replayed, oldest first, once it
+    answers again.
+    """
+
+    def __init__(self, api_key, endpoint=telemetry_endpoint, flush_interval=telemetry_flush_interval,
+                 batch_size=telemetry_batch_size, spill_path=telemetry_spill_path, timeout=telemetry_timeout):
+        self.endpoint = endpoint.rstrip("/")
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.spill_path = spill_path
+        self.timeout = timeout
+        self.sent = 0
+        self.spilled = 0
+        self.dropped = 0
+        self._session = requests.Session()
+        self._session.headers["x-api-key"] = api_key
+        self._queue = queue.Queue()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._retry_at = 0.0
+        self._backoff = flush_interval
+        self._thread = threading.Thread(target=self._run, name="telemetry", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def patch_run(self, run_id, **fields):
+        self._queue.put({"method": "PATCH", "path": f"/runs/{run_id}", "json": fields})
+
+    def create_feedback(self, run_id, key, score=None, comment=None):
+        self._queue.put({"method": "POST", "path": "/feedback", "json": {
+            "id": str(uuid.uuid4()), "run_id": str(run_id), "key": key, "score": score, "comment": comment,
+        }})
+
+    def _run(self):
+        while not self._stop.is_set():
+            deadline = time.monotonic() + self.flush_interval
+            while self._queue.qsize() < self.batch_size and not self._stop.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._stop.wait(min(remaining, 0.1))
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"telemetry flush failed: {e}")
+
+    def _drain(self):
+        items = []
+        while True:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                return items
+
+    def _read_spill(self):
+        if not os.path.exists(self.spill_path):
+            return []
+        with open(self.spill_path) as f:
+            items = [json.loads(line) for line in f if line.strip()]
+        os.remove(self.spill_path)
+        return items
+
+    def _spill(self, items):
+        size = os.path.getsize(self.spill_path) if os.path.exists(self.spill_path) else 0
+        with open(self.spill_path, "a") as f:
+            for item in items:
+                line = json.dumps(item, ensure_ascii=False) + "\n"
+                if size + len(line) > telemetry_spill_max_bytes:
+                    self.dropped += 1
+                    continue
+                f.write(line)
+                size += len(line)
+                self.spilled += 1
+
+    def _requests(self, items):
+        """Yield (items, request) with each batch's run updates merged into one /runs/batch request."""
+        for i in range(0, len(items), self.batch_size):
+            chunk = items[i:i + self.batch_size]
+            patches, others = [], []
+            for item in chunk:
+                (patches if item["method"] == "PATCH" and item["path"].startswith("/runs/") else others).append(item)
+            if patches:
+                yield patches, {"method": "POST", "path": "/runs/batch", "json": {
+                    "post": [],
+                    "patch": [dict(item["json"], id=item["path"][len("/runs/"):]) for item in patches],
+                }}
+            for item in others:
+                yield [item], item
+
+    def _send(self, item, count=1):
+        """True when delivered or permanently rejected, False when it should be retried later."""
+        try:
+            response = self._session.request(item["method"], self.endpoint + item["path"],
+                                             json=item["json"], timeout=self.timeout)
+        except requests.RequestException as e:
+            print(f"telemetry endpoint unavailable: {e}")
+            return False
+        if response.status_code == 429 or response.status_code >= 500:
+            return False
+        if response.status_code >= 400:
+            # 请求本身有问题, 重试也不会成功
+            print(f"telemetry {item['method']} {item['path']} rejected: {response.status_code} {response.text[:200]}")
+            self.dropped += count
+            return True
+        self.sent += count
+        return True
+
+    def flush(self):
+        """Send everything queued (and spilled earlier); spill what cannot be delivered now."""
+        with self._flush_lock:
+            items = self._drain()
+            if time.monotonic() < self._retry_at:
+                if items:
+                    self._spill(items)
+                return
+            batches = list(self._requests(self._read_spill() + items))
+            for i, (members, request) in enumerate(batches):
+                if not self._send(request, len(members)):
+                    self._spill([item for pending, _ in batches[i:] for item in pending])
+                    self._retry_at = time.monotonic() + self._backoff
+                    self._backoff = min(self._backoff * 2, telemetry_max_backoff)
+                    return
+            self._backoff = self.flush_interval
+
+    def close(self):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join(timeout=self.timeout)
+        # 退出前不再等重试间隔, 能发就发, 发不出去就落盘
+        self._retry_at = 0.0
+        self.flush()
+
+    def report(self):
+        return f"telemetry: {self.sent} sent, {self.spilled} spilled, {self.dropped} dropped, {self._queue.qsize()} queued"
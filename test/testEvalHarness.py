@@ -0,0 +1,73 @@
+import os
+import sys
+import json
+import tempfile
+import unittest
+import importlib.util
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from evalHarness import EvalRunner, case_id, extract_numbers, mock_backend, score_answer
+
+# test/testTableRetrieval.py 和根目录的同名脚本重名, 按路径加载
+_spec = importlib.util.spec_from_file_location(
+    "tableRetrievalEval", os.path.join(os.path.dirname(os.path.abspath(__file__)), "testTableRetrieval.py"))
+tableRetrievalEval = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(tableRetrievalEval)
+
+
+class ScoreTest(unittest.TestCase):
+    question = tableRetrievalEval.question("Llama3-8B", 128, 128)
+    expected = [41.2, 5273.6, 1.21, 1.48, 2.95]
+
+    def test_exact_answer(self):
+        self.assertEqual(score_answer(self.expected, "41.2, 5,273.6, 1.21, 1.48, 2.95", question=self.question), (5, 0))
+
+    def test_echoed_question_numbers_do_not_count(self):
+        answer = "Input 128, output 128: Batch=1 1.21, Batch=8 1.48, Batch=64 2.95"
+        self.assertEqual(score_answer(self.expected, answer, question=self.question), (3, 2))
+
+    def test_hyphen_in_identifier_is_not_a_minus(self):
+        self.assertEqual(extract_numbers("llama-7b on a100: -3.5, 延迟为1.21秒"), [-3.5, 1.21])
+        self.assertEqual(score_answer([-7.0], "llama-7b"), (0, 1))
+
+    def test_matched_in_order_and_one_to_one(self):
+        self.assertEqual(score_answer([1.0, 2.0], "2.0, 1.0"), (1, 1))
+        self.assertEqual(score_answer([1.5, 1.5], "1.5"), (1, 1))
+        self.assertEqual(score_answer([1.5, 3.0], "1.5, 9, 3.0"), (2, 0))
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.checkpoint = os.path.join(tempfile.mkdtemp(), "eval.jsonl")
+        self.asked = []
+        self.answer = mock_backend()
+
+    def ask(self, case):
+        self.asked.append(case["id"])
+        return self.answer(case)
+
+    def test_mock_run_over_fixture_sheet(self):
+        summary = tableRetrievalEval.main("xlsx", "mock", checkpoint=self.checkpoint)
+        self.assertEqual(summary["cases"], 6)
+        self.assertEqual(summary["accuracy"], 1.0)
+
+    def test_resume_skips_finished_cases(self):
+        cases = [{"id": case_id(f"q{i}", [i + 0.5]), "question": f"q{i}", "expected": [i + 0.5]} for i in range(4)]
+        EvalRunner(self.ask, self.checkpoint).run(cases[:2])
+        summary = EvalRunner(self.ask, self.checkpoint).run(cases)
+        self.assertEqual(sorted(self.asked), sorted(case["id"] for case in cases))
+        self.assertEqual((summary["cases"], summary["hits"]), (4, 4))
+
+    def test_mismatched_checkpoint_results_are_rerun(self):
+        # 另一份表格的结果: id 一样, 题目和期望值不一样
+        with open(self.checkpoint, "w") as f:
+            f.write(json.dumps({"id": "0", "question": "old question", "expected": [1.0],
+                                "answer": "1.0", "hits": 1, "misses": 0, "latency": 0.1}) + "\n")
+        cases = [{"id": "0", "question": "new question", "expected": [2.5]}]
+        summary = EvalRunner(self.ask, self.checkpoint).run(cases)
+        self.assertEqual(self.asked, ["0"])
+        self.assertEqual((summary["hits"], summary["misses"]), (1, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import unittest
+
+import chromadb
+from llama_index.core import Document, VectorStoreIndex
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.vector_stores.chroma import ChromaVectorStore
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from deltaIndex import DOC_HASH_KEY
+from ingestPipeline import IngestPipeline
+from keywordIndex import KeywordIndex
+
+
+class FetchStats(object):
+    started = None
+    finished = None
+
+    def report(self):
+        return "fetched"
+
+
+class LocalFetcher(object):
+    # 不访问飞书, 直接把节点内容写成本地文件
+    workers = 2
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.stats = FetchStats()
+
+    async def fetch_node(self, session, node):
+        path = os.path.join(self.directory, node["obj_token"] + ".txt")
+        with open(path, "w") as f:
+            f.write(node["text"])
+        return node, path, True
+
+
+def load_file(path):
+    with open(path) as f:
+        text = f.read()
+    return [Document(text=text, id_=path, metadata={"file_path": os.path.abspath(path), "file_name": "https://wiki/" + os.path.basename(path)})]
+
+
+class LegacyChunkTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        client = chromadb.EphemeralClient()
+        self.collection = client.get_or_create_collection(f"wiki-{time.time_ns()}")
+        embed_model = MockEmbedding(embed_dim=8)
+        self.index = VectorStoreIndex.from_vector_store(ChromaVectorStore(chroma_collection=self.collection),
+                                                        embed_model=embed_model)
+        self.keywords = KeywordIndex(os.path.join(self.directory, "keywords.sqlite"))
+
+    def test_chunks_without_path_or_hash_are_removed(self):
+        # 升级前的部署: chunk 只有 file_name (url) 和随机 id
+        self.collection.add(ids=["legacy-1", "legacy-2"], embeddings=[[0.1] * 8, [0.2] * 8],
+                            documents=["cht830 old copy", "llama old copy"],
+                            metadatas=[{"file_name": "https://wiki/doc1"}, {"file_name": "https://wiki/doc2"}])
+        self.keywords.sync_with_collection(self.collection)
+
+        nodes = [{"obj_token": "doc1", "text": "cht830 throughput table"}, {"obj_token": "doc2", "text": "llama latency notes"}]
+        pipeline = IngestPipeline(LocalFetcher(self.directory), self.index, self.collection, load_file,
+                                  transformations=[SentenceSplitter()], parse_workers=2, keyword_index=self.keywords)
+        asyncio.run(pipeline.run(nodes))
+
+        stored = self.collection.get(include=["metadatas"])
+        self.assertNotIn("legacy-1", stored["ids"])
+        self.assertNotIn("legacy-2", stored["ids"])
+        self.assertEqual(len(stored["ids"]), 2)
+        for metadata in stored["metadatas"]:
+            self.assertIn("file_path", metadata)
+            self.assertIn(DOC_HASH_KEY, metadata)
+        self.assertEqual(self.keywords.node_ids(), set(stored["ids"]))
+
+        # 再同步一次, 内容没变就什么都不动
+        again = IngestPipeline(LocalFetcher(self.directory), self.index, self.collection, load_file,
+                               transformations=[SentenceSplitter()], parse_workers=2, keyword_index=self.keywords)
+        stats = asyncio.run(again.run(nodes))
+        self.assertEqual(stats.skipped, 2)
+        self.assertEqual(self.collection.get()["ids"], stored["ids"])
+
+
+if __name__ == "__main__":
+    unittest.main()
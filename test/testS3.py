@@ -0,0 +1,58 @@
+import os
+import sys
+import tempfile
+import unittest
+import importlib.util
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+has_moto = importlib.util.find_spec("moto") is not None
+
+
+@unittest.skipUnless(has_moto, "moto is not installed")
+class LocalS3Test(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from moto.server import ThreadedMotoServer
+
+        cls.server = ThreadedMotoServer(ip_address="127.0.0.1", port=0)
+        cls.server.start()
+        host, port = cls.server.get_host_and_port()
+        # upsertS3 在 import 时读取 st.secrets 和 QC_S3_ENDPOINT
+        cls.cwd = os.getcwd()
+        workdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(workdir, ".streamlit"))
+        with open(os.path.join(workdir, ".streamlit", "secrets.toml"), "w") as f:
+            f.write('aws_access_key = "testing"\naws_secret_key = "testing"\n')
+        os.chdir(workdir)
+        os.environ["QC_S3_ENDPOINT"] = f"http://127.0.0.1:{port}"
+        global upsertS3
+        import upsertS3
+        upsertS3 = importlib.reload(upsertS3)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.environ.pop("QC_S3_ENDPOINT", None)
+        os.chdir(cls.cwd)
+        cls.server.stop()
+
+    def test_upload_bytes_and_presigned_urls(self):
+        self.assertTrue(upsertS3.create_bucket("uploads"))
+        files = {"a.txt": b"hello", "b.md": b"# title\n" * 1000}
+        for name, data in files.items():
+            self.assertTrue(upsertS3.upload_bytes(data, "uploads", name))
+
+        urls = upsertS3.create_presigned_urls("uploads", list(files), expiration=60)
+        self.assertEqual(sorted(urls), sorted(files))
+        for name, url in urls.items():
+            self.assertTrue(url.startswith(os.environ["QC_S3_ENDPOINT"]))
+            with urllib.request.urlopen(url) as response:
+                self.assertEqual(response.read(), files[name])
+
+    def test_upload_to_missing_bucket_fails(self):
+        self.assertFalse(upsertS3.upload_bytes(b"x", "no-such-bucket", "x.txt"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,26 +1,18 @@
-import pandas as pd
-from openai import OpenAI
 import os
-import streamlit as st
-
-os.environ["OPENAI_API_BASE"] = ""
-os.environ["OPENAI_API_KEY"] = st.secrets.openai_key
-openai_client = OpenAI()
-openai_assistant = openai_client.beta.assistants.create(
-  name="Financial Analyst Assistant",
-  instructions="You are an expert ai infra analyst. Use your knowledge base to answer questions about ai model/hardware performance.",
-  model="gpt-4o",
-  tools=[{"type": "code_interpreter"},{"type": "file_search"}]
-)
-
-import anthropic
+import sys
+import argparse
+import pandas as pd
+from tqdm import tqdm
 
-anthropic_client = anthropic.Anthropic(
-    # defaults to os.environ.get("ANTHROPIC_API_KEY")
-    api_key=st.secrets.claude_key,
-)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from evalHarness import EvalRunner, case_id, mock_backend
 
 excel_file_path = 'sheets/模型性能对比.xlsx'
+# mock 后端默认用仓库里的小表, CI 不需要真实的性能表
+fixture_excel_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', '模型性能对比.xlsx')
+expected_columns = ['Throughput（requests/s)', 'Throughput（tokens/s)', 'Avg latency（Batch=1）', 'Avg latency（Batch=8）', 'Avg latency（Batch=64）']
+# 每个后端同时在跑的问题数, 按各家的限流调
+backend_concurrency = {"gpt4o": 4, "claude3.5sonnet": 4, "mock": 16}
 '''
 create_file_response = openai_client.files.create(
     file=open(excel_file_path, 'rb'),
@@ -33,17 +25,58 @@ if create_file_response:
 '''
 
 
-def test_function_performance(model_type, model, input_len, output_len, throughput_requests, throughput_tokens, avg_latency_batch1, avg_latency_batch8, avg_latency_batch64, md_table="", message_file=None):
+def question(model, input_len, output_len):
     ch_question = f'{model}模型输入长度为{input_len}输出长度为{output_len}时吞吐量(request/s)，吞吐量(tokens/s)，batch是1、8、64的平均延迟分别是多少? 只返回最终答案数字[Throughput（requests/s), Throughput（tokens/s), Avg latency（Batch=1）, Avg latency（Batch=8）, Avg latency（Batch=64）]'
     en_question = f'With input leng {input_len}, output length {output_len}, what are the Throughput（requests/s), Throughput（tokens/s), Avg latency（Batch=1）, Avg latency（Batch=8）, Avg latency（Batch=64）for {model}? Only return the numbers'
-
-    if model_type=="gpt4o":
+    return en_question
+
+
+def load_cases(df):
+    # 假设Excel文件中有以下列：Model, Input, Output, Throughput_Requests, Throughput_Tokens, Avg_Latency_Batch1, Avg_Latency_Batch8, Avg_Latency_Batch64
+    cases = []
+    for _, row in df.iterrows():
+        text = question(row['Model'], row['Input'], row['Output'])
+        expected = [float(row[column]) for column in expected_columns]
+        cases.append({"id": case_id(text, expected), "question": text, "expected": expected})
+    return cases
+
+
+def openai_backend(table_file_path):
+    import streamlit as st
+    from openai import OpenAI
+
+    os.environ["OPENAI_API_BASE"] = ""
+    os.environ["OPENAI_API_KEY"] = st.secrets.openai_key
+    openai_client = OpenAI()
+    # Create a vector store caled "Financial Statements"
+    vector_store = openai_client.beta.vector_stores.create(name="Model Performances")
+    # Upload the user provided file to OpenAI
+    message_file = openai_client.files.create(
+      file=open(table_file_path, "rb"), purpose="assistants"
+    )
+    print(f'provided {message_file.id} to openai')
+    openai_assistant = openai_client.beta.assistants.create(
+      name="Financial Analyst Assistant",
+      instructions="You are an expert ai infra analyst. Use your knowledge base to answer questions about ai model/hardware performance.",
+      model="gpt-4o",
+      tools=[{"type": "code_interpreter"},{"type": "file_search"}],
+      tool_resources={
+          "file_search": {
+              "vector_store_ids": [vector_store.id]
+          },
+          "code_interpreter": {
+            "file_ids": [message_file.id]
+          }
+      },
+    )
+
+    def ask(case):
         # Create a thread and attach the file to the message
         thread = openai_client.beta.threads.create(
           messages=[
             {
               "role": "user",
-              "content": en_question,
+              "content": case["question"],
               "attachments": [
                 {
                   "file_id": message_file.id,
@@ -53,105 +86,97 @@ def test_function_performance(model_type, model, input_len, output_len, throughp
             }
           ]
         )
-
-
         run = openai_client.beta.threads.runs.create_and_poll(
             thread_id=thread.id, assistant_id=openai_assistant.id
         )
-
         messages = list(openai_client.beta.threads.messages.list(thread_id=thread.id, run_id=run.id))
+        usage = run.usage
+        return {
+            "answer": messages[0].content[0].text.value,
+            "prompt_tokens": usage.prompt_tokens if usage else None,
+            "completion_tokens": usage.completion_tokens if usage else None,
+        }
+
+    return ask
+
+
+def claude_backend(md_table):
+    import anthropic
+    import streamlit as st
 
-        message_content = messages[0].content[0].text
-        msg = message_content.value
-    elif model_type=="claude3.5sonnet":
+    anthropic_client = anthropic.Anthropic(
+        # defaults to os.environ.get("ANTHROPIC_API_KEY")
+        api_key=st.secrets.claude_key,
+    )
+
+    def ask(case):
         message = anthropic_client.messages.create(
             model="claude-3-sonnet-20240229",
             max_tokens=1024,
             messages=[
-                {"role": "user", "content": md_table+"\n"+en_question}
+                {"role": "user", "content": md_table+"\n"+case["question"]}
             ]
         )
-        msg = message.content[0].text
-        
-    cur_hit = sum([str(throughput_requests) in msg, str(throughput_tokens) in msg, str(avg_latency_batch1) in msg, str(avg_latency_batch8) in msg, str(avg_latency_batch64) in msg])      
-    return cur_hit, 5-cur_hit
-
-def main(file_type, model_type):
-  # Ready the files for upload to LLM 
-  df = pd.read_excel(excel_file_path)
-  md_table = ""
-  message_file = None
-  
+        return {
+            "answer": message.content[0].text,
+            "prompt_tokens": message.usage.input_tokens,
+            "completion_tokens": message.usage.output_tokens,
+        }
+
+    return ask
+
+
+def main(file_type, model_type, checkpoint=None, concurrency=None, excel=None):
+  excel = excel or (fixture_excel_path if model_type == "mock" else excel_file_path)
+  # Ready the files for upload to LLM
+  df = pd.read_excel(excel)
+  md_table = df.to_markdown(tablefmt="grid") if file_type=="md" else ""
+  table_file_path = excel
+
   if file_type=="md":
-      md_file_path = excel_file_path.split('.xlsx')[0]+'.md'
-      md_table = df.to_markdown(tablefmt="grid")
-      with open(md_file_path, 'w') as file:
+      table_file_path = excel.split('.xlsx')[0]+'.md'
+      with open(table_file_path, 'w') as file:
           file.write(md_table)
   elif file_type=="csv":
-      csv_file_path = excel_file_path.split('.xlsx')[0]+'.csv'
-      csv_table = df.to_csv()
-      with open(csv_file_path, 'w') as file:
-          file.write(csv_table)
-    
+      table_file_path = excel.split('.xlsx')[0]+'.csv'
+      with open(table_file_path, 'w') as file:
+          file.write(df.to_csv())
+
   if model_type=="gpt4o":
-      # Create a vector store caled "Financial Statements"
-      vector_store = openai_client.beta.vector_stores.create(name="Model Performances")
-      # Upload the user provided file to OpenAI
-      message_file = openai_client.files.create(
-        file=open(md_file_path, "rb"), purpose="assistants"
-      )
-
-      print(f'provided {message_file.id} to openai')
-
-      openai_assistant = openai_client.beta.assistants.update(
-        assistant_id=openai_assistant.id,
-        tool_resources={
-            "file_search": {
-                "vector_store_ids": [vector_store.id]
-            },
-            "code_interpreter": {
-              "file_ids": [message_file.id]
-            }
-        },
-      )
-  # elif model_type=="claude3.5sonnet":
-
-  
-  # 假设Excel文件中有以下列：Model, Input, Output, Throughput_Requests, Throughput_Tokens, Avg_Latency_Batch1, Avg_Latency_Batch8, Avg_Latency_Batch64
-  # 使用DataFrame中的数据测试函数
-  hit = 0
-  miss = 0
-  from tqdm import tqdm
-  for index, row in tqdm(df.iterrows()):
-      model = row['Model']
-      input_len = row['Input']
-      output_len = row['Output']
-      throughput_requests = row['Throughput（requests/s)']
-      throughput_tokens = row['Throughput（tokens/s)']
-      avg_latency_batch1 = row['Avg latency（Batch=1）']
-      avg_latency_batch8 = row['Avg latency（Batch=8）']
-      avg_latency_batch64 = row['Avg latency（Batch=64）']
-      cur_hit, cur_miss = test_function_performance(model_type, model, input_len, output_len, throughput_requests, throughput_tokens, avg_latency_batch1, avg_latency_batch8, avg_latency_batch64, md_table, message_file)
-      hit += cur_hit
-      miss += cur_miss
-
-  print(f'accuracy: {hit/(hit+miss)}')
-  
-import argparse
-parser = argparse.ArgumentParser(description="Process some files with a specified model.")
-parser.add_argument(
-    '-f', '--file_type', 
-    type=str, 
-    required=True, 
-    help='Specify the type of the file (csv, md, xlsx).'
-)
-parser.add_argument(
-    '-m', '--model', 
-    type=str, 
-    required=True, 
-    help='Specify the model to use (gpt4o, claude3.5sonnet).'
-)
-args = parser.parse_args()
+      ask = openai_backend(table_file_path)
+  elif model_type=="claude3.5sonnet":
+      ask = claude_backend(md_table)
+  else:
+      # 离线跑通流程用, CI 里不需要任何 key
+      ask = mock_backend()
+
+  cases = load_cases(df)
+  checkpoint = checkpoint or f'eval/{model_type}-{file_type}.jsonl'
+  runner = EvalRunner(ask, checkpoint, concurrency=concurrency or backend_concurrency.get(model_type, 4))
+  with tqdm(total=len(cases)) as progress:
+      summary = runner.run(cases, progress)
+
+  print(f'accuracy: {summary["accuracy"]}')
+  print(summary)
+  return summary
+
 
 if __name__ == "__main__":
-    main(args.file_type, args.model)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Process some files with a specified model.")
+    parser.add_argument(
+        '-f', '--file_type',
+        type=str,
+        required=True,
+        help='Specify the type of the file (csv, md, xlsx).'
+    )
+    parser.add_argument(
+        '-m', '--model',
+        type=str,
+        required=True,
+        help='Specify the model to use (gpt4o, claude3.5sonnet, mock).'
+    )
+    parser.add_argument('--checkpoint', type=str, default=None, help='JSONL checkpoint; rerun with the same file to resume.')
+    parser.add_argument('--concurrency', type=int, default=None, help='Questions in flight at once for this backend.')
+    parser.add_argument('--excel', type=str, default=None, help=f'Benchmark sheet; defaults to {excel_file_path}, or the test fixture for the mock backend.')
+    args = parser.parse_args()
+    main(args.file_type, args.model, args.checkpoint, args.concurrency, args.excel)
@@ -0,0 +1,89 @@
+import os
+import sys
+import json
+import tempfile
+import unittest
+import importlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import telemetry
+
+
+class Collector(object):
+    """Local stand-in for the LangSmith API that records every request."""
+
+    def __init__(self):
+        self.requests = []
+        self.status = 200
+        collector = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _handle(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                collector.requests.append((self.command, self.path, json.loads(body or "null")))
+                self.send_response(collector.status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            do_POST = do_PATCH = _handle
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TelemetryQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.collector = Collector()
+        self.addCleanup(self.collector.stop)
+        # 上报地址只从环境变量读, 测试里指向本地收集器
+        os.environ["QC_TELEMETRY_ENDPOINT"] = self.collector.url
+        self.addCleanup(os.environ.pop, "QC_TELEMETRY_ENDPOINT")
+        importlib.reload(telemetry)
+        self.spill_path = os.path.join(tempfile.mkdtemp(), "spill.jsonl")
+        # 刷新间隔设得很长, 由测试手动 flush
+        self.queue = telemetry.TelemetryQueue("key", flush_interval=3600, spill_path=self.spill_path)
+        self.addCleanup(self.queue.close)
+
+    def test_run_updates_are_sent_in_one_batch(self):
+        for i in range(3):
+            self.queue.patch_run(f"run-{i}", outputs={"my_output": str(i)})
+        self.queue.create_feedback("run-0", key="user-score", score=1.0)
+        self.queue.flush()
+
+        batches = [body for method, path, body in self.collector.requests if path == "/runs/batch"]
+        self.assertEqual(len(batches), 1)
+        self.assertEqual([run["id"] for run in batches[0]["patch"]], ["run-0", "run-1", "run-2"])
+        self.assertEqual(batches[0]["patch"][1]["outputs"], {"my_output": "1"})
+        feedback = [body for method, path, body in self.collector.requests if path == "/feedback"]
+        self.assertEqual([(item["run_id"], item["score"]) for item in feedback], [("run-0", 1.0)])
+        self.assertEqual(self.queue.sent, 4)
+
+    def test_undelivered_items_are_spilled_and_replayed(self):
+        self.collector.status = 503
+        self.queue.patch_run("run-0", outputs={})
+        self.queue.create_feedback("run-0", key="user-score", score=0.0)
+        self.queue.flush()
+        self.assertEqual(self.queue.spilled, 2)
+        self.assertTrue(os.path.exists(self.spill_path))
+
+        self.collector.status = 200
+        self.collector.requests.clear()
+        self.queue._retry_at = 0.0
+        self.queue.flush()
+        self.assertEqual(sorted(path for _, path, _ in self.collector.requests), ["/feedback", "/runs/batch"])
+        self.assertEqual(self.queue.sent, 2)
+        self.assertFalse(os.path.exists(self.spill_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import sys
+import json
+import asyncio
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchStubs import FeishuStub, Reply
+from wikiSync import SyncManifest, local_path
+import listAllWiki
+from listAllWiki import IncompleteCrawl, WikiCrawler, get_all_wiki_nodes
+
+fixture_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench", "wiki.json")
+
+
+class FlakyFeishu(FeishuStub):
+    # 指定父节点的子节点列表先失败 fail_times 次, status 决定是暂时性错误还是永久错误
+    def __init__(self, dump, parent, status, fail_times):
+        super().__init__(dump)
+        self.parent = parent
+        self.status = status
+        self.fail_times = fail_times
+
+    def synthesize(self, route, method, path, query, payload):
+        if route == "wiki_nodes" and query.get("parent_node_token", [None])[0] == self.parent and self.fail_times:
+            self.fail_times -= 1
+            return Reply.json({"code": 1, "msg": "injected failure"}, status=self.status)
+        return super().synthesize(route, method, path, query, payload)
+
+
+class CrawlTest(unittest.TestCase):
+    def setUp(self):
+        with open(fixture_path) as f:
+            self.dump = json.load(f)
+        self.parent = "wikcnBenchOps00001"
+
+    def serve(self, status, fail_times):
+        stub = FlakyFeishu(self.dump, self.parent, status, fail_times).start()
+        self.addCleanup(stub.stop)
+        endpoint = listAllWiki.FEISHU_OPENAPI_ENDPOINT
+        listAllWiki.FEISHU_OPENAPI_ENDPOINT = f"{stub.url}/open-apis/wiki/v2/spaces"
+        self.addCleanup(setattr, listAllWiki, "FEISHU_OPENAPI_ENDPOINT", endpoint)
+        return stub
+
+    def test_failed_subtree_raises_incomplete(self):
+        self.serve(403, fail_times=1)
+        with self.assertRaises(IncompleteCrawl) as raised:
+            asyncio.run(get_all_wiki_nodes(self.dump["space_id"], "t-test", concurrency=4))
+        crawled = {node["node_token"] for node in raised.exception.nodes}
+        children = {node["node_token"] for node in self.dump["nodes"] if node.get("parent_node_token") == self.parent}
+        self.assertIn(self.parent, crawled)
+        self.assertFalse(crawled & children)
+
+    def test_5xx_is_retried(self):
+        self.serve(502, fail_times=2)
+
+        async def crawl():
+            crawler = WikiCrawler(self.dump["space_id"], "t-test", concurrency=4, backoff=0.01)
+            nodes = [node async for node in crawler.crawl()]
+            return nodes, crawler.stats
+
+        nodes, stats = asyncio.run(crawl())
+        self.assertEqual(len(nodes), len(self.dump["nodes"]))
+        self.assertEqual(stats.retries, 2)
+        self.assertEqual(stats.failures, 0)
+
+
+class PlanTest(unittest.TestCase):
+    def test_incomplete_crawl_deletes_nothing(self):
+        directory = tempfile.mkdtemp()
+        manifest = SyncManifest(os.path.join(directory, "manifest.json"))
+        nodes = [{"obj_token": f"dox{i}", "obj_type": "docx", "title": f"doc{i}", "obj_edit_time": "1"} for i in range(3)]
+        for node in nodes:
+            path = local_path(directory, node)
+            with open(path, "w") as f:
+                f.write(node["title"])
+            manifest.record(node, path)
+
+        # 一个子树没爬到, 只看到了第一个节点
+        changed, unchanged, vanished = manifest.plan(nodes[:1], directory, complete=False)
+        self.assertEqual((changed, len(unchanged), vanished), ([], 1, []))
+
+        changed, unchanged, vanished = manifest.plan(nodes[:1], directory)
+        self.assertEqual(sorted(token for token, _ in vanished), ["dox1", "dox2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
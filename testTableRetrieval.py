@@ -79,16 +79,13 @@ assistant = client.beta.assistants.update(
 )
 
 
-def test_function_performance(model, input_len, output_len, throughput_requests, throughput_tokens, avg_latency_batch1, avg_latency_batch8, avg_latency_batch64):
-    ch_question = f'{model}模型输入长度为{input_len}输出长度为{output_len}时吞吐量(request/s)，吞吐量(tokens/s)，batch是1、8、64的平均延迟分别是多少? 只返回最终答案数字[Throughput（requests/s), Throughput（tokens/s), Avg latency（Batch=1）, Avg latency（Batch=8）, Avg latency（Batch=64）]'
-    en_question = f'With input leng {input_len}, output length {output_len}, what are the Throughput（requests/s), Throughput（tokens/s), Avg latency（Batch=1）, Avg latency（Batch=8）, Avg latency（Batch=64）for {model}? Only return the numbers'
-
+def test_function_performance(case):
     # Create a thread and attach the file to the message
     thread = client.beta.threads.create(
       messages=[
         {
           "role": "user",
-          "content": en_question,
+          "content": case["question"],
           "attachments": [
             {
               "file_id": message_file.id,
@@ -107,26 +104,32 @@ def test_function_performance(model, input_len, output_len, throughput_requests,
     messages = list(client.beta.threads.messages.list(thread_id=thread.id, run_id=run.id))
 
     message_content = messages[0].content[0].text
-    msg = message_content.value
-    cur_hit = sum([str(throughput_requests) in msg, str(throughput_tokens) in msg, str(avg_latency_batch1) in msg, str(avg_latency_batch8) in msg, str(avg_latency_batch64) in msg])
-    return cur_hit, 5-cur_hit
+    return {
+        "answer": message_content.value,
+        "prompt_tokens": run.usage.prompt_tokens if run.usage else None,
+        "completion_tokens": run.usage.completion_tokens if run.usage else None,
+    }
 
 # 假设Excel文件中有以下列：Model, Input, Output, Throughput_Requests, Throughput_Tokens, Avg_Latency_Batch1, Avg_Latency_Batch8, Avg_Latency_Batch64
 # 使用DataFrame中的数据测试函数
-hit = 0
-miss = 0
 from tqdm import tqdm
-for index, row in tqdm(df.iterrows()):
+from evalHarness import EvalRunner, case_id
+
+cases = []
+for _, row in df.iterrows():
     model = row['Model']
     input_len = row['Input']
     output_len = row['Output']
-    throughput_requests = row['Throughput（requests/s)']
-    throughput_tokens = row['Throughput（tokens/s)']
-    avg_latency_batch1 = row['Avg latency（Batch=1）']
-    avg_latency_batch8 = row['Avg latency（Batch=8）']
-    avg_latency_batch64 = row['Avg latency（Batch=64）']
-    cur_hit, cur_miss = test_function_performance(model, input_len, output_len, throughput_requests, throughput_tokens, avg_latency_batch1, avg_latency_batch8, avg_latency_batch64)
-    hit += cur_hit
-    miss += cur_miss
-
-print(f'accuracy: {hit/(hit+miss)}')
\ No newline at end of file
+    ch_question = f'{model}模型输入长度为{input_len}输出长度为{output_len}时吞吐量(request/s)，吞吐量(tokens/s)，batch是1、8、64的平均延迟分别是多少? 只返回最终答案数字[Throughput（requests/s), Throughput（tokens/s), Avg latency（Batch=1）, Avg latency（Batch=8）, Avg latency（Batch=64）]'
+    en_question = f'With input leng {input_len}, output length {output_len}, what are the Throughput（requests/s), Throughput（tokens/s), Avg latency（Batch=1）, Avg latency（Batch=8）, Avg latency（Batch=64）for {model}? Only return the numbers'
+    expected = [float(row['Throughput（requests/s)']), float(row['Throughput（tokens/s)']), float(row['Avg latency（Batch=1）']),
+                float(row['Avg latency（Batch=8）']), float(row['Avg latency（Batch=64）'])]
+    cases.append({"id": case_id(en_question, expected), "question": en_question, "expected": expected})
+
+# 并发跑, 每题结果写进 checkpoint, 中断后重跑会跳过已完成的题
+runner = EvalRunner(test_function_performance, 'eval/gpt4o-assistant.jsonl', concurrency=4)
+with tqdm(total=len(cases)) as progress:
+    summary = runner.run(cases, progress)
+
+print(f'accuracy: {summary["accuracy"]}')
+print(summary)
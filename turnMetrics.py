@@ -0,0 +1,208 @@
+import os
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from llama_index.core import Settings
+
+metrics_port = int(os.environ.get("QC_METRICS_PORT", "9464"))
+# /metrics 没有鉴权, 默认只监听本机, 需要被 Prometheus 抓取时再设成 0.0.0.0
+metrics_host = os.environ.get("QC_METRICS_HOST", "127.0.0.1")
+# 直方图的桶 (秒)
+latency_buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0)
+
+_current_turn = contextvars.ContextVar("current_turn", default=None)
+
+
+def count_tokens(text):
+    return len(Settings.tokenizer(text)) if text else 0
+
+
+class TurnMetrics(object):
+    """Timings and counts for answering one chat turn.
+
+    Shared components report into the turn that is active in the calling
+    thread through the module-level ``stage`` and ``add`` helpers, so the
+    same query engine can serve many sessions at once. ``prompt_tokens`` is
+    estimated from the question and the retrieved context; the prompt
+    template itself is not counted.
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.started = clock()
+        self.stages = {}
+        self.counts = {"retrieved_nodes": 0, "cited_nodes": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        self.ttft = None
+        self.tokens_per_second = None
+        self.total = None
+        self._first_token = None
+
+    @contextmanager
+    def active(self):
+        token = _current_turn.set(self)
+        try:
+            yield self
+        finally:
+            _current_turn.reset(token)
+
+    def add_stage(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def token(self):
+        if self._first_token is None:
+            self._first_token = self.clock()
+            self.ttft = self._first_token - self.started
+
+    def finish(self, answer):
+        now = self.clock()
+        self.total = now - self.started
+        self.counts["completion_tokens"] = count_tokens(answer)
+        if self._first_token is not None and now > self._first_token:
+            self.tokens_per_second = self.counts["completion_tokens"] / (now - self._first_token)
+
+    def as_dict(self):
+        return {
+            "stages": {name: round(seconds, 4) for name, seconds in self.stages.items()},
+            "ttft": round(self.ttft, 4) if self.ttft is not None else None,
+            "total": round(self.total, 4) if self.total is not None else None,
+            "tokens_per_second": round(self.tokens_per_second, 2) if self.tokens_per_second is not None else None,
+            **self.counts,
+        }
+
+
+@contextmanager
+def stage(name):
+    """Time a block into the active turn's ``name`` stage; a no-op outside a turn."""
+    turn = _current_turn.get()
+    if turn is None:
+        yield
+        return
+    started = turn.clock()
+    try:
+        yield
+    finally:
+        turn.add_stage(name, turn.clock() - started)
+
+
+def add(name, value):
+    turn = _current_turn.get()
+    if turn is not None:
+        turn.counts[name] = turn.counts.get(name, 0) + value
+
+
+class Histogram(object):
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{_labels(labels, le=bound)} {cumulative}'
+        yield f'{name}_bucket{_labels(labels, le="+Inf")} {self.count}'
+        yield f'{name}_sum{_labels(labels)} {self.sum}'
+        yield f'{name}_count{_labels(labels)} {self.count}'
+
+
+def _labels(labels, **extra):
+    items = list(labels.items()) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join('%s="%s"' % (key, str(value).replace('"', '\\"')) for key, value in items) + "}"
+
+
+class MetricsRegistry(object):
+    """Process-wide aggregates of finished turns, rendered in Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    def _histogram(self, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self._histograms:
+            self._histograms[key] = Histogram()
+        return self._histograms[key]
+
+    def _count(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, turn, llm):
+        labels = {"llm": llm}
+        with self._lock:
+            self._count("qc_turns_total", labels, 1)
+            for name, seconds in turn.stages.items():
+                self._histogram("qc_stage_seconds", dict(labels, stage=name)).observe(seconds)
+            if turn.ttft is not None:
+                self._histogram("qc_ttft_seconds", labels).observe(turn.ttft)
+            if turn.total is not None:
+                self._histogram("qc_turn_seconds", labels).observe(turn.total)
+            for name, value in turn.counts.items():
+                self._count(f"qc_{name}_total", labels, value)
+
+    def render(self, llm_stats=None):
+        """Prometheus text exposition of the turn metrics and, if given, LLMRegistry.stats()."""
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+        seen = set()
+        for (name, labels), histogram in histograms:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            lines.extend(histogram.lines(name, dict(labels)))
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{_labels(dict(labels))} {value}")
+        if llm_stats:
+            for name, field in (("qc_llm_calls_total", "calls"), ("qc_llm_errors_total", "errors")):
+                lines.append(f"# TYPE {name} counter")
+                lines.extend(f'{name}{_labels({"llm": llm})} {stats[field]}' for llm, stats in llm_stats.items())
+            lines.append("# TYPE qc_llm_avg_seconds gauge")
+            lines.extend(f'qc_llm_avg_seconds{_labels({"llm": llm})} {stats["avg_seconds"]}' for llm, stats in llm_stats.items())
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(render, port=metrics_port, host=metrics_host):
+    """Serve ``render()`` at /metrics from a daemon thread; returns the server, or None if the port is taken."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer((host, port), Handler)
+    except OSError as e:
+        print(f"metrics endpoint not started on port {port}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
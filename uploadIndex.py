@@ -0,0 +1,131 @@
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from fsspec.implementations.memory import MemoryFileSystem
+from llama_index.core import Document, SimpleDirectoryReader, VectorStoreIndex
+
+from tableStore import ExcelReader
+
+# 每个会话上传文件的总大小上限
+upload_max_bytes = 50 * 1024 * 1024
+# 闲置超过这个时间的上传索引被回收
+upload_ttl = 3600
+upload_max_sessions = 64
+# 纯文本直接从内存解码, 不经过文件读取器
+text_suffixes = (".txt", ".md", ".markdown", ".csv", ".json", ".py", ".log")
+
+_archiver = ThreadPoolExecutor(max_workers=2, thread_name_prefix="upload-archive")
+
+
+def load_upload_documents(files, file_metadata=None):
+    """Parse [(file name, bytes)] into Documents without touching the disk.
+
+    Text files are decoded in place; everything else goes through the usual
+    SimpleDirectoryReader file readers on an in-memory filesystem, which is
+    cleared afterwards.
+    """
+    docs = []
+    others = []
+    for name, data in files:
+        if name.lower().endswith(text_suffixes):
+            metadata = dict(file_metadata(name) if file_metadata else {}, file_name=name)
+            docs.append(Document(text=bytes(data).decode("utf-8", errors="ignore"), metadata=metadata))
+        else:
+            others.append((name, data))
+    if not others:
+        return docs
+
+    fs = MemoryFileSystem()
+    prefix = f"/uploads/{uuid.uuid4().hex}"
+    paths = {}
+    try:
+        for name, data in others:
+            path = f"{prefix}/{name}"
+            fs.pipe(path, bytes(data))
+            paths[path] = name
+        reader = SimpleDirectoryReader(
+            input_files=list(paths),
+            fs=fs,
+            file_extractor={".xlsx": ExcelReader()},
+            file_metadata=lambda path: dict(file_metadata(paths[path]) if file_metadata else {}, file_name=paths[path]),
+        )
+        docs.extend(reader.load_data())
+    finally:
+        # MemoryFileSystem 的存储是进程级共享的, 用完必须删掉
+        fs.rm(prefix, recursive=True)
+    return docs
+
+
+def archive_uploads(files, bucket, region=None):
+    """Archive [(file name, bytes)] to ``bucket`` in the background; returns {file name: presigned URL} right away."""
+    from upsertS3 import create_bucket, upload_bytes, create_presigned_urls
+
+    def archive():
+        if not create_bucket(bucket_name=bucket, region=region):
+            print(f"upload archive: could not create bucket {bucket}")
+        for name, data in files:
+            if not upload_bytes(data, bucket, name, region=region):
+                print(f"upload archive: failed to upload {name} to {bucket}")
+
+    _archiver.submit(archive)
+    # 预签名只在本地计算, 不用等上传完成
+    return create_presigned_urls(bucket, [name for name, _ in files], region=region)
+
+
+class UploadIndexStore(object):
+    """In-memory vector indexes over each session's uploaded files.
+
+    Indexes live in SimpleVectorStores, one per session, and are dropped after
+    ``ttl`` seconds without use or when more than ``max_sessions`` sessions
+    hold one (least recently used first), so abandoned sessions do not keep
+    memory or disk.
+    """
+
+    def __init__(self, ttl=upload_ttl, max_sessions=upload_max_sessions, max_bytes=upload_max_bytes):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        for session_id in [s for s, (_, last_used) in self._entries.items() if now - last_used > self.ttl]:
+            del self._entries[session_id]
+        while len(self._entries) > self.max_sessions:
+            self._entries.popitem(last=False)
+
+    def build(self, session_id, files, embed_model=None, file_metadata=None):
+        """Index [(file name, bytes)] for ``session_id``; returns (index, names of files skipped over the size cap)."""
+        kept, skipped, total = [], [], 0
+        for name, data in files:
+            if total + len(data) > self.max_bytes:
+                skipped.append(name)
+                continue
+            kept.append((name, data))
+            total += len(data)
+        docs = load_upload_documents(kept, file_metadata)
+        index = VectorStoreIndex.from_documents(docs, embed_model=embed_model)
+        with self._lock:
+            now = time.time()
+            self._entries[session_id] = (index, now)
+            self._entries.move_to_end(session_id)
+            self._evict(now)
+        return index, skipped
+
+    def get(self, session_id):
+        with self._lock:
+            now = time.time()
+            self._evict(now)
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            self._entries[session_id] = (entry[0], now)
+            self._entries.move_to_end(session_id)
+            return entry[0]
+
+    def discard(self, session_id):
+        with self._lock:
+            self._entries.pop(session_id, None)
@@ -1,11 +1,46 @@
+import io
 import logging
+import threading
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import os
 import streamlit as st
 
 aws_access_key_id = st.secrets.aws_access_key
 aws_secret_access_key = st.secrets.aws_secret_key
+# 指向本地的 moto/MinIO 时设置, 例如 http://localhost:9000
+s3_endpoint_url = os.environ.get("QC_S3_ENDPOINT") or None
+s3_max_pool_connections = 32
+# 超过阈值的文件分片并发上传
+multipart_threshold = 8 * 1024 * 1024
+multipart_chunksize = 8 * 1024 * 1024
+multipart_concurrency = 8
+
+transfer_config = TransferConfig(multipart_threshold=multipart_threshold,
+                                 multipart_chunksize=multipart_chunksize,
+                                 max_concurrency=multipart_concurrency)
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(region=None):
+    """Shared S3 client for ``region``; boto3 clients are thread-safe and keep their connection pool."""
+    with _clients_lock:
+        if region not in _clients:
+            _clients[region] = boto3.client(
+                's3',
+                region_name=region,
+                endpoint_url=s3_endpoint_url,
+                aws_access_key_id=aws_access_key_id,
+                aws_secret_access_key=aws_secret_access_key,
+                config=Config(max_pool_connections=s3_max_pool_connections,
+                              retries={'max_attempts': 3, 'mode': 'standard'}),
+            )
+        return _clients[region]
+
 
 def create_bucket(bucket_name, region=None):
     """Create an S3 bucket in a specified region
@@ -20,7 +55,7 @@ def create_bucket(bucket_name, region=None):
 
     # Create bucket
     try:
-        s3_client = boto3.client('s3', region_name=region, api_version=None, use_ssl=None, verify=None, endpoint_url=None, aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key, aws_session_token=None, config=None)
+        s3_client = get_client(region)
         if region is None:
             s3_client.create_bucket(Bucket=bucket_name)
         else:
@@ -33,12 +68,15 @@ def create_bucket(bucket_name, region=None):
     return True
 
 
-def upload_file(file_name, bucket, object_name=None):
+def upload_file(file_name, bucket, object_name=None, region=None):
     """Upload a file to an S3 bucket
 
+    Files above ``multipart_threshold`` are uploaded in parts, in parallel.
+
     :param file_name: File to upload
     :param bucket: Bucket to upload to
     :param object_name: S3 object name. If not specified then file_name is used
+    :param region: Region of the bucket
     :return: True if file was uploaded, else False
     """
 
@@ -47,26 +85,45 @@ def upload_file(file_name, bucket, object_name=None):
         object_name = os.path.basename(file_name)
 
     # Upload the file
-    s3_client = boto3.client('s3', aws_access_key_id, aws_secret_access_key)
+    s3_client = get_client(region)
     try:
-        response = s3_client.upload_file(file_name, bucket, object_name)
-    except ClientError as e:
+        s3_client.upload_file(file_name, bucket, object_name, Config=transfer_config)
+    except (ClientError, boto3.exceptions.S3UploadFailedError) as e:
+        logging.error(e)
+        return False
+    return True
+
+
+def upload_bytes(data, bucket, object_name, region=None):
+    """Upload an in-memory object to an S3 bucket
+
+    :param data: Bytes to upload
+    :param bucket: Bucket to upload to
+    :param object_name: S3 object name
+    :param region: Region of the bucket
+    :return: True if uploaded, else False
+    """
+    s3_client = get_client(region)
+    try:
+        s3_client.upload_fileobj(io.BytesIO(data), bucket, object_name, Config=transfer_config)
+    except (ClientError, boto3.exceptions.S3UploadFailedError) as e:
         logging.error(e)
         return False
     return True
 
 
-def create_presigned_url(bucket_name, object_name, expiration=3600):
+def create_presigned_url(bucket_name, object_name, expiration=3600, region=None):
     """Generate a presigned URL to share an S3 object
 
     :param bucket_name: string
     :param object_name: string
     :param expiration: Time in seconds for the presigned URL to remain valid
+    :param region: Region of the bucket
     :return: Presigned URL as string. If error, returns None.
     """
 
     # Generate a presigned URL for the S3 object
-    s3_client = boto3.client('s3', aws_access_key_id, aws_secret_access_key)
+    s3_client = get_client(region)
     try:
         response = s3_client.generate_presigned_url('get_object',
                                                     Params={'Bucket': bucket_name,
@@ -78,3 +135,12 @@ def create_presigned_url(bucket_name, object_name, expiration=3600):
 
     # The response contains the presigned URL
     return response
+
+
+def create_presigned_urls(bucket_name, object_names, expiration=3600, region=None):
+    """Presigned URLs for several objects; signing is local, no request is made per object
+
+    :return: Dict of object name to presigned URL (None on error)
+    """
+    return {object_name: create_presigned_url(bucket_name, object_name, expiration, region)
+            for object_name in object_names}
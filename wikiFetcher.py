@@ -0,0 +1,222 @@
+import time
+import asyncio
+import threading
+import lark_oapi as lark
+from lark_oapi.api.docx.v1 import *
+from lark_oapi.api.sheets.v3 import *
+from feishuToken import FEISHU_HOST, resolve_token
+from tableStore import SheetFileWriter
+from wikiSync import local_path
+
+# 飞书频控错误码: 通用频控 / 表格接口频控
+FEISHU_RATE_LIMIT_CODES = (99991400, 90217)
+SHEET_VALUES_ENDPOINT = f"{FEISHU_HOST}/open-apis/sheets/v2/spreadsheets"
+# 读取表格时每个请求的行数, 单次返回不能超过 10MB
+sheet_range_rows = 2000
+
+# 每个接口的并发上限, 各接口频控额度不同
+endpoint_limits = {
+    "docx": 5,
+    "sheets": 5,
+    "sheet_values": 5,
+}
+
+
+def _column_letter(n):
+    # 1 -> A, 26 -> Z, 27 -> AA
+    letters = ""
+    while n > 0:
+        n, remainder = divmod(n - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+class FetchStats(object):
+    # 记录每个节点的下载耗时, 用来确认总耗时接近最慢的文档而不是所有文档之和
+    def __init__(self):
+        self.fetched = 0
+        self.failed = 0
+        self.retries = 0
+        self.node_timings = {}
+        self.started = None
+        self.finished = None
+        # 解析/写文件会放到线程里执行, 计数统一加锁
+        self._lock = threading.Lock()
+
+    def record(self, node, elapsed, fetched):
+        with self._lock:
+            self.node_timings[node["obj_token"]] = (node["title"], elapsed)
+            if fetched:
+                self.fetched += 1
+            else:
+                self.failed += 1
+
+    def retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def report(self, slowest=5):
+        wall = (self.finished or time.perf_counter()) - (self.started or time.perf_counter())
+        total = sum(elapsed for _, elapsed in self.node_timings.values())
+        slow = sorted(self.node_timings.values(), key=lambda t: t[1], reverse=True)[:slowest]
+        slow_str = ", ".join(f"{title}={elapsed:.2f}s" for title, elapsed in slow)
+        return (f"fetched {self.fetched} nodes ({self.failed} failed, {self.retries} retries) "
+                f"in {wall:.2f}s wall / {total:.2f}s summed, slowest: {slow_str}")
+
+
+class WikiFetcher(object):
+    """Download docx and sheet nodes into ``directory`` with a pool of async workers.
+
+    Docx nodes are saved as raw text; sheets are saved as SQLite files (see
+    ``tableStore.SheetFileWriter``) with one table per sheet.
+    Every Feishu endpoint has its own concurrency limit and requests that hit a
+    rate-limit code are retried with exponential backoff. ``tenant_access_token``
+    may be a fixed token or a TokenProvider.
+    """
+
+    def __init__(self, client, tenant_access_token, directory="./data", workers=16, limits=None,
+                 max_retries=4, backoff=1.0):
+        self.client = client
+        self.tenant_access_token = tenant_access_token
+        self.directory = directory
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.limits = dict(endpoint_limits, **(limits or {}))
+        self.stats = FetchStats()
+        self._semaphores = {}
+
+    async def option(self):
+        token = await resolve_token(self.tenant_access_token)
+        return lark.RequestOption.builder().tenant_access_token(token).build()
+
+    def _semaphore(self, endpoint):
+        if endpoint not in self._semaphores:
+            self._semaphores[endpoint] = asyncio.Semaphore(self.limits.get(endpoint, 1))
+        return self._semaphores[endpoint]
+
+    async def _backoff(self, attempt):
+        self.stats.retry()
+        await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def call(self, endpoint, fn, request):
+        # fn 是 lark SDK 的异步接口, 如 client.docx.v1.document.araw_content
+        for attempt in range(self.max_retries + 1):
+            async with self._semaphore(endpoint):
+                response = await fn(request, await self.option())
+            if response.code in FEISHU_RATE_LIMIT_CODES and attempt < self.max_retries:
+                await self._backoff(attempt)
+                continue
+            return response
+
+    async def get_json(self, endpoint, session, url):
+        for attempt in range(self.max_retries + 1):
+            headers = {
+                'Authorization': f'Bearer {await resolve_token(self.tenant_access_token)}'
+            }
+            async with self._semaphore(endpoint):
+                async with session.get(url, headers=headers) as response:
+                    status = response.status
+                    try:
+                        result_data = await response.json(content_type=None)
+                    except ValueError:
+                        result_data = {"msg": await response.text()}
+            result_data = result_data or {}
+            if (status == 429 or result_data.get("code") in FEISHU_RATE_LIMIT_CODES) and attempt < self.max_retries:
+                await self._backoff(attempt)
+                continue
+            if status != 200 or result_data.get("code", 0) != 0:
+                lark.logger.error(
+                    f"Getting sheet from {url} failed, code: {status}, msg: {result_data.get('msg')}")
+                return None
+            return result_data
+
+    async def fetch_sheet(self, session, node, path):
+        sheet_token = node["obj_token"]
+        request: QuerySpreadsheetSheetRequest = QuerySpreadsheetSheetRequest.builder() \
+            .spreadsheet_token(sheet_token) \
+            .build()
+
+        response: QuerySpreadsheetSheetResponse = await self.call(
+            "sheets", self.client.sheets.v3.spreadsheet_sheet.aquery, request)
+        if not response.success():
+            lark.logger.error(
+                f"client.sheets.v3.spreadsheet_sheet.query failed, code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}")
+            return False
+
+        # 每个 sheet 按行区间分段拉取, 每段到达后直接写入本地 SQLite 文件, 不在内存里拼整表
+        writer = SheetFileWriter(path)
+        try:
+            fetched = await asyncio.gather(*[
+                self.fetch_sheet_values(session, sheet_token, position, sheet, writer)
+                for position, sheet in enumerate(response.data.sheets or [])
+            ])
+            if not all(fetched):
+                # 有区间没拉下来就整份放弃, 下次同步再重试, 避免把残缺的表格入库
+                writer.abort()
+                return False
+            await asyncio.to_thread(writer.commit)
+        except BaseException:
+            writer.abort()
+            raise
+        return True
+
+    async def fetch_sheet_values(self, session, sheet_token, position, sheet, writer):
+        await asyncio.to_thread(writer.add_sheet, position, sheet.title)
+        grid = sheet.grid_properties
+        if grid is None or not grid.row_count or not grid.column_count:
+            # 拿不到行列数时整表读取
+            ranges = [(1, sheet.sheet_id)]
+        else:
+            last_column = _column_letter(grid.column_count)
+            ranges = [(start, f"{sheet.sheet_id}!A{start}:{last_column}{min(start + sheet_range_rows - 1, grid.row_count)}")
+                      for start in range(1, grid.row_count + 1, sheet_range_rows)]
+
+        async def fetch_range(start, value_range):
+            respJson = await self.get_json("sheet_values", session, f'{SHEET_VALUES_ENDPOINT}/{sheet_token}/values/{value_range}')
+            if not respJson:
+                return False
+            rows = respJson["data"]["valueRange"].get("values") or []
+            await asyncio.to_thread(writer.write_rows, position, start, rows)
+            return True
+
+        return all(await asyncio.gather(*[fetch_range(start, value_range) for start, value_range in ranges]))
+
+    async def fetch_docx(self, node, path):
+        doc_id = node["obj_token"]
+        request: RawContentDocumentRequest = RawContentDocumentRequest.builder() \
+            .document_id(doc_id) \
+            .lang(0) \
+            .build()
+
+        response: RawContentDocumentResponse = await self.call(
+            "docx", self.client.docx.v1.document.araw_content, request)
+        if not response.success():
+            lark.logger.error(
+                f"client.docx.v1.document.raw_content failed, code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}, doc_id: {doc_id}")
+            return False
+
+        try:
+            with open(path, 'w') as f:
+                f.write(response.data.content)
+        except OSError as e:
+            print(f'failed to write {path}: {e}')
+            return False
+        return True
+
+    async def fetch_node(self, session, node):
+        """Fetch one node; returns (node, path, fetched)."""
+        path = local_path(self.directory, node)
+        started = time.perf_counter()
+        try:
+            if node["obj_type"] == "sheet":
+                fetched = await self.fetch_sheet(session, node, path)
+            elif node["obj_type"] == "docx":
+                fetched = await self.fetch_docx(node, path)
+            else:
+                fetched = False
+        except Exception as e:
+            print(f'failed to fetch {node["title"]} ({node["obj_token"]}): {e}')
+            fetched = False
+        self.stats.record(node, time.perf_counter() - started, fetched)
+        return node, path, fetched
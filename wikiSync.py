@@ -0,0 +1,142 @@
+import os
+import json
+import hashlib
+
+manifest_path = "./sync_manifest.json"
+url_cache_path = "./url_cache.json"
+# 目前只同步这两类节点, 其它类型(bitable, mindnote, file...)在 readWiki 中不会被下载
+supported_types = ("docx", "sheet")
+
+
+def local_path(directory, node):
+    """Absolute path a node is synced to; sheets are stored as SQLite files."""
+    name = node["title"] + ".sqlite" if node["obj_type"] == "sheet" else node["title"]
+    return os.path.abspath(os.path.join(directory, name))
+
+
+def content_hash(path):
+    """SHA-256 of a local file's bytes, or None if it cannot be read."""
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+class SyncManifest(object):
+    """Persisted map of obj_token -> title, edit time, content hash and local path.
+
+    Lets readWiki fetch only the wiki nodes that are new or whose
+    ``obj_edit_time`` moved since the last sync, and clean up the local files
+    (and vectors) of nodes that disappeared from the space.
+    """
+
+    def __init__(self, path=manifest_path):
+        self.path = path
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Failed to load sync manifest {self.path}: {e}, doing a full sync")
+                self.entries = {}
+        return self.entries
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def plan(self, nodes, directory="./data", complete=True):
+        """Split the crawled nodes into (changed, unchanged, vanished).
+
+        ``changed`` and ``unchanged`` are node dicts, ``vanished`` is a list of
+        (obj_token, entry) pairs for manifest entries no longer in the wiki.
+        After an incomplete crawl nothing is reported as vanished, since a
+        missing node may just be in a subtree that failed to load.
+        """
+        changed = []
+        unchanged = []
+        seen = set()
+        for node in nodes:
+            if node.get("obj_type") not in supported_types:
+                continue
+            token = node["obj_token"]
+            seen.add(token)
+            entry = self.entries.get(token)
+            if (entry is None
+                    or entry.get("edit_time") != node.get("obj_edit_time")
+                    or entry.get("title") != node.get("title")
+                    or entry.get("path") != local_path(directory, node)
+                    or not os.path.exists(entry.get("path", ""))):
+                changed.append(node)
+            else:
+                unchanged.append(node)
+
+        vanished = [(token, entry) for token, entry in self.entries.items() if token not in seen] if complete else []
+        return changed, unchanged, vanished
+
+    def record(self, node, path):
+        entry = {
+            "title": node["title"],
+            "obj_type": node["obj_type"],
+            "edit_time": node.get("obj_edit_time"),
+            "path": os.path.abspath(path),
+            "hash": content_hash(path),
+        }
+        self.entries[node["obj_token"]] = entry
+        return entry
+
+    def remove(self, token):
+        return self.entries.pop(token, None)
+
+    def fileToTitleAndUrl(self, urls):
+        return {entry["path"]: {"title": entry["title"], "url": urls.get(token)} for token, entry in self.entries.items()}
+
+
+class UrlCache(object):
+    """Persisted obj_token -> URL map; wiki URLs never change so entries never expire."""
+
+    def __init__(self, path=url_cache_path):
+        self.path = path
+        self.urls = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    self.urls = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Failed to load url cache {self.path}: {e}")
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.urls, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def missing(self, entries):
+        """(token, obj_type) pairs of manifest entries with no cached URL."""
+        return [(token, entry["obj_type"]) for token, entry in entries.items() if not self.urls.get(token)]
+
+    def update(self, urls):
+        self.urls.update({token: url for token, url in urls.items() if url})
+
+    def prune(self, entries):
+        self.urls = {token: url for token, url in self.urls.items() if token in entries}
+
+
+def remove_local_doc(path, chroma_collection=None, table_store=None, keyword_index=None):
+    """Delete a synced file and, if given, the vectors, SQL tables and keyword postings built from it."""
+    if os.path.exists(path):
+        os.remove(path)
+    if chroma_collection is not None:
+        # SimpleDirectoryReader 把文件的绝对路径写进了每个 chunk 的 file_path 元数据
+        chroma_collection.delete(where={"file_path": path})
+    if table_store is not None:
+        table_store.remove_file(path)
+    if keyword_index is not None:
+        keyword_index.delete_file(path)